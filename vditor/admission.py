@@ -0,0 +1,267 @@
+"""
+Admission control for the Django Vditor upload endpoints.
+
+Limits how many uploads a process hashes and stores at once. A slot is
+only taken once the request body has been received, so slow clients
+cannot hold slots while sending it. Requests over the limit wait in a
+short, bounded queue; once the queue is full, or a request has waited too
+long, it is turned away with ``503 Service Unavailable`` and a
+``Retry-After`` header instead of slowing down every upload in flight.
+Optionally, a limit across all processes is coordinated through the Django
+cache.
+"""
+
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from typing import NamedTuple, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from django.utils.translation import gettext_lazy as _
+
+from .metrics import record_rejection
+
+logger = logging.getLogger(__name__)
+
+# Uploads handled at once by this process; None disables admission control
+UPLOAD_CONCURRENCY = getattr(settings, "VDITOR_UPLOAD_CONCURRENCY", 8)
+
+# Requests waiting for a slot beyond which new requests are rejected
+UPLOAD_QUEUE_SIZE = getattr(settings, "VDITOR_UPLOAD_QUEUE_SIZE", 16)
+
+# Seconds a request waits for a slot before it is rejected
+UPLOAD_QUEUE_TIMEOUT = getattr(settings, "VDITOR_UPLOAD_QUEUE_TIMEOUT", 2.0)
+
+# Value of the Retry-After header of rejected requests, in seconds
+UPLOAD_RETRY_AFTER = getattr(settings, "VDITOR_UPLOAD_RETRY_AFTER", 1)
+
+# Uploads handled at once by all processes sharing the cache; None disables
+UPLOAD_GLOBAL_CONCURRENCY = getattr(settings, "VDITOR_UPLOAD_GLOBAL_CONCURRENCY", None)
+UPLOAD_ADMISSION_CACHE = getattr(settings, "VDITOR_UPLOAD_ADMISSION_CACHE", "default")
+
+# Seconds after which a global slot is freed if its process never released
+# it (e.g. because it was killed); longer than the slowest upload
+UPLOAD_SLOT_TIMEOUT = getattr(settings, "VDITOR_UPLOAD_SLOT_TIMEOUT", 300)
+
+# Seconds between attempts to take a global slot
+GLOBAL_SLOT_POLL_INTERVAL = 0.05
+
+
+class Admission(NamedTuple):
+    """A granted upload slot, to pass back to ``release``."""
+
+    # Cache key of the global slot, or None without global coordination
+    slot_key: Optional[str]
+    slot_token: Optional[str]
+
+
+class AdmissionController:
+    """Bound the number of uploads in flight, with a bounded wait queue.
+
+    Thread-safe; one controller is shared by every request of the process.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        queue_size: int,
+        queue_timeout: float,
+        global_limit: Optional[int] = None,
+        cache_alias: str = "default",
+    ) -> None:
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.global_limit = global_limit
+        self.cache_alias = cache_alias
+        self._active = 0
+        self._waiting = 0
+        self._max_waiting = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> Optional[Admission]:
+        """Wait for an upload slot.
+
+        Returns:
+            Admission to release once the upload is handled, or None if the
+            queue is full or no slot was freed in time
+        """
+        start = time.monotonic()
+        with self._condition:
+            if self._active >= self.limit or self._waiting:
+                if self._waiting >= self.queue_size:
+                    self._rejected += 1
+                    return None
+                self._waiting += 1
+                self._max_waiting = max(self._max_waiting, self._waiting)
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self._active < self.limit, self.queue_timeout
+                    )
+                finally:
+                    self._waiting -= 1
+                if not admitted:
+                    self._rejected += 1
+                    return None
+            self._active += 1
+
+        admission = Admission(None, None)
+        if self.global_limit is not None:
+            deadline = start + self.queue_timeout
+            admission = self._acquire_global_slot(deadline)
+            if admission is None:
+                self._release_local()
+                with self._condition:
+                    self._rejected += 1
+                return None
+
+        waited = time.monotonic() - start
+        with self._condition:
+            self._admitted += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+        return admission
+
+    def release(self, admission: Admission) -> None:
+        """Free the slot of a handled upload."""
+        if admission.slot_key is not None:
+            cache = caches[self.cache_alias]
+            try:
+                # Only free the slot if it has not expired and been retaken
+                if cache.get(admission.slot_key) == admission.slot_token:
+                    cache.delete(admission.slot_key)
+            except Exception as e:
+                logger.warning(f"Failed to release upload slot: {e}")
+        self._release_local()
+
+    def _release_local(self) -> None:
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def _acquire_global_slot(self, deadline: float) -> Optional[Admission]:
+        """Take one of the ``global_limit`` slots kept in the cache.
+
+        Each slot is a cache key set with ``add``, which is atomic, and expires
+        after ``UPLOAD_SLOT_TIMEOUT`` in case its holder dies.
+        """
+        cache = caches[self.cache_alias]
+        token = uuid.uuid4().hex
+        while True:
+            # Start at a random slot so processes do not contend for the first
+            offset = random.randrange(self.global_limit)
+            for i in range(self.global_limit):
+                key = f"vditor_upload_slot_{(offset + i) % self.global_limit}"
+                try:
+                    if cache.add(key, token, UPLOAD_SLOT_TIMEOUT):
+                        return Admission(key, token)
+                except Exception as e:
+                    # Never block uploads because the cache is unavailable
+                    logger.warning(f"Failed to take upload slot: {e}")
+                    return Admission(None, None)
+            if time.monotonic() + GLOBAL_SLOT_POLL_INTERVAL > deadline:
+                return None
+            time.sleep(GLOBAL_SLOT_POLL_INTERVAL)
+
+    def gauges(self) -> dict:
+        """Get the current state of the controller.
+
+        Returns:
+            Dictionary with ``active``, ``queue_depth``, ``max_queue_depth``,
+            ``admitted``, ``rejected``, ``total_wait_time``,
+            ``avg_wait_time`` and ``max_wait_time`` (in seconds)
+        """
+        with self._condition:
+            return {
+                "active": self._active,
+                "queue_depth": self._waiting,
+                "max_queue_depth": self._max_waiting,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "total_wait_time": self._total_wait,
+                "avg_wait_time": (
+                    self._total_wait / self._admitted if self._admitted else 0.0
+                ),
+                "max_wait_time": self._max_wait,
+            }
+
+
+upload_admission = AdmissionController(
+    UPLOAD_CONCURRENCY or 0,
+    UPLOAD_QUEUE_SIZE,
+    UPLOAD_QUEUE_TIMEOUT,
+    UPLOAD_GLOBAL_CONCURRENCY,
+    UPLOAD_ADMISSION_CACHE,
+)
+
+
+class UploadsBusy(Exception):
+    """Raised when no upload slot was freed in time."""
+
+
+def busy_response() -> JsonResponse:
+    """Build the ``503`` response of an upload turned away by ``upload_slot``."""
+    record_rejection("busy")
+    response = JsonResponse(
+        {
+            "msg": _("Server is busy, please retry later."),
+            "code": 1,
+        },
+        status=503,
+    )
+    response["Retry-After"] = str(UPLOAD_RETRY_AFTER)
+    return response
+
+
+@contextmanager
+def upload_slot():
+    """Hold an upload slot while uploads are hashed and stored.
+
+    Take it only once the request body has been received, so slow clients
+    cannot hold slots while they send it.
+
+    Raises:
+        UploadsBusy: If the queue is full or no slot was freed in time
+    """
+    if UPLOAD_CONCURRENCY is None:
+        yield
+        return
+    controller = upload_admission
+    admission = controller.acquire()
+    if admission is None:
+        logger.warning("Upload rejected: too many uploads in progress")
+        raise UploadsBusy()
+    try:
+        yield
+    finally:
+        controller.release(admission)
+
+
+@asynccontextmanager
+async def async_upload_slot():
+    """Async counterpart of ``upload_slot``.
+
+    Waits for a slot on a worker thread so the event loop is never blocked.
+    """
+    if UPLOAD_CONCURRENCY is None:
+        yield
+        return
+    controller = upload_admission
+    admission = await sync_to_async(controller.acquire, thread_sensitive=False)()
+    if admission is None:
+        logger.warning("Upload rejected: too many uploads in progress")
+        raise UploadsBusy()
+    try:
+        yield
+    finally:
+        await sync_to_async(controller.release, thread_sensitive=False)(admission)
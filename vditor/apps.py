@@ -0,0 +1,19 @@
+from django.apps import AppConfig
+from django.core.signals import request_finished, setting_changed
+
+
+class VditorAppConfig(AppConfig):
+    name = "vditor"
+    default_auto_field = "django.db.models.BigAutoField"
+
+    def ready(self):
+        from .metrics import flush_metrics
+        from .policy import load_upload_policies, reload_upload_policies
+        from .tracing import load_tracing_hooks
+
+        # Compile upload validation rules once, before the first request
+        load_upload_policies()
+        setting_changed.connect(reload_upload_policies)
+        # Add the metrics counted during a request in one batch
+        request_finished.connect(flush_metrics)
+        load_tracing_hooks()
@@ -0,0 +1,383 @@
+"""
+Benchmarks for Django Vditor.
+
+Run with ``python manage.py vditor_bench``. Each benchmark is warmed up,
+then timed for at least ``min_rounds`` rounds and ``min_time`` seconds with
+``perf_counter_ns``; warm-up rounds are discarded. Fast functions are
+called many times per round so each round is long enough to time
+accurately.
+
+Results can be saved as a JSON baseline and compared with a later run,
+failing when the median of a benchmark regressed beyond a threshold.
+Uploads are written to a temporary ``MEDIA_ROOT`` and their database rows
+are rolled back, so benchmarks never touch real uploads or metrics.
+"""
+
+import json
+import os
+import platform
+import shutil
+import statistics
+import struct
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Callable, NamedTuple, Optional
+
+import django
+from django.db import transaction
+from django.test import override_settings
+
+BASELINE_VERSION = 1
+
+# Shortest round timed when calling a fast function repeatedly, in seconds
+MIN_ROUND_TIME = 0.001
+MAX_CALLS_PER_ROUND = 1_000_000
+
+UPLOAD_SIZES = (4 * 1024, 256 * 1024, 2 * 1024 * 1024)
+UPLOAD_FILES = (1, 4, 16)
+RENDER_WIDGETS = (1, 10, 100)
+
+
+class BenchmarkError(Exception):
+    """Raised when a benchmarked call does not do what it is meant to."""
+
+
+class Benchmark(NamedTuple):
+    """A function to time."""
+
+    name: str
+    func: Callable[..., object]
+    # Called before each round, outside the timing; returns func's arguments
+    setup: Optional[Callable[[], tuple]] = None
+    # Bytes processed per call, to report throughput
+    bytes_per_call: int = 0
+    # Called after each round, outside the timing, with func's arguments
+    teardown: Optional[Callable[..., None]] = None
+
+
+class BenchmarkResult(NamedTuple):
+    """Statistics of a benchmark, in seconds per call."""
+
+    name: str
+    rounds: int
+    calls_per_round: int
+    median: float
+    mean: float
+    stdev: float
+    iqr: float
+    min: float
+    max: float
+    # Bytes per second at the median, for benchmarks processing bytes
+    throughput: Optional[float]
+
+
+class Comparison(NamedTuple):
+    """Change of a benchmark median against a baseline."""
+
+    name: str
+    baseline: float
+    current: float
+    change: float
+    regressed: bool
+
+
+def format_size(size: int) -> str:
+    if size >= 1024 * 1024:
+        return f"{size // (1024 * 1024)}MB"
+    return f"{size // 1024}KB"
+
+
+def _png(size: int) -> bytes:
+    """Build a PNG-headed file of random content, unique for each call."""
+    ihdr = struct.pack(">IIBBBBB", 640, 480, 8, 2, 0, 0, 0)
+    header = (
+        b"\x89PNG\r\n\x1a\n"
+        + struct.pack(">I", len(ihdr))
+        + b"IHDR"
+        + ihdr
+        + struct.pack(">I", zlib.crc32(b"IHDR" + ihdr))
+    )
+    return header + os.urandom(max(0, size - len(header)))
+
+
+def _upload_benchmark(size: int, files: int) -> Benchmark:
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import RequestFactory
+
+    from .uploadhandler import upload_memory_budget
+    from .views import vditor_images_upload_view
+
+    factory = RequestFactory()
+
+    def setup() -> tuple:
+        # New content every round, so nothing is deduplicated
+        uploads = [
+            SimpleUploadedFile(f"bench{i}.png", _png(size), content_type="image/png")
+            for i in range(files)
+        ]
+        return (factory.post("/vditor/uploads/", {"file[]": uploads}),)
+
+    def upload(request) -> None:
+        response = vditor_images_upload_view(request)
+        result = json.loads(response.content)
+        if result["code"] != 0 or len(result["data"]["succMap"]) != files:
+            raise BenchmarkError(f"Upload failed: {result['msg']}")
+
+    def close(request) -> None:
+        # Release the in-memory buffers so rounds do not pile up reservations
+        request.close()
+        in_memory = upload_memory_budget.gauges()["in_memory_bytes"]
+        if in_memory:
+            raise BenchmarkError(f"Upload left {in_memory} bytes buffered")
+
+    return Benchmark(
+        f"upload/{format_size(size)}x{files}", upload, setup, size * files, close
+    )
+
+
+def _render_benchmark(widgets: int) -> Benchmark:
+    from .widgets import VditorWidget
+
+    def render() -> None:
+        for i in range(widgets):
+            VditorWidget().render(f"content_{i}", "Some **markdown**")
+
+    return Benchmark(f"render/{widgets}", render)
+
+
+def _config_benchmarks() -> list[Benchmark]:
+    from .cache_utils import ConfigCache
+    from .configs import VditorConfig
+
+    def invalidate() -> tuple:
+        ConfigCache.invalidate_config("default")
+        return ()
+
+    def load() -> None:
+        VditorConfig("default")
+
+    return [
+        Benchmark("config/hit", load),
+        Benchmark("config/miss", load, invalidate),
+    ]
+
+
+def _validation_benchmarks() -> list[Benchmark]:
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    from .policy import get_upload_policy
+    from .security import SecurityValidator
+    from .views import _validate_uploaded_file
+
+    policy = get_upload_policy()
+    upload = SimpleUploadedFile("photo.png", _png(256 * 1024), content_type="image/png")
+    content = _png(1024 * 1024)
+    validator = SecurityValidator()
+
+    def validate_filename() -> None:
+        policy.validate_filename("holiday-2024_final.png")
+
+    def validate_upload() -> None:
+        is_valid, error_msg = _validate_uploaded_file(upload, policy)
+        if not is_valid:
+            raise BenchmarkError(error_msg)
+
+    def scan_content() -> None:
+        validator.validate_file_content(content)
+
+    return [
+        Benchmark("validate/filename", validate_filename),
+        Benchmark("validate/upload", validate_upload),
+        Benchmark("validate/scan_1MB", scan_content, bytes_per_call=len(content)),
+    ]
+
+
+def get_benchmarks() -> list[Benchmark]:
+    """Get every benchmark, in the order they are run."""
+    return (
+        [
+            _upload_benchmark(size, files)
+            for size in UPLOAD_SIZES
+            for files in UPLOAD_FILES
+        ]
+        + [_render_benchmark(widgets) for widgets in RENDER_WIDGETS]
+        + _config_benchmarks()
+        + _validation_benchmarks()
+    )
+
+
+def _time_round(benchmark: Benchmark, calls: int) -> float:
+    args = benchmark.setup() if benchmark.setup is not None else ()
+    func = benchmark.func
+    start = time.perf_counter_ns()
+    for _ in range(calls):
+        func(*args)
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    if benchmark.teardown is not None:
+        benchmark.teardown(*args)
+    return elapsed
+
+
+def _calibrate(benchmark: Benchmark) -> int:
+    """Find how many calls make a round last at least ``MIN_ROUND_TIME``."""
+    if benchmark.setup is not None:
+        # Arguments are prepared once per round and may be single-use
+        return 1
+    calls = 1
+    while calls < MAX_CALLS_PER_ROUND:
+        if _time_round(benchmark, calls) >= MIN_ROUND_TIME:
+            break
+        calls *= 10
+    return calls
+
+
+def run_benchmark(
+    benchmark: Benchmark,
+    warmup: int = 2,
+    min_rounds: int = 5,
+    min_time: float = 0.5,
+    max_rounds: int = 1000,
+) -> BenchmarkResult:
+    """Time a benchmark.
+
+    Args:
+        benchmark: Benchmark to run
+        warmup: Rounds run first and discarded
+        min_rounds: Rounds timed at least
+        min_time: Seconds spent timing rounds at least
+        max_rounds: Rounds timed at most
+
+    Returns:
+        Statistics of the timed rounds
+    """
+    calls = _calibrate(benchmark)
+    for _ in range(warmup):
+        _time_round(benchmark, calls)
+
+    timings = []
+    deadline = time.perf_counter() + min_time
+    while len(timings) < max_rounds and (
+        len(timings) < min_rounds or time.perf_counter() < deadline
+    ):
+        timings.append(_time_round(benchmark, calls) / calls)
+
+    median = statistics.median(timings)
+    if len(timings) > 1:
+        quartiles = statistics.quantiles(timings, n=4)
+        iqr = quartiles[2] - quartiles[0]
+        stdev = statistics.stdev(timings)
+    else:
+        iqr = stdev = 0.0
+    throughput = None
+    if benchmark.bytes_per_call and median > 0:
+        throughput = benchmark.bytes_per_call / median
+    return BenchmarkResult(
+        name=benchmark.name,
+        rounds=len(timings),
+        calls_per_round=calls,
+        median=median,
+        mean=statistics.fmean(timings),
+        stdev=stdev,
+        iqr=iqr,
+        min=min(timings),
+        max=max(timings),
+        throughput=throughput,
+    )
+
+
+@contextmanager
+def bench_environment():
+    """Isolate benchmarks from real uploads, metrics and database rows.
+
+    Uploads go to a temporary ``MEDIA_ROOT`` rather than ``VDITOR_STORAGE``,
+    metrics are kept in this process, and every database change is rolled
+    back.
+    """
+    from . import metrics, views
+
+    media_root = tempfile.mkdtemp(prefix="vditor-bench-")
+    saved = (views.UPLOAD_STORAGE, metrics.METRICS_CACHE)
+    views.UPLOAD_STORAGE = None
+    metrics.METRICS_CACHE = None
+    try:
+        with override_settings(MEDIA_ROOT=media_root), transaction.atomic():
+            try:
+                yield
+            finally:
+                transaction.set_rollback(True)
+    finally:
+        views.UPLOAD_STORAGE, metrics.METRICS_CACHE = saved
+        metrics.reset_upload_metrics()
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+def environment_info() -> dict:
+    """Describe where benchmarks ran, to judge whether results compare."""
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "django": django.get_version(),
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def save_baseline(results: list[BenchmarkResult], path: str) -> None:
+    """Write results as a JSON baseline."""
+    data = {
+        "version": BASELINE_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": environment_info(),
+        "results": {result.name: result._asdict() for result in results},
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load_baseline(path: str) -> dict:
+    """Read a JSON baseline written by ``save_baseline``.
+
+    Raises:
+        ValueError: If the file is not a baseline of a supported version
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or data.get("version") != BASELINE_VERSION:
+        raise ValueError(f"{path} is not a version {BASELINE_VERSION} baseline")
+    return data
+
+
+def compare_results(
+    results: list[BenchmarkResult], baseline: dict, threshold: float
+) -> list[Comparison]:
+    """Compare medians with a baseline.
+
+    Args:
+        results: Results of the current run
+        baseline: Baseline from ``load_baseline``
+        threshold: Relative slowdown of the median beyond which a benchmark
+            regressed, e.g. 0.2 for 20%
+
+    Returns:
+        Comparisons of the benchmarks present in both runs
+    """
+    comparisons = []
+    for result in results:
+        previous = baseline["results"].get(result.name)
+        if previous is None or not previous["median"]:
+            continue
+        change = result.median / previous["median"] - 1
+        comparisons.append(
+            Comparison(
+                result.name,
+                previous["median"],
+                result.median,
+                change,
+                change > threshold,
+            )
+        )
+    return comparisons
@@ -13,6 +13,8 @@ from typing import Any, Callable, Optional
 from django.core.cache import cache
 from django.conf import settings
 
+from .metrics import incr_counter
+
 logger = logging.getLogger(__name__)
 
 # Default cache timeouts (in seconds)
@@ -57,8 +59,7 @@ def cache_result(timeout: Optional[int] = None, key_prefix: str = "vditor") -> C
         def wrapper(*args: Any, **kwargs: Any) -> Any:
             # Generate cache key from function name and arguments
             cache_key = get_cache_key(
-                func.__name__, args, tuple(sorted(kwargs.items())), 
-                prefix=key_prefix
+                func.__name__, args, tuple(sorted(kwargs.items())), prefix=key_prefix
             )
 
             # Try to get from cache first
@@ -66,6 +67,7 @@ def cache_result(timeout: Optional[int] = None, key_prefix: str = "vditor") -> C
                 result = cache.get(cache_key)
                 if result is not None:
                     logger.debug(f"Cache hit for {func.__name__}: {cache_key}")
+                    incr_counter("result_cache_hits")
                     return result
             except Exception as e:
                 logger.error(f"Cache get error for {func.__name__}: {e}")
@@ -74,6 +76,7 @@ def cache_result(timeout: Optional[int] = None, key_prefix: str = "vditor") -> C
 
             # Cache miss - execute function
             logger.debug(f"Cache miss for {func.__name__}: {cache_key}")
+            incr_counter("result_cache_misses")
             result = func(*args, **kwargs)
 
             # Store in cache with error handling
@@ -105,7 +108,9 @@ class ConfigCache:
             Cached configuration dict or None if not found
         """
         cache_key = f"vditor_config:{config_name}"
-        return cache.get(cache_key)
+        config = cache.get(cache_key)
+        incr_counter("config_cache_misses" if config is None else "config_cache_hits")
+        return config
 
     @staticmethod
     def set_config(
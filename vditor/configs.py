@@ -4,53 +4,55 @@ from typing import Any, Dict, List, Optional
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from .tracing import span
+
 logger = logging.getLogger(__name__)
 
 
 def validate_config(config: Dict[str, Any], config_name: str) -> List[str]:
     """Validate configuration and return list of warnings.
-    
+
     Args:
         config: Configuration dictionary to validate
         config_name: Name of the configuration
-        
+
     Returns:
         List of warning messages
     """
     warnings = []
-    
+
     # Validate required fields
-    required_fields = ['width', 'height', 'mode']
+    required_fields = ["width", "height", "mode"]
     for field in required_fields:
         if field not in config:
             warnings.append(
                 f"Missing required field '{field}' in config '{config_name}'"
             )
-    
+
     # Validate mode
-    valid_modes = ['sv', 'ir', 'wysiwyg']
-    if 'mode' in config and config['mode'] not in valid_modes:
+    valid_modes = ["sv", "ir", "wysiwyg"]
+    if "mode" in config and config["mode"] not in valid_modes:
         warnings.append(
             f"Invalid mode '{config['mode']}' in config '{config_name}'. "
             f"Valid modes: {valid_modes}"
         )
-    
+
     # Validate theme
-    valid_themes = ['classic', 'dark']
-    if 'theme' in config and config['theme'] not in valid_themes:
+    valid_themes = ["classic", "dark"]
+    if "theme" in config and config["theme"] not in valid_themes:
         warnings.append(
             f"Invalid theme '{config['theme']}' in config '{config_name}'. "
             f"Valid themes: {valid_themes}"
         )
-    
+
     # Validate file size limits
-    if 'upload' in config and 'max' in config['upload']:
-        max_size = config['upload']['max']
+    if "upload" in config and "max" in config["upload"]:
+        max_size = config["upload"]["max"]
         if not isinstance(max_size, (int, float)) or max_size <= 0:
             warnings.append(
                 f"Invalid upload max size '{max_size}' in config '{config_name}'"
             )
-    
+
     return warnings
 
 
@@ -215,6 +217,10 @@ def get_default_config() -> Dict[str, Any]:
 
 class VditorConfig(dict):
     def __init__(self, config_name: str = "default") -> None:
+        with span("config", config=config_name):
+            self._load(config_name)
+
+    def _load(self, config_name: str) -> None:
         # Try to load from cache first
         try:
             from .cache_utils import ConfigCache
@@ -233,7 +239,7 @@ class VditorConfig(dict):
         self.update(get_default_config())
         self.set_language()
         self.set_configs(config_name)
-        
+
         self._validate_and_log_warnings(config_name)
 
         # Cache the result
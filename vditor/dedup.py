@@ -0,0 +1,168 @@
+"""
+Content deduplication index for Django Vditor.
+
+This module maps SHA-256 content hashes to stored uploads. A persistent
+``StoredFile`` table is the source of truth; an in-process bloom filter in
+front of it answers "never seen this content" without touching the
+database or the filesystem.
+"""
+
+import logging
+import math
+import threading
+from typing import Optional
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+logger = logging.getLogger(__name__)
+
+# Default bloom filter sizing
+DEFAULT_BLOOM_CAPACITY = 1_000_000
+DEFAULT_BLOOM_ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    """Fixed-size bloom filter keyed by hex SHA-256 digests.
+
+    The digests are already uniformly distributed, so bit positions are
+    derived from the digest itself by double hashing instead of rehashing.
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        capacity = max(capacity, 1)
+        self.num_bits = max(
+            8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, content_hash: str) -> list[int]:
+        h1 = int(content_hash[:16], 16)
+        h2 = int(content_hash[16:32], 16) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, content_hash: str) -> None:
+        for position in self._positions(content_hash):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, content_hash: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(content_hash)
+        )
+
+
+class ContentIndex:
+    """Persistent content hash to stored file index with a bloom filter.
+
+    The bloom filter is filled from the database on first use and updated
+    as files are recorded. Other processes' inserts are not visible to it,
+    so a miss can occasionally be a duplicate stored by another worker; the
+    unique constraint on ``StoredFile.content_hash`` resolves those races
+    when the file is recorded.
+
+    Lookups and records access the database and must run in a thread that
+    may use Django's connections (the request thread, or ``sync_to_async``).
+    """
+
+    def __init__(self) -> None:
+        self._bloom: Optional[BloomFilter] = None
+        self._lock = threading.Lock()
+
+    def _get_bloom(self) -> BloomFilter:
+        if self._bloom is None:
+            with self._lock:
+                if self._bloom is None:
+                    self._bloom = self._load_bloom()
+        return self._bloom
+
+    def _load_bloom(self) -> BloomFilter:
+        from .models import StoredFile
+
+        count = StoredFile.objects.count()
+        capacity = max(
+            getattr(settings, "VDITOR_DEDUP_BLOOM_CAPACITY", DEFAULT_BLOOM_CAPACITY),
+            count * 2,
+        )
+        bloom = BloomFilter(
+            capacity,
+            getattr(
+                settings, "VDITOR_DEDUP_BLOOM_ERROR_RATE", DEFAULT_BLOOM_ERROR_RATE
+            ),
+        )
+        hashes = StoredFile.objects.values_list("content_hash", flat=True)
+        for content_hash in hashes.iterator(chunk_size=10000):
+            bloom.add(content_hash)
+        logger.debug(f"Loaded {count} content hashes into the dedup bloom filter")
+        return bloom
+
+    def might_contain(self, content_hash: str) -> bool:
+        """Check whether content may already be stored, without any I/O.
+
+        Returns True until the bloom filter has been loaded, so it is safe
+        to call from worker threads.
+        """
+        bloom = self._bloom
+        return bloom is None or content_hash in bloom
+
+    def lookup(self, content_hash: str) -> Optional[str]:
+        """Get the stored name for content, or None if it is not stored.
+
+        Args:
+            content_hash: Hex SHA-256 digest of the content
+
+        Returns:
+            Stored file name relative to the upload root
+        """
+        if content_hash not in self._get_bloom():
+            return None
+
+        from .models import StoredFile
+
+        return (
+            StoredFile.objects.filter(content_hash=content_hash)
+            .values_list("name", flat=True)
+            .first()
+        )
+
+    def record(self, content_hash: str, name: str, size: int) -> str:
+        """Record a newly stored file.
+
+        Args:
+            content_hash: Hex SHA-256 digest of the content
+            name: Stored file name relative to the upload root
+            size: File size in bytes
+
+        Returns:
+            The name the content is stored under: ``name``, or the name of an
+            existing file with the same content recorded concurrently
+        """
+        from .models import StoredFile
+
+        bloom = self._get_bloom()
+        try:
+            with transaction.atomic():
+                StoredFile.objects.create(
+                    content_hash=content_hash, name=name, size=size
+                )
+        except IntegrityError:
+            name = StoredFile.objects.values_list("name", flat=True).get(
+                content_hash=content_hash
+            )
+        bloom.add(content_hash)
+        return name
+
+    def forget(self, content_hash: str) -> None:
+        """Remove content from the index (its file no longer exists)."""
+        from .models import StoredFile
+
+        StoredFile.objects.filter(content_hash=content_hash).delete()
+
+    def reset(self) -> None:
+        """Drop the in-process bloom filter so it is reloaded on next use."""
+        with self._lock:
+            self._bloom = None
+
+
+content_index = ContentIndex()
@@ -0,0 +1,313 @@
+"""
+Responsive image derivatives for Django Vditor.
+
+Newly stored images are queued in the ``DerivativeTask`` table and resized
+to the configured widths in the background, either on a bounded worker pool
+or by the ``vditor_derivatives`` management command. Generated files are
+recorded in ``ImageDerivative`` so templates can build ``srcset``. The same
+queue runs deferred optimization of large images (see ``vditor.optimize``).
+"""
+
+import io
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Widths (in pixels) derivatives are generated at; empty disables them
+DERIVATIVE_WIDTHS = getattr(settings, "VDITOR_DERIVATIVE_WIDTHS", ())
+DERIVATIVE_FORMATS = getattr(settings, "VDITOR_DERIVATIVE_FORMATS", ("webp",))
+DERIVATIVE_QUALITY = getattr(settings, "VDITOR_DERIVATIVE_QUALITY", 80)
+
+# Background threads processing tasks; 0 leaves them to the management command
+DERIVATIVE_WORKERS = getattr(settings, "VDITOR_DERIVATIVE_WORKERS", 2)
+
+# Attempts before a task is marked as failed
+MAX_ATTEMPTS = 3
+
+# Tasks left running this long are assumed to belong to a dead worker
+STALE_TASK_TIMEOUT = timedelta(minutes=10)
+
+# Formats of stored images that can be resized
+RESIZABLE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+FORMAT_EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg"}
+
+_derivative_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _derivative_executor
+    if _derivative_executor is None:
+        with _executor_lock:
+            if _derivative_executor is None:
+                _derivative_executor = ThreadPoolExecutor(
+                    max_workers=DERIVATIVE_WORKERS,
+                    thread_name_prefix="vditor-derivatives",
+                )
+    return _derivative_executor
+
+
+def derivative_name(stored_name: str, width: int, image_format: str) -> str:
+    """Get the stored name of a derivative, next to its original.
+
+    Args:
+        stored_name: Stored name of the original image
+        width: Derivative width in pixels
+        image_format: Derivative format ("webp" or "jpeg")
+
+    Returns:
+        Stored name such as ``ab/cd/<hash>_640w.webp``
+    """
+    stem = posixpath.splitext(stored_name)[0]
+    return f"{stem}_{width}w{FORMAT_EXTENSIONS[image_format]}"
+
+
+def queue_derivatives(content_hash: str, stored_name: str):
+    """Queue a newly stored image for derivative generation.
+
+    Only creates the task row, so the upload response is not delayed. The
+    task is handed to the worker pool once the transaction commits.
+
+    Args:
+        content_hash: Hex SHA-256 digest of the image
+        stored_name: Stored name of the image
+
+    Returns:
+        The created DerivativeTask, or None if derivatives are disabled or the
+        image cannot be resized
+    """
+    if not DERIVATIVE_WIDTHS:
+        return None
+    if posixpath.splitext(stored_name)[1].lower() not in RESIZABLE_EXTENSIONS:
+        return None
+
+    from .models import DerivativeTask
+
+    return queue_task(content_hash, stored_name, DerivativeTask.KIND_DERIVATIVES)
+
+
+def queue_task(content_hash: str, stored_name: str, kind: str):
+    """Queue background processing of a stored image.
+
+    Args:
+        content_hash: Hex SHA-256 digest of the image
+        stored_name: Stored name of the image
+        kind: One of the ``DerivativeTask.KIND_*`` values
+
+    Returns:
+        The created DerivativeTask
+    """
+    from .models import DerivativeTask
+
+    task = DerivativeTask.objects.create(
+        content_hash=content_hash, name=stored_name, kind=kind
+    )
+    if DERIVATIVE_WORKERS > 0:
+        transaction.on_commit(lambda: _get_executor().submit(_run_task, task.pk))
+    return task
+
+
+def _run_task(task_id: int) -> None:
+    """Process a task on a worker thread.
+
+    A failed task put back to pending is submitted again, until it succeeds
+    or is marked as failed after ``MAX_ATTEMPTS``.
+    """
+    from .models import DerivativeTask
+
+    retry = False
+    try:
+        if not process_task(task_id):
+            retry = DerivativeTask.objects.filter(
+                pk=task_id, status=DerivativeTask.STATUS_PENDING
+            ).exists()
+    except Exception as e:
+        logger.error(f"Derivative task {task_id} crashed: {e}")
+    finally:
+        # Worker threads are not managed by Django's request cycle
+        connections.close_all()
+    if retry:
+        _get_executor().submit(_run_task, task_id)
+
+
+def _claim_task(task_id: int):
+    """Mark a task as running, unless another worker claimed it first."""
+    from .models import DerivativeTask
+
+    stale_before = timezone.now() - STALE_TASK_TIMEOUT
+    claimable = Q(status=DerivativeTask.STATUS_PENDING) | Q(
+        status=DerivativeTask.STATUS_RUNNING, updated_at__lt=stale_before
+    )
+    claimed = (
+        DerivativeTask.objects.filter(claimable, pk=task_id).update(
+            status=DerivativeTask.STATUS_RUNNING,
+            attempts=F("attempts") + 1,
+            updated_at=timezone.now(),
+        )
+        == 1
+    )
+    return DerivativeTask.objects.get(pk=task_id) if claimed else None
+
+
+def process_task(task_id: int) -> bool:
+    """Process a queued image: generate its derivatives or optimize it.
+
+    Failed tasks are put back to pending and retried up to ``MAX_ATTEMPTS``
+    times: resubmitted by the worker pool, or picked up by the next
+    ``vditor_derivatives`` run.
+
+    Args:
+        task_id: Primary key of the DerivativeTask
+
+    Returns:
+        True if the task succeeded
+    """
+    from .models import DerivativeTask
+
+    task = _claim_task(task_id)
+    if task is None:
+        return False
+
+    try:
+        if task.kind == DerivativeTask.KIND_OPTIMIZE:
+            from .optimize import optimize_stored_file
+
+            optimize_stored_file(task.content_hash, task.name)
+        else:
+            generate_derivatives(task.content_hash, task.name)
+    except Exception as e:
+        failed = task.attempts >= MAX_ATTEMPTS
+        logger.warning(
+            f"Failed to process {task.kind} task for {task.name} "
+            f"(attempt {task.attempts}): {e}"
+        )
+        task.status = (
+            DerivativeTask.STATUS_FAILED if failed else DerivativeTask.STATUS_PENDING
+        )
+        task.error = str(e)
+        task.save(update_fields=["status", "error", "updated_at"])
+        return False
+
+    task.status = DerivativeTask.STATUS_DONE
+    task.error = ""
+    task.save(update_fields=["status", "error", "updated_at"])
+    return True
+
+
+def generate_derivatives(content_hash: str, stored_name: str) -> list:
+    """Resize a stored image to every configured width narrower than it.
+
+    Args:
+        content_hash: Hex SHA-256 digest of the image
+        stored_name: Stored name of the image
+
+    Returns:
+        List of ImageDerivative records, narrowest first
+
+    Raises:
+        ImportError: If Pillow is not installed
+    """
+    from PIL import Image
+
+    from .models import ImageDerivative
+    from .views import _open_stored_file, _write_stored_file
+
+    with _open_stored_file(stored_name) as f:
+        image = Image.open(f)
+        image.load()
+
+    derivatives = []
+    for width in sorted(set(DERIVATIVE_WIDTHS)):
+        if width >= image.width:
+            # Never upscale; the original serves the widest candidate
+            continue
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.Resampling.LANCZOS)
+
+        for image_format in DERIVATIVE_FORMATS:
+            if image_format == "jpeg" and resized.mode != "RGB":
+                converted = resized.convert("RGB")
+            elif resized.mode not in ("RGB", "RGBA"):
+                converted = resized.convert("RGBA")
+            else:
+                converted = resized
+            buffer = io.BytesIO()
+            converted.save(buffer, image_format.upper(), quality=DERIVATIVE_QUALITY)
+
+            name = derivative_name(stored_name, width, image_format)
+            _write_stored_file(name, buffer.getvalue())
+            derivative, _created = ImageDerivative.objects.update_or_create(
+                content_hash=content_hash,
+                width=width,
+                format=image_format,
+                defaults={"name": name, "size": buffer.tell()},
+            )
+            derivatives.append(derivative)
+
+    logger.info(f"Generated {len(derivatives)} derivatives of {stored_name}")
+    return derivatives
+
+
+def get_srcset(content_hash: str, image_format: str = "webp") -> str:
+    """Build a ``srcset`` attribute value from an image's derivatives.
+
+    Args:
+        content_hash: Hex SHA-256 digest of the original image
+        image_format: Derivative format to list
+
+    Returns:
+        Comma-separated "<url> <width>w" candidates, or "" if there are none
+    """
+    from .models import ImageDerivative
+    from .views import _stored_url
+
+    derivatives = ImageDerivative.objects.filter(
+        content_hash=content_hash, format=image_format
+    ).order_by("width")
+    return ", ".join(
+        f"{_stored_url(derivative.name)} {derivative.width}w"
+        for derivative in derivatives
+    )
+
+
+def drain_tasks(limit: Optional[int] = None) -> tuple[int, int]:
+    """Process queued tasks in the current thread.
+
+    Args:
+        limit: Maximum number of tasks to process
+
+    Returns:
+        tuple: (processed, failed)
+    """
+    from .models import DerivativeTask
+
+    stale_before = timezone.now() - STALE_TASK_TIMEOUT
+    task_ids = (
+        DerivativeTask.objects.filter(
+            Q(status=DerivativeTask.STATUS_PENDING)
+            | Q(status=DerivativeTask.STATUS_RUNNING, updated_at__lt=stale_before)
+        )
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+    if limit is not None:
+        task_ids = task_ids[:limit]
+
+    processed = failed = 0
+    for task_id in list(task_ids):
+        if process_task(task_id):
+            processed += 1
+        else:
+            failed += 1
+    return processed, failed
@@ -0,0 +1,146 @@
+"""
+Idempotency keys for the Django Vditor upload endpoints.
+
+A client that sends an ``Idempotency-Key`` header can retry an upload
+safely: the final response of the first attempt is kept in the Django cache
+and returned for every retry with the same key, without reading, hashing or
+validating the body again. Keys are scoped to the client (see
+``vditor.ratelimit.get_client_key``) and to the endpoint.
+"""
+
+import hashlib
+import logging
+from functools import wraps
+from inspect import iscoroutinefunction
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.utils.translation import gettext_lazy as _
+
+from .ratelimit import get_client_key
+
+logger = logging.getLogger(__name__)
+
+# Seconds responses are kept for retries; None disables idempotency keys
+IDEMPOTENCY_TTL = getattr(settings, "VDITOR_IDEMPOTENCY_TTL", 24 * 60 * 60)
+IDEMPOTENCY_CACHE = getattr(settings, "VDITOR_IDEMPOTENCY_CACHE", "default")
+
+MAX_KEY_LENGTH = 255
+
+# Seconds a first attempt may take before a retry is processed again
+IN_PROGRESS_TIMEOUT = 60
+
+# Statuses worth retrying: the response is not kept for them
+TRANSIENT_STATUSES = {408, 409, 429}
+
+
+def _cache_key(request: HttpRequest, idempotency_key: str) -> str:
+    scope = f"{get_client_key(request)}\0{request.path}\0{idempotency_key}"
+    return "vditor_idempotency_" + hashlib.sha256(scope.encode()).hexdigest()
+
+
+def _error_response(message: str, status: int) -> JsonResponse:
+    return JsonResponse({"msg": message, "code": 1}, status=status)
+
+
+def _begin(request: HttpRequest) -> tuple[Optional[str], Optional[HttpResponse]]:
+    """Look up the idempotency key of a request.
+
+    Returns:
+        tuple: (cache_key, response), where response is the stored (or an
+        error) response to return instead of running the view, and
+        cache_key is where to store the response of the view otherwise
+    """
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key is None or IDEMPOTENCY_TTL is None:
+        return None, None
+    if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+        return None, _error_response(_("Invalid Idempotency-Key header."), 400)
+
+    cache = caches[IDEMPOTENCY_CACHE]
+    key = _cache_key(request, idempotency_key)
+    try:
+        stored = cache.get(key)
+        if stored is None:
+            # Claim the key so concurrent retries do not upload in parallel
+            if cache.add(key, "in-progress", IN_PROGRESS_TIMEOUT):
+                return key, None
+            stored = cache.get(key)
+    except Exception as e:
+        # Never block uploads because the cache is unavailable
+        logger.warning(f"Failed to look up idempotency key: {e}")
+        return None, None
+
+    if stored is None or stored == "in-progress":
+        response = _error_response(
+            _("A request with this Idempotency-Key is in progress."), 409
+        )
+        response["Retry-After"] = "1"
+        return None, response
+
+    status, content_type, content = stored
+    response = HttpResponse(content, status=status, content_type=content_type)
+    response["Idempotent-Replayed"] = "true"
+    return None, response
+
+
+def _finish(key: Optional[str], response: Optional[HttpResponse]) -> None:
+    """Store the response of a first attempt, or release its key."""
+    if key is None:
+        return
+    cache = caches[IDEMPOTENCY_CACHE]
+    try:
+        if (
+            response is None
+            or response.status_code >= 500
+            or response.status_code in TRANSIENT_STATUSES
+            or response.streaming
+        ):
+            cache.delete(key)
+            return
+        cache.set(
+            key,
+            (response.status_code, response["Content-Type"], response.content),
+            IDEMPOTENCY_TTL,
+        )
+    except Exception as e:
+        logger.warning(f"Failed to store idempotent response: {e}")
+
+
+def idempotent_upload(view):
+    """Decorate an upload view to honour the ``Idempotency-Key`` header.
+
+    Works with sync and async views.
+    """
+    if iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            key, stored = await sync_to_async(_begin)(request)
+            if stored is not None:
+                return stored
+            response = None
+            try:
+                response = await view(request, *args, **kwargs)
+            finally:
+                await sync_to_async(_finish)(key, response)
+            return response
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key, stored = _begin(request)
+        if stored is not None:
+            return stored
+        response = None
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _finish(key, response)
+        return response
+
+    return wrapper
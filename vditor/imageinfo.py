@@ -0,0 +1,238 @@
+"""
+Image header parsing for Django Vditor.
+
+Reads the pixel dimensions of PNG, JPEG, GIF and WebP images from their
+headers, without decoding any image data, so oversized images
+(decompression bombs) can be rejected while they are still being uploaded.
+"""
+
+import struct
+from typing import Optional
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+
+# Bytes read from a file at a time to find its dimensions
+PROBE_SIZE = 64 * 1024
+
+# Bytes needed to recognize a format, and to read non-JPEG dimensions
+SIGNATURE_SIZE = 12
+HEADER_SIZE = 32
+
+# JPEG segments walked looking for the frame header; real files have a few
+# dozen, so more is treated as unreadable rather than walked byte by byte
+JPEG_MAX_SEGMENTS = 1024
+
+# JPEG start-of-frame markers (SOF0-SOF15 without DHT, JPG and DAC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7}
+
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+
+# Maximum width * height of uploaded images, checked from the file header
+# before anything decodes the image; None disables the check
+MAX_IMAGE_PIXELS = getattr(settings, "VDITOR_MAX_IMAGE_PIXELS", 100_000_000)
+
+
+def _png_dimensions(header: bytes) -> Optional[tuple[int, int]]:
+    if len(header) < 24 or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def _gif_dimensions(header: bytes) -> Optional[tuple[int, int]]:
+    if len(header) < 10:
+        return None
+    return struct.unpack("<HH", header[6:10])
+
+
+def _webp_dimensions(header: bytes) -> Optional[tuple[int, int]]:
+    chunk = header[12:16]
+    if chunk == b"VP8 " and len(header) >= 30:
+        # Lossy: key frame header followed by 14-bit dimensions
+        if header[23:26] != b"\x9d\x01\x2a":
+            return None
+        width, height = struct.unpack("<HH", header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(header) >= 25:
+        # Lossless: 14-bit width and height minus one, packed after 0x2f
+        if header[20] != 0x2F:
+            return None
+        (bits,) = struct.unpack("<I", header[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(header) >= 30:
+        # Extended: 24-bit canvas width and height minus one
+        width = int.from_bytes(header[24:27], "little") + 1
+        height = int.from_bytes(header[27:30], "little") + 1
+        return width, height
+    return None
+
+
+def _detect_format(header: bytes) -> Optional[str]:
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+_HEADER_PARSERS = {
+    "png": _png_dimensions,
+    "gif": _gif_dimensions,
+    "webp": _webp_dimensions,
+}
+
+
+class ImageProbe:
+    """Read the pixel dimensions of an image from its content, chunk by chunk.
+
+    PNG, GIF and WebP dimensions are in the first ``HEADER_SIZE`` bytes.
+    JPEG segments before the frame header are walked by their length
+    fields and skipped without being buffered, however far into the file
+    the frame header is.
+
+    Attributes:
+        format: "png", "jpeg", "gif" or "webp" once recognized, else None
+        dimensions: (width, height), or None until read or if unreadable
+        done: Whether no more content is needed
+    """
+
+    def __init__(self) -> None:
+        self.format: Optional[str] = None
+        self.dimensions: Optional[tuple[int, int]] = None
+        self.done = False
+        self._header = b""
+        # JPEG: start of a segment whose marker and length are incomplete,
+        # bytes of the current segment still to skip and segments walked
+        self._pending = b""
+        self._skip = 0
+        self._segments = 0
+
+    def feed(self, chunk: bytes) -> bool:
+        """Read the next chunk of content.
+
+        Returns:
+            True once the dimensions are read or cannot be read
+        """
+        if self.done:
+            return True
+        if self.format == "jpeg":
+            self._walk_jpeg(chunk)
+            return self.done
+
+        used = HEADER_SIZE - len(self._header)
+        self._header += chunk[:used]
+        if self.format is None:
+            if len(self._header) < SIGNATURE_SIZE:
+                return False
+            self.format = _detect_format(self._header)
+            if self.format is None:
+                self.done = True
+                return True
+            if self.format == "jpeg":
+                self._walk_jpeg(self._header[2:] + chunk[used:])
+                return self.done
+        if len(self._header) >= HEADER_SIZE:
+            self.close()
+        return self.done
+
+    def close(self) -> None:
+        """Finish reading at the end of the content."""
+        if self.done:
+            return
+        if self.format is None:
+            self.format = _detect_format(self._header)
+        parser = _HEADER_PARSERS.get(self.format)
+        if parser is not None:
+            self.dimensions = parser(self._header)
+        self.done = True
+
+    def _walk_jpeg(self, chunk: bytes) -> None:
+        if self._skip >= len(chunk):
+            self._skip -= len(chunk)
+            return
+        data = self._pending + chunk[self._skip :]
+        self._pending = b""
+        self._skip = 0
+        pos = 0
+        while len(data) - pos >= 2:
+            if data[pos] != 0xFF:
+                self.done = True
+                return
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                # Fill byte
+                pos += 1
+                continue
+            if marker in JPEG_STANDALONE_MARKERS:
+                pos += 2
+                continue
+            if marker in (JPEG_SOS, JPEG_EOI) or self._segments >= JPEG_MAX_SEGMENTS:
+                # Image data or end of image before any frame header
+                self.done = True
+                return
+            if len(data) - pos < 9:
+                break
+            (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", data[pos + 5 : pos + 9])
+                # A zero height is defined later in the scan (DNL marker)
+                self.dimensions = (width, height) if height else None
+                self.done = True
+                return
+            if length < 2:
+                self.done = True
+                return
+            self._segments += 1
+            pos += 2 + length
+        if pos > len(data):
+            self._skip = pos - len(data)
+        else:
+            self._pending = data[pos:]
+
+
+def probe_image_dimensions(header: bytes) -> Optional[tuple[int, int]]:
+    """Get the pixel dimensions of an image from the start of its file.
+
+    Args:
+        header: First bytes of the file
+
+    Returns:
+        tuple: (width, height), or None if the format is not recognized or
+        the dimensions are not within ``header``
+    """
+    probe = ImageProbe()
+    probe.feed(header)
+    probe.close()
+    return probe.dimensions
+
+
+def validate_image_dimensions(probe: ImageProbe) -> tuple[bool, str]:
+    """Validate the dimensions read by a finished ``ImageProbe``.
+
+    Content that is not a recognized image format passes; a recognized
+    image whose dimensions could not be read is rejected.
+
+    Returns:
+        tuple: (is_valid, error_message)
+    """
+    if probe.format is None:
+        return True, ""
+    if probe.dimensions is None:
+        return False, _("Image dimensions could not be read.")
+    width, height = probe.dimensions
+    if not width or not height:
+        return False, _("Image has invalid dimensions.")
+    if MAX_IMAGE_PIXELS and width * height > MAX_IMAGE_PIXELS:
+        return False, _(
+            f"Image dimensions {width}x{height} exceed the maximum allowed "
+            f"{MAX_IMAGE_PIXELS} pixels."
+        )
+    return True, ""
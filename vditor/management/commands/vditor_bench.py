@@ -0,0 +1,162 @@
+"""
+Django management command running the Vditor benchmarks.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vditor import bench
+
+
+def _format_time(seconds: float) -> str:
+    if seconds >= 1:
+        return f"{seconds:.3f}s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.3f}ms"
+    return f"{seconds * 1e6:.3f}us"
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark uploads, widget rendering, config loading and validation, "
+        "optionally against a saved baseline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--filter",
+            action="append",
+            default=[],
+            help="Only run benchmarks whose name contains this text (repeatable)",
+        )
+        parser.add_argument(
+            "--list",
+            action="store_true",
+            help="List the benchmarks without running them",
+        )
+        parser.add_argument(
+            "--quick",
+            action="store_true",
+            help="Time fewer rounds, e.g. for CI (1 warm-up, 3 rounds, 0.1s)",
+        )
+        parser.add_argument(
+            "--warmup",
+            type=int,
+            default=2,
+            help="Warm-up rounds discarded before timing (default: 2)",
+        )
+        parser.add_argument(
+            "--min-rounds",
+            type=int,
+            default=5,
+            help="Rounds timed at least (default: 5)",
+        )
+        parser.add_argument(
+            "--min-time",
+            type=float,
+            default=0.5,
+            help="Seconds each benchmark is timed at least (default: 0.5)",
+        )
+        parser.add_argument(
+            "--save",
+            metavar="PATH",
+            help="Save the results as a JSON baseline",
+        )
+        parser.add_argument(
+            "--compare",
+            metavar="PATH",
+            help="Compare the results with a JSON baseline",
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=0.2,
+            help="Slowdown of a median that fails --compare (default: 0.2, 20%%)",
+        )
+
+    def handle(self, *args, **options):
+        benchmarks = [
+            benchmark
+            for benchmark in bench.get_benchmarks()
+            if not options["filter"]
+            or any(text in benchmark.name for text in options["filter"])
+        ]
+        if not benchmarks:
+            raise CommandError("No benchmark matches --filter")
+        if options["list"]:
+            for benchmark in benchmarks:
+                self.stdout.write(benchmark.name)
+            return
+
+        baseline = None
+        if options["compare"]:
+            try:
+                baseline = bench.load_baseline(options["compare"])
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read baseline: {e}")
+
+        if options["quick"]:
+            warmup, min_rounds, min_time = 1, 3, 0.1
+        else:
+            warmup = options["warmup"]
+            min_rounds = options["min_rounds"]
+            min_time = options["min_time"]
+
+        results = []
+        self.stdout.write(
+            f"{'Benchmark':<24} {'Median':>11} {'IQR':>11} "
+            f"{'Rounds':>7} {'Throughput':>12}"
+        )
+        with bench.bench_environment():
+            for benchmark in benchmarks:
+                try:
+                    result = bench.run_benchmark(
+                        benchmark, warmup, max(1, min_rounds), min_time
+                    )
+                except bench.BenchmarkError as e:
+                    raise CommandError(f"{benchmark.name}: {e}")
+                results.append(result)
+                throughput = (
+                    f"{result.throughput / (1024 * 1024):.1f}MB/s"
+                    if result.throughput
+                    else ""
+                )
+                self.stdout.write(
+                    f"{result.name:<24} {_format_time(result.median):>11} "
+                    f"{_format_time(result.iqr):>11} {result.rounds:>7} "
+                    f"{throughput:>12}"
+                )
+
+        if options["save"]:
+            bench.save_baseline(results, options["save"])
+            self.stdout.write(f"Saved baseline to {options['save']}")
+
+        if baseline is not None:
+            self._compare(results, baseline, options["threshold"])
+
+    def _compare(self, results, baseline, threshold):
+        if baseline.get("environment") != bench.environment_info():
+            self.stdout.write(
+                self.style.WARNING(
+                    "Baseline was recorded in a different environment; "
+                    "differences may not be regressions"
+                )
+            )
+        comparisons = bench.compare_results(results, baseline, threshold)
+        self.stdout.write(f"\nCompared with {len(comparisons)} baseline results:")
+        for comparison in comparisons:
+            line = (
+                f"{comparison.name:<24} {_format_time(comparison.baseline):>11} -> "
+                f"{_format_time(comparison.current):>11} "
+                f"({comparison.change:+.1%})"
+            )
+            if comparison.regressed:
+                line = self.style.ERROR(line)
+            self.stdout.write(line)
+
+        regressions = [c.name for c in comparisons if c.regressed]
+        if regressions:
+            raise CommandError(
+                f"{len(regressions)} benchmarks regressed by more than "
+                f"{threshold:.0%}: {', '.join(regressions)}"
+            )
+        self.stdout.write(self.style.SUCCESS("No regressions"))
@@ -13,9 +13,49 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
             "action",
-            choices=["clear", "warm", "info", "metrics"],
+            choices=["clear", "warm", "info", "metrics", "profile"],
             help="Action to perform on caches or view metrics",
         )
+        profile = parser.add_argument_group("profile")
+        profile.add_argument(
+            "--enable",
+            type=int,
+            metavar="N",
+            help="Profile one in N uploads and widget renders on every worker",
+        )
+        profile.add_argument(
+            "--duration",
+            type=int,
+            default=600,
+            help="Seconds profiling stays enabled (default: 600)",
+        )
+        profile.add_argument(
+            "--disable",
+            action="store_true",
+            help="Go back to VDITOR_PROFILE_SAMPLE_RATE on every worker",
+        )
+        profile.add_argument(
+            "--clear",
+            action="store_true",
+            help="Delete the profiles written so far",
+        )
+        profile.add_argument(
+            "--name",
+            choices=["upload", "render"],
+            help="Only report profiles of uploads or widget renders",
+        )
+        profile.add_argument(
+            "--top",
+            type=int,
+            default=25,
+            help="Number of functions in the report (default: 25)",
+        )
+        profile.add_argument(
+            "--sort",
+            choices=["cumulative", "tottime", "ncalls"],
+            default="cumulative",
+            help="Order of the functions in the report (default: cumulative)",
+        )
 
     def handle(self, *args, **options):
         action = options["action"]
@@ -65,46 +105,94 @@ class Command(BaseCommand):
             except Exception as e:
                 self.stdout.write(f"Error getting cache info: {e}")
 
+        elif action == "profile":
+            self._profile(options)
+
         elif action == "metrics":
             self.stdout.write("Vditor Performance Metrics:")
             self.stdout.write("==========================")
 
             try:
-                from vditor.views import get_upload_metrics
-                
+                from vditor.metrics import METRICS_CACHE, get_upload_metrics
+
                 metrics = get_upload_metrics()
-                
+                if METRICS_CACHE is None:
+                    self.stdout.write(
+                        "\nUpload metrics are kept per process "
+                        "(VDITOR_METRICS_CACHE = None); showing this process only."
+                    )
+
                 if not metrics:
                     self.stdout.write("No upload metrics available yet.")
                     return
-                
+
                 for metric_type, data in metrics.items():
                     self.stdout.write(f"\n{metric_type.upper()} Uploads:")
                     self.stdout.write(f"  Count: {data['count']}")
-                    if data['count'] > 0:
-                        self.stdout.write(f"  Average Time: {data['avg_time']:.3f}s")
-                        self.stdout.write(
-                            f"  Total Size: {data['total_size'] / (1024*1024):.2f}MB"
-                        )
-                        self.stdout.write(
-                            f"  Average Size: {data['avg_size'] / 1024:.2f}KB"
-                        )
-                    else:
-                        self.stdout.write("  No uploads recorded")
-                
+                    self.stdout.write(f"  Average Time: {data['avg_time']:.3f}s")
+                    self.stdout.write(
+                        f"  Time p50/p95/p99: {data['time_p50']:.3f}s / "
+                        f"{data['time_p95']:.3f}s / {data['time_p99']:.3f}s"
+                    )
+                    self.stdout.write(
+                        f"  Total Size: {data['total_size'] / (1024*1024):.2f}MB"
+                    )
+                    self.stdout.write(
+                        f"  Average Size: {data['avg_size'] / 1024:.2f}KB"
+                    )
+                    self.stdout.write(
+                        f"  Size p50/p95/p99: {data['size_p50'] / 1024:.2f}KB / "
+                        f"{data['size_p95'] / 1024:.2f}KB / "
+                        f"{data['size_p99'] / 1024:.2f}KB"
+                    )
+
                 # Calculate overall stats
-                total_uploads = sum(data['count'] for data in metrics.values())
-                if total_uploads > 0:
-                    self.stdout.write(f"\nOverall Statistics:")
-                    self.stdout.write(f"  Total Uploads: {total_uploads}")
-                    
-                    total_time = sum(data['total_time'] for data in metrics.values())
-                    avg_time = total_time / total_uploads
-                    self.stdout.write(f"  Average Processing Time: {avg_time:.3f}s")
-                    
-                    total_size = sum(data['total_size'] for data in metrics.values())
-                    avg_size = total_size / total_uploads
-                    self.stdout.write(f"  Average File Size: {avg_size / 1024:.2f}KB")
-                    
+                total_uploads = sum(data["count"] for data in metrics.values())
+                self.stdout.write("\nOverall Statistics:")
+                self.stdout.write(f"  Total Uploads: {total_uploads}")
+
+                total_time = sum(data["total_time"] for data in metrics.values())
+                avg_time = total_time / total_uploads
+                self.stdout.write(f"  Average Processing Time: {avg_time:.3f}s")
+
+                total_size = sum(data["total_size"] for data in metrics.values())
+                avg_size = total_size / total_uploads
+                self.stdout.write(f"  Average File Size: {avg_size / 1024:.2f}KB")
+
             except Exception as e:
                 self.stdout.write(f"Error getting metrics: {e}")
+
+    def _profile(self, options):
+        from vditor import profiling
+
+        if options["enable"] is not None:
+            if options["enable"] < 1:
+                raise CommandError("--enable must be at least 1")
+            profiling.set_sample_rate(options["enable"], options["duration"])
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Profiling 1 in {options['enable']} calls for "
+                    f"{options['duration']}s; profiles are written to "
+                    f"{profiling.PROFILE_DIR}"
+                )
+            )
+            return
+        if options["disable"]:
+            profiling.set_sample_rate(None)
+            self.stdout.write(self.style.SUCCESS("Profiling override removed"))
+            return
+        if options["clear"]:
+            profiles = profiling.list_profiles()
+            for path in profiles:
+                path.unlink(missing_ok=True)
+            self.stdout.write(self.style.SUCCESS(f"Deleted {len(profiles)} profiles"))
+            return
+
+        profiles = profiling.list_profiles(options["name"])
+        self.stdout.write(f"Sample rate: {profiling.get_sample_rate() or 'disabled'}")
+        stats = profiling.merge_profiles(profiles, stream=self.stdout)
+        if stats is None:
+            self.stdout.write(f"No profiles in {profiling.PROFILE_DIR}")
+            return
+        self.stdout.write(f"Merged {len(profiles)} profiles:")
+        stats.strip_dirs().sort_stats(options["sort"]).print_stats(options["top"])
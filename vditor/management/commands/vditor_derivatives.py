@@ -0,0 +1,47 @@
+"""
+Django management command processing queued image derivative and optimize tasks.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vditor import derivatives, optimize
+from vditor.models import DerivativeTask
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate resized derivatives of uploaded images and optimize large "
+        "uploads queued for processing. Failed tasks are retried by the next "
+        "run, up to the attempt limit"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            help="Maximum number of tasks to process",
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="Queue tasks that failed every attempt again before processing",
+        )
+
+    def handle(self, *args, **options):
+        if not (derivatives.DERIVATIVE_WIDTHS or optimize.OPTIMIZE_IMAGES):
+            raise CommandError(
+                "Neither VDITOR_DERIVATIVE_WIDTHS nor VDITOR_OPTIMIZE_IMAGES is "
+                "configured"
+            )
+
+        if options["retry_failed"]:
+            retried = DerivativeTask.objects.filter(
+                status=DerivativeTask.STATUS_FAILED
+            ).update(status=DerivativeTask.STATUS_PENDING, attempts=0)
+            self.stdout.write(f"Queued {retried} failed tasks again.")
+
+        processed, failed = derivatives.drain_tasks(options["limit"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Processed {processed} image tasks ({failed} failed)")
+        )
@@ -0,0 +1,265 @@
+"""
+Django management command moving flat uploads into the sharded layout.
+"""
+
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from vditor import views
+from vditor.dedup import content_index
+from vditor.fields import VditorTextField
+from vditor.derivatives import derivative_name
+from vditor.models import ImageDerivative, StoredFile
+
+# Names written by the flat layout: "<hash16>_<name>.<ext>"
+FLAT_NAME_RE = re.compile(r"[0-9a-f]{16}_[^/\s]+")
+
+
+def _hash_file(path: Path) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _link_into_layout(
+    upload_path: Path, name: str, content_hash: Optional[str], layout: str
+) -> tuple[str, str, str]:
+    """Link a flat upload to its sharded name, keeping the original.
+
+    Returns:
+        tuple: (old_name, new_name, content_hash)
+    """
+    source = upload_path / name
+    if content_hash is None:
+        content_hash = _hash_file(source)
+    new_name = views._stored_name(content_hash, "", Path(name).suffix, layout)
+    target = upload_path / new_name
+    target.parent.mkdir(parents=True, exist_ok=True, mode=0o755)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        # Same content already moved, e.g. uploaded earlier under another name
+        pass
+    return name, new_name, content_hash
+
+
+class Command(BaseCommand):
+    help = (
+        "Move uploads stored flat in MEDIA_ROOT into the sharded layout and "
+        "rewrite their URLs in VditorTextField content"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=views.UPLOAD_WORKERS,
+            help="Number of files hashed and linked concurrently",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of rows rewritten per database update",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report what would be migrated without changing anything",
+        )
+
+    def handle(self, *args, **options):
+        layout = views.UPLOAD_LAYOUT
+        if layout != "sharded":
+            raise CommandError(
+                f"VDITOR_UPLOAD_LAYOUT is '{layout}'; set it to 'sharded' before "
+                "migrating so new uploads use the same layout"
+            )
+
+        if views._get_upload_storage() is not None:
+            raise CommandError(
+                "Uploads are stored through VDITOR_STORAGE; only uploads written "
+                "to MEDIA_ROOT can be migrated"
+            )
+
+        upload_path = Path(settings.MEDIA_ROOT)
+        if not upload_path.is_dir():
+            raise CommandError(f"MEDIA_ROOT '{upload_path}' does not exist")
+
+        # Derivatives follow their original instead of being migrated as content
+        derivative_names = set(ImageDerivative.objects.values_list("name", flat=True))
+        flat_names = sorted(
+            entry.name
+            for entry in os.scandir(upload_path)
+            if entry.is_file()
+            and FLAT_NAME_RE.fullmatch(entry.name)
+            and entry.name not in derivative_names
+        )
+        if not flat_names:
+            self.stdout.write("No flat uploads to migrate.")
+            return
+
+        self.stdout.write(f"Found {len(flat_names)} flat uploads.")
+        if options["dry_run"]:
+            return
+
+        # Files are linked first, then the database is updated, and only then
+        # are the flat names removed, so an interrupted run can be resumed
+        known_hashes = dict(
+            StoredFile.objects.filter(name__in=flat_names).values_list(
+                "name", "content_hash"
+            )
+        )
+        with ThreadPoolExecutor(max_workers=max(1, options["workers"])) as executor:
+            moved = list(
+                executor.map(
+                    lambda name: _link_into_layout(
+                        upload_path, name, known_hashes.get(name), layout
+                    ),
+                    flat_names,
+                )
+            )
+
+        renames = {old_name: new_name for old_name, new_name, _hash in moved}
+        self._update_index(moved, upload_path, options["batch_size"])
+        old_derivatives = self._move_derivatives(
+            moved, upload_path, options["batch_size"]
+        )
+        rows = self._rewrite_content(renames, options["batch_size"])
+
+        for old_name in flat_names + old_derivatives:
+            (upload_path / old_name).unlink(missing_ok=True)
+        content_index.reset()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Migrated {len(flat_names)} uploads and rewrote {rows} rows"
+            )
+        )
+
+    def _update_index(self, moved, upload_path: Path, batch_size: int) -> None:
+        new_names = {}
+        for _old_name, new_name, content_hash in moved:
+            new_names[content_hash] = new_name
+
+        with transaction.atomic():
+            existing = list(StoredFile.objects.filter(content_hash__in=new_names))
+            for stored in existing:
+                stored.name = new_names[stored.content_hash]
+            StoredFile.objects.bulk_update(existing, ["name"], batch_size=batch_size)
+
+            indexed = {stored.content_hash for stored in existing}
+            StoredFile.objects.bulk_create(
+                [
+                    StoredFile(
+                        content_hash=content_hash,
+                        name=name,
+                        size=(upload_path / name).stat().st_size,
+                    )
+                    for content_hash, name in new_names.items()
+                    if content_hash not in indexed
+                ],
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+
+    def _move_derivatives(self, moved, upload_path: Path, batch_size: int):
+        """Link derivatives of migrated uploads next to their new name.
+
+        Returns:
+            Old derivative names, to be removed once the migration completes
+        """
+        new_names = {content_hash: new_name for _old, new_name, content_hash in moved}
+        derivatives = list(
+            ImageDerivative.objects.filter(content_hash__in=new_names).exclude(
+                name__contains="/"
+            )
+        )
+        old_names = []
+        for derivative in derivatives:
+            new_name = derivative_name(
+                new_names[derivative.content_hash], derivative.width, derivative.format
+            )
+            try:
+                os.link(upload_path / derivative.name, upload_path / new_name)
+            except FileNotFoundError:
+                # Regenerated by the derivative worker on its next run
+                continue
+            except FileExistsError:
+                pass
+            old_names.append(derivative.name)
+            derivative.name = new_name
+        ImageDerivative.objects.bulk_update(
+            derivatives, ["name"], batch_size=batch_size
+        )
+        return old_names
+
+    def _rewrite_content(self, renames: dict[str, str], batch_size: int) -> int:
+        """Replace flat upload URLs in every VditorTextField, in batches.
+
+        Returns:
+            Number of rows updated
+        """
+        media_url = settings.MEDIA_URL
+        url_re = re.compile(re.escape(media_url) + r"([0-9a-f]{16}_[^\s\"'()<>]+)")
+
+        def replace(match: re.Match) -> str:
+            new_name = renames.get(match.group(1))
+            if new_name is None:
+                return match.group(0)
+            return os.path.join(media_url, new_name)
+
+        updated = 0
+        for model in apps.get_models():
+            fields = [
+                field.name
+                for field in model._meta.concrete_fields
+                if isinstance(field, VditorTextField)
+            ]
+            if not fields:
+                continue
+
+            # Only fetch rows that can reference an upload
+            contains_url = Q()
+            for field in fields:
+                contains_url |= Q(**{f"{field}__contains": media_url})
+            queryset = model._default_manager.filter(contains_url).only(
+                model._meta.pk.name, *fields
+            )
+
+            pending = []
+            for obj in queryset.order_by("pk").iterator(chunk_size=batch_size):
+                changed = False
+                for field in fields:
+                    value = getattr(obj, field)
+                    if not value or media_url not in value:
+                        continue
+                    new_value = url_re.sub(replace, value)
+                    if new_value != value:
+                        setattr(obj, field, new_value)
+                        changed = True
+                if changed:
+                    pending.append(obj)
+                if len(pending) >= batch_size:
+                    model._default_manager.bulk_update(pending, fields)
+                    updated += len(pending)
+                    pending = []
+            if pending:
+                model._default_manager.bulk_update(pending, fields)
+                updated += len(pending)
+
+            self.stdout.write(f"Rewrote upload URLs in {model._meta.label}")
+
+        return updated
@@ -0,0 +1,115 @@
+"""
+Django management command optimizing images already stored in MEDIA_ROOT.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from vditor import views
+from vditor.dedup import content_index
+from vditor.models import ImageDerivative, StoredFile
+from vditor.optimize import optimize_image
+
+OPTIMIZABLE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def _optimize_file(
+    upload_path: Path, name: str, dry_run: bool
+) -> tuple[int, int, Optional[str]]:
+    """Optimize a single stored file.
+
+    Returns:
+        tuple: (new_size, bytes_saved, new_content_hash); the hash is None
+        when the file was not rewritten
+    """
+    with open(upload_path / name, "rb") as f:
+        data = f.read()
+    optimized = optimize_image(data)
+    saved = len(data) - len(optimized)
+    if not saved or dry_run:
+        return len(optimized), saved, None
+    views._write_stored_file(name, optimized)
+    return len(optimized), saved, hashlib.sha256(optimized).hexdigest()
+
+
+class Command(BaseCommand):
+    help = (
+        "Strip metadata from and losslessly recompress stored uploads and "
+        "their derivatives in MEDIA_ROOT"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=views.UPLOAD_WORKERS,
+            help="Number of files optimized concurrently",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report the bytes that would be saved without changing files",
+        )
+
+    def handle(self, *args, **options):
+        if views._get_upload_storage() is not None:
+            raise CommandError(
+                "Uploads are stored through VDITOR_STORAGE; only uploads written "
+                "to MEDIA_ROOT can be optimized"
+            )
+
+        upload_path = Path(settings.MEDIA_ROOT)
+        if not upload_path.is_dir():
+            raise CommandError(f"MEDIA_ROOT '{upload_path}' does not exist")
+
+        # Only files the app stored itself: indexed uploads and their derivatives.
+        # A file indexed under several hashes is optimized once.
+        stored_files = {}
+        for stored_file in StoredFile.objects.order_by("pk"):
+            if Path(stored_file.name).suffix.lower() in OPTIMIZABLE_EXTENSIONS:
+                stored_files.setdefault(stored_file.name, stored_file)
+        derivatives = list(ImageDerivative.objects.order_by("pk"))
+        records = list(stored_files.values()) + derivatives
+        dry_run = options["dry_run"]
+
+        def optimize(record):
+            try:
+                return _optimize_file(upload_path, record.name, dry_run)
+            except FileNotFoundError:
+                return None
+
+        total_saved = 0
+        optimized = 0
+        with ThreadPoolExecutor(max_workers=max(1, options["workers"])) as executor:
+            for record, result in zip(records, executor.map(optimize, records)):
+                if result is None:
+                    self.stderr.write(f"Skipped {record.name}: file not found")
+                    continue
+                size, saved, content_hash = result
+                total_saved += saved
+                if not saved:
+                    continue
+                optimized += 1
+                if content_hash is None:
+                    continue
+                # Keep the index in step with each rewritten file
+                if isinstance(record, ImageDerivative):
+                    ImageDerivative.objects.filter(pk=record.pk).update(size=size)
+                    continue
+                StoredFile.objects.filter(name=record.name).update(size=size)
+                # Uploads of the optimized bytes dedup to the same file; the
+                # original hash stays the key of derivatives and ownership
+                content_index.record(content_hash, record.name, size)
+
+        verb = "Would save" if dry_run else "Saved"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{verb} {total_saved / 1024:.1f}KB across {optimized} "
+                f"of {len(records)} images"
+            )
+        )
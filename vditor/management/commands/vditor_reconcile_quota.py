@@ -0,0 +1,136 @@
+"""
+Django management command rebuilding upload quota usage from stored files.
+
+Usage is summed from ``UploadOwnership.size``, the size each owner was
+charged on upload, so a rebuild agrees with the incremental counters. The
+storage scan only drops uploads whose file no longer exists.
+"""
+
+import os
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from vditor import views
+from vditor.models import QuotaUsage, StoredFile, UploadOwnership
+from vditor.quota import refresh_usage_cache
+
+
+def _scan_local(upload_path: Path) -> set[str]:
+    """Get the name of every file under MEDIA_ROOT in one walk."""
+    names = set()
+    for root, _dirs, files in os.walk(upload_path):
+        for file_name in files:
+            names.add((Path(root) / file_name).relative_to(upload_path).as_posix())
+    return names
+
+
+def _scan_storage(storage, directory: str = "") -> set[str]:
+    """Get the name of every file in a storage backend, directory by directory.
+
+    Only listings are requested; sizes come from ``UploadOwnership``.
+    """
+    names = set()
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        directories, files = storage.listdir(current)
+        names.update(
+            f"{current}/{file_name}" if current else file_name for file_name in files
+        )
+        pending.extend(
+            f"{current}/{subdirectory}" if current else subdirectory
+            for subdirectory in directories
+        )
+    return names
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild upload quota usage from the charged uploads whose files are "
+        "still stored, in one scan of the upload storage"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=2000,
+            help="Number of rows read and written per query",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report usage that would change without updating it",
+        )
+
+    def handle(self, *args, **options):
+        storage = views._get_upload_storage()
+        if storage is None:
+            upload_path = Path(settings.MEDIA_ROOT)
+            if not upload_path.is_dir():
+                raise CommandError(f"MEDIA_ROOT '{upload_path}' does not exist")
+            names = _scan_local(upload_path)
+        else:
+            names = _scan_storage(storage)
+        self.stdout.write(f"Scanned {len(names)} stored files.")
+
+        batch_size = options["batch_size"]
+        # Indexed content hashes whose file is still stored
+        stored_hashes = set()
+        for content_hash, name in StoredFile.objects.values_list(
+            "content_hash", "name"
+        ).iterator(chunk_size=batch_size):
+            if name in names:
+                stored_hashes.add(content_hash)
+
+        # Charged sizes, the same source charge_upload adds to the counters
+        usage = defaultdict(lambda: [0, 0])
+        missing = 0
+        for owner, content_hash, size in UploadOwnership.objects.values_list(
+            "owner", "content_hash", "size"
+        ).iterator(chunk_size=batch_size):
+            if content_hash not in stored_hashes:
+                missing += 1
+                continue
+            usage[owner][0] += size
+            usage[owner][1] += 1
+
+        current = {
+            row.owner: row for row in QuotaUsage.objects.iterator(chunk_size=batch_size)
+        }
+        changed = [
+            owner
+            for owner in set(usage) | set(current)
+            if owner not in current
+            or [current[owner].bytes_used, current[owner].files]
+            != usage.get(owner, [0, 0])
+        ]
+        for owner in sorted(changed):
+            old = current[owner].bytes_used if owner in current else 0
+            new = usage.get(owner, [0, 0])[0]
+            self.stdout.write(f"{owner}: {old} -> {new} bytes")
+
+        if not options["dry_run"] and changed:
+            with transaction.atomic():
+                QuotaUsage.objects.filter(owner__in=changed).delete()
+                QuotaUsage.objects.bulk_create(
+                    [
+                        QuotaUsage(owner=owner, bytes_used=used, files=files)
+                        for owner, (used, files) in usage.items()
+                        if owner in changed
+                    ],
+                    batch_size=batch_size,
+                )
+            refresh_usage_cache(changed)
+
+        verb = "Would update" if options["dry_run"] else "Updated"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{verb} usage of {len(changed)} of {len(usage)} owners "
+                f"({missing} uploads no longer stored)"
+            )
+        )
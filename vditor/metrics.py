@@ -0,0 +1,573 @@
+"""
+Upload metrics for Django Vditor.
+
+Uploads are counted in fixed-bucket histograms of processing time and file
+size, from which percentiles are estimated. Counters are kept in the Django
+cache and only changed with atomic ``incr``, so with a shared cache (Redis,
+Memcached) every worker adds to the same histograms and
+``python manage.py vditor_cache metrics`` reads the totals of all of them.
+Set ``VDITOR_METRICS_CACHE = None`` to keep per-process counters instead.
+
+Counts are first added to a buffer owned by the current thread, whose lock
+is only contended while it is flushed. The buffers of every thread, upload
+pool threads included, are added to the shared counters in one batch at
+the end of each request or once a buffer is
+``VDITOR_METRICS_FLUSH_INTERVAL`` seconds old. Reading metrics never blocks
+the threads recording them.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from typing import Sequence
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Cache alias counters are aggregated in; None keeps them in this process
+METRICS_CACHE = getattr(settings, "VDITOR_METRICS_CACHE", "default")
+
+# Upper bounds of the histogram buckets; values above the last bound are
+# counted in an overflow bucket
+LATENCY_BUCKETS = tuple(
+    getattr(
+        settings,
+        "VDITOR_METRICS_LATENCY_BUCKETS",
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    )
+)
+SIZE_BUCKETS = tuple(
+    getattr(
+        settings,
+        "VDITOR_METRICS_SIZE_BUCKETS",
+        tuple(1024 * 4**i for i in range(10)),  # 1KB to 256MB
+    )
+)
+
+# Serve metrics in the Prometheus text format at ``metrics/``
+METRICS_ENDPOINT = getattr(settings, "VDITOR_METRICS_ENDPOINT", False)
+
+# Bearer token scrapers must send to the endpoint; None allows any client
+METRICS_TOKEN = getattr(settings, "VDITOR_METRICS_TOKEN", None)
+
+# Seconds counts are buffered in a thread before being added to the shared
+# counters
+METRICS_FLUSH_INTERVAL = getattr(settings, "VDITOR_METRICS_FLUSH_INTERVAL", 1.0)
+
+OUTCOMES = ("successful", "failed")
+
+# Rules uploads are rejected by
+REJECTION_REASONS = (
+    "filename",
+    "size",
+    "empty",
+    "type",
+    "header",
+    "dimensions",
+    "content",
+    "config",
+    "rate_limit",
+    "quota",
+    "busy",
+    "error",
+)
+
+# Caches whose hits and misses are counted: ``ConfigCache`` and
+# ``cache_result``
+CACHE_NAMES = ("config", "result")
+
+# Event counters besides the upload histograms
+COUNTERS = (
+    tuple(f"rejected_{reason}" for reason in REJECTION_REASONS)
+    + ("dedup_hits", "dedup_misses")
+    + tuple(
+        f"{name}_cache_{result}"
+        for name in CACHE_NAMES
+        for result in ("hits", "misses")
+    )
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Processing time is summed in microseconds, as cache counters are integers
+MICROSECONDS = 1_000_000
+
+
+def bucket_index(buckets: Sequence[float], value: float) -> int:
+    """Get the index of the first bucket whose upper bound is >= value."""
+    return bisect.bisect_left(buckets, value)
+
+
+def estimate_quantile(
+    buckets: Sequence[float], counts: Sequence[int], quantile: float
+) -> float:
+    """Estimate a quantile from histogram bucket counts.
+
+    Values are assumed evenly spread within their bucket. Values in the
+    overflow bucket are reported as the last upper bound.
+
+    Args:
+        buckets: Upper bounds of the buckets
+        counts: Number of values per bucket, plus the overflow bucket
+        quantile: Quantile between 0 and 1
+
+    Returns:
+        Estimated value, or 0.0 without values
+    """
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = quantile * total
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if count and cumulative + count >= rank:
+            if i >= len(buckets):
+                return float(buckets[-1])
+            lower = buckets[i - 1] if i else 0.0
+            return lower + (buckets[i] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return float(buckets[-1])
+
+
+class LocalCounters:
+    """Counters kept in this process."""
+
+    def __init__(self) -> None:
+        self._counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def incr_many(self, deltas: dict[str, int]) -> None:
+        with self._lock:
+            for key, delta in deltas.items():
+                self._counters[key] = self._counters.get(key, 0) + delta
+
+    def get_many(self, keys: Sequence[str]) -> dict[str, int]:
+        with self._lock:
+            return {key: self._counters[key] for key in keys if key in self._counters}
+
+    def delete_many(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._counters.pop(key, None)
+
+
+class CacheCounters:
+    """Counters shared by every process using the same Django cache."""
+
+    def __init__(self, alias: str) -> None:
+        self.alias = alias
+
+    def incr_many(self, deltas: dict[str, int]) -> None:
+        cache = caches[self.alias]
+        dropped = []
+        for key, delta in deltas.items():
+            # Retried once if evicted between add() and incr(); a cache that
+            # cannot hold counters at all (e.g. DummyCache) fails both times
+            for _attempt in range(2):
+                cache.add(key, 0, None)
+                try:
+                    cache.incr(key, delta)
+                    break
+                except ValueError:
+                    continue
+            else:
+                dropped.append(key)
+        if dropped:
+            logger.warning(
+                f"Cache '{self.alias}' cannot hold metric counters; "
+                f"dropped {len(dropped)} counts"
+            )
+
+    def get_many(self, keys: Sequence[str]) -> dict[str, int]:
+        return caches[self.alias].get_many(keys)
+
+    def delete_many(self, keys: Sequence[str]) -> None:
+        caches[self.alias].delete_many(keys)
+
+
+def _counters():
+    if METRICS_CACHE is None:
+        return _local_counters
+    return CacheCounters(METRICS_CACHE)
+
+
+_local_counters = LocalCounters()
+
+
+class _PendingCounts:
+    """Counts recorded by one thread and not yet added to the counters.
+
+    Only its thread adds to it; the lock is contended while it is flushed.
+    """
+
+    def __init__(self) -> None:
+        self.deltas: dict[str, int] = {}
+        self.since = time.monotonic()
+        self.thread = threading.current_thread()
+        self.lock = threading.Lock()
+
+
+_local = threading.local()
+
+# Buffers of every thread that recorded counts, including upload pool
+# threads that never finish a request, so any flush drains all of them
+_buffers: list[_PendingCounts] = []
+_buffers_lock = threading.Lock()
+
+
+def _thread_buffer() -> _PendingCounts:
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None:
+        buffer = _local.buffer = _PendingCounts()
+        with _buffers_lock:
+            _buffers.append(buffer)
+    return buffer
+
+
+def _add(deltas: dict[str, int]) -> None:
+    buffer = _thread_buffer()
+    with buffer.lock:
+        for key, delta in deltas.items():
+            buffer.deltas[key] = buffer.deltas.get(key, 0) + delta
+        due = time.monotonic() - buffer.since >= METRICS_FLUSH_INTERVAL
+    if due:
+        flush_metrics()
+
+
+def _drain_buffers() -> dict[str, int]:
+    """Take the counts buffered by every thread, forgetting finished threads."""
+    with _buffers_lock:
+        buffers = list(_buffers)
+    deltas: dict[str, int] = {}
+    now = time.monotonic()
+    for buffer in buffers:
+        with buffer.lock:
+            pending, buffer.deltas = buffer.deltas, {}
+            buffer.since = now
+        for key, delta in pending.items():
+            deltas[key] = deltas.get(key, 0) + delta
+    with _buffers_lock:
+        _buffers[:] = [buffer for buffer in _buffers if buffer.thread.is_alive()]
+    return deltas
+
+
+def flush_metrics(**kwargs) -> None:
+    """Add the counts buffered by every thread to the shared counters.
+
+    Connected to ``request_finished``, so each request costs at most one
+    batch of increments, including the counts its upload pool tasks
+    recorded.
+    """
+    deltas = _drain_buffers()
+    if not deltas:
+        return
+    try:
+        _counters().incr_many(deltas)
+    except Exception as e:
+        # Never fail requests because the cache is unavailable
+        logger.warning(f"Failed to record metrics: {e}")
+
+
+def _key(outcome: str, name: str) -> str:
+    return f"vditor_metrics_{outcome}_{name}"
+
+
+def _counter_key(name: str) -> str:
+    return f"vditor_metrics_counter_{name}"
+
+
+def _keys(outcome: str) -> list[str]:
+    return (
+        [_key(outcome, name) for name in ("count", "time_us", "size")]
+        + [_key(outcome, f"latency_{i}") for i in range(len(LATENCY_BUCKETS) + 1)]
+        + [_key(outcome, f"size_{i}") for i in range(len(SIZE_BUCKETS) + 1)]
+    )
+
+
+def record_upload(file_size: int, processing_time: float, success: bool) -> None:
+    """Count an upload in the shared histograms.
+
+    Args:
+        file_size: Size of the uploaded file in bytes
+        processing_time: Time taken to process the upload in seconds
+        success: Whether the upload was stored
+    """
+    outcome = "successful" if success else "failed"
+    deltas = {
+        _key(outcome, "count"): 1,
+        _key(outcome, "time_us"): round(processing_time * MICROSECONDS),
+        _key(outcome, "size"): file_size,
+        _key(outcome, f"latency_{bucket_index(LATENCY_BUCKETS, processing_time)}"): 1,
+        _key(outcome, f"size_{bucket_index(SIZE_BUCKETS, file_size)}"): 1,
+    }
+    _add(deltas)
+
+
+def incr_counter(name: str, delta: int = 1) -> None:
+    """Count an event in one of ``COUNTERS``."""
+    _add({_counter_key(name): delta})
+
+
+def record_rejection(reason: str) -> None:
+    """Count an upload rejected by a rule from ``REJECTION_REASONS``."""
+    if reason not in REJECTION_REASONS:
+        reason = "error"
+    incr_counter(f"rejected_{reason}")
+
+
+def read_counters() -> dict[str, int]:
+    """Read every event counter, aggregated over every worker."""
+    flush_metrics()
+    values = _counters().get_many([_counter_key(name) for name in COUNTERS])
+    return {name: values.get(_counter_key(name), 0) for name in COUNTERS}
+
+
+def read_histograms(include_empty: bool = False) -> dict:
+    """Read the raw counters of every outcome with at least one upload.
+
+    Args:
+        include_empty: Also return outcomes without uploads
+
+    Returns:
+        Dictionary mapping outcome to ``count``, ``total_time`` (seconds),
+        ``total_size`` (bytes), ``latency_counts`` and ``size_counts`` (one
+        count per bucket, plus the overflow bucket)
+    """
+    flush_metrics()
+    keys = [key for outcome in OUTCOMES for key in _keys(outcome)]
+    values = _counters().get_many(keys)
+    histograms = {}
+    for outcome in OUTCOMES:
+        count = values.get(_key(outcome, "count"), 0)
+        if not count and not include_empty:
+            continue
+        histograms[outcome] = {
+            "count": count,
+            "total_time": values.get(_key(outcome, "time_us"), 0) / MICROSECONDS,
+            "total_size": values.get(_key(outcome, "size"), 0),
+            "latency_counts": [
+                values.get(_key(outcome, f"latency_{i}"), 0)
+                for i in range(len(LATENCY_BUCKETS) + 1)
+            ],
+            "size_counts": [
+                values.get(_key(outcome, f"size_{i}"), 0)
+                for i in range(len(SIZE_BUCKETS) + 1)
+            ],
+        }
+    return histograms
+
+
+def get_upload_metrics() -> dict:
+    """Get upload metrics aggregated over every worker.
+
+    Returns:
+        Dictionary mapping outcome (``successful``, ``failed``) to
+        ``count``, ``total_time``, ``avg_time``, ``total_size``,
+        ``avg_size``, and ``time_p50``/``time_p95``/``time_p99`` and
+        ``size_p50``/``size_p95``/``size_p99`` estimated from the histograms
+    """
+    metrics = {}
+    for outcome, data in read_histograms().items():
+        count = data["count"]
+        metrics[outcome] = {
+            "count": count,
+            "total_time": data["total_time"],
+            "avg_time": data["total_time"] / count,
+            "total_size": data["total_size"],
+            "avg_size": data["total_size"] / count,
+        }
+        for quantile in QUANTILES:
+            suffix = f"p{round(quantile * 100)}"
+            metrics[outcome][f"time_{suffix}"] = estimate_quantile(
+                LATENCY_BUCKETS, data["latency_counts"], quantile
+            )
+            metrics[outcome][f"size_{suffix}"] = estimate_quantile(
+                SIZE_BUCKETS, data["size_counts"], quantile
+            )
+    return metrics
+
+
+def reset_upload_metrics() -> None:
+    """Reset the upload metrics of every worker."""
+    _drain_buffers()
+    _counters().delete_many(
+        [key for outcome in OUTCOMES for key in _keys(outcome)]
+        + [_counter_key(name) for name in COUNTERS]
+    )
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _histogram_lines(
+    name: str, outcome: str, buckets: Sequence[float], counts: list, total: float
+) -> list[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        lines.append(
+            f'{name}_bucket{{outcome="{outcome}",le="{_format_value(bound)}"}} '
+            f"{cumulative}"
+        )
+    cumulative += counts[-1]
+    lines.append(f'{name}_bucket{{outcome="{outcome}",le="+Inf"}} {cumulative}')
+    lines.append(f'{name}_sum{{outcome="{outcome}"}} {_format_value(total)}')
+    lines.append(f'{name}_count{{outcome="{outcome}"}} {cumulative}')
+    return lines
+
+
+def _process_gauge_lines() -> list[str]:
+    """Render the gauges kept in this process, which only it can report."""
+    from .admission import upload_admission
+    from .uploadhandler import upload_memory_budget
+
+    memory = upload_memory_budget.gauges()
+    admission = upload_admission.gauges()
+    lines = []
+    for name, metric_type, help_text, value in (
+        (
+            "vditor_upload_memory_bytes",
+            "gauge",
+            "Bytes of uploads held in memory by this process.",
+            memory["in_memory_bytes"],
+        ),
+        (
+            "vditor_upload_memory_peak_bytes",
+            "gauge",
+            "Most bytes of uploads held in memory by this process at once.",
+            memory["peak_in_memory_bytes"],
+        ),
+        (
+            "vditor_upload_memory_budget_bytes",
+            "gauge",
+            "Bytes of uploads this process may hold in memory.",
+            memory["budget_bytes"],
+        ),
+        (
+            "vditor_upload_spilled_files_total",
+            "counter",
+            "Uploads spooled to disk because the memory budget was used up.",
+            memory["spilled_files"],
+        ),
+        (
+            "vditor_upload_admission_active",
+            "gauge",
+            "Uploads being hashed and stored by this process.",
+            admission["active"],
+        ),
+        (
+            "vditor_upload_admission_queue_depth",
+            "gauge",
+            "Uploads waiting for a slot in this process.",
+            admission["queue_depth"],
+        ),
+        (
+            "vditor_upload_admission_max_queue_depth",
+            "gauge",
+            "Most uploads waiting for a slot in this process at once.",
+            admission["max_queue_depth"],
+        ),
+        (
+            "vditor_upload_admission_admitted_total",
+            "counter",
+            "Uploads given a slot by this process.",
+            admission["admitted"],
+        ),
+        (
+            "vditor_upload_admission_rejected_total",
+            "counter",
+            "Uploads turned away by this process because no slot was free.",
+            admission["rejected"],
+        ),
+        (
+            "vditor_upload_admission_wait_seconds_total",
+            "counter",
+            "Time admitted uploads waited for a slot in this process.",
+            admission["total_wait_time"],
+        ),
+        (
+            "vditor_upload_admission_wait_seconds_max",
+            "gauge",
+            "Longest time an upload waited for a slot in this process.",
+            admission["max_wait_time"],
+        ),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name} {_format_value(value)}")
+    return lines
+
+
+def render_prometheus() -> str:
+    """Render every metric in the Prometheus text exposition format.
+
+    Upload memory and admission gauges are those of the process serving
+    the request.
+    """
+    histograms = read_histograms(include_empty=True)
+    counters = read_counters()
+    lines = []
+
+    for name, help_text, buckets, counts_key, total_key in (
+        (
+            "vditor_upload_duration_seconds",
+            "Time taken to process an upload.",
+            LATENCY_BUCKETS,
+            "latency_counts",
+            "total_time",
+        ),
+        (
+            "vditor_upload_size_bytes",
+            "Size of uploaded files.",
+            SIZE_BUCKETS,
+            "size_counts",
+            "total_size",
+        ),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for outcome, data in histograms.items():
+            lines.extend(
+                _histogram_lines(
+                    name, outcome, buckets, data[counts_key], data[total_key]
+                )
+            )
+
+    lines.append("# HELP vditor_upload_rejections_total Uploads rejected, by rule.")
+    lines.append("# TYPE vditor_upload_rejections_total counter")
+    for reason in REJECTION_REASONS:
+        lines.append(
+            f'vditor_upload_rejections_total{{reason="{reason}"}} '
+            f"{counters[f'rejected_{reason}']}"
+        )
+
+    hits, misses = counters["dedup_hits"], counters["dedup_misses"]
+    lines.append(
+        "# HELP vditor_upload_dedup_total Stored uploads, by whether their "
+        "content was already stored."
+    )
+    lines.append("# TYPE vditor_upload_dedup_total counter")
+    lines.append(f'vditor_upload_dedup_total{{result="hit"}} {hits}')
+    lines.append(f'vditor_upload_dedup_total{{result="miss"}} {misses}')
+    lines.append(
+        "# HELP vditor_upload_dedup_hit_ratio Share of stored uploads whose "
+        "content was already stored."
+    )
+    lines.append("# TYPE vditor_upload_dedup_hit_ratio gauge")
+    ratio = hits / (hits + misses) if hits + misses else 0.0
+    lines.append(f"vditor_upload_dedup_hit_ratio {_format_value(ratio)}")
+
+    lines.append("# HELP vditor_cache_requests_total Cache lookups, by cache.")
+    lines.append("# TYPE vditor_cache_requests_total counter")
+    for cache_name in CACHE_NAMES:
+        for result, counter in (("hit", "hits"), ("miss", "misses")):
+            lines.append(
+                f'vditor_cache_requests_total{{cache="{cache_name}",'
+                f'result="{result}"}} {counters[f"{cache_name}_cache_{counter}"]}'
+            )
+    lines.extend(_process_gauge_lines())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vditor", "0002_derivatives"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivativetask",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("derivatives", "Generate derivatives"),
+                    ("optimize", "Optimize"),
+                ],
+                default="derivatives",
+                max_length=16,
+                verbose_name="Kind",
+            ),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vditor", "0003_derivativetask_kind"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuotaUsage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "owner",
+                    models.CharField(max_length=255, unique=True, verbose_name="Owner"),
+                ),
+                (
+                    "bytes_used",
+                    models.PositiveBigIntegerField(
+                        default=0, verbose_name="Bytes used"
+                    ),
+                ),
+                ("files", models.PositiveIntegerField(default=0, verbose_name="Files")),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated at"),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="UploadOwnership",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("owner", models.CharField(max_length=255, verbose_name="Owner")),
+                (
+                    "content_hash",
+                    models.CharField(max_length=64, verbose_name="Content hash"),
+                ),
+                ("size", models.PositiveBigIntegerField(verbose_name="Size")),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Created at"),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("owner", "content_hash"),
+                        name="vditor_unique_upload_ownership",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,125 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class StoredFile(models.Model):
+    """A stored upload, indexed by the SHA-256 hash of its content.
+
+    Identical content maps to a single stored file whatever name it was
+    uploaded under.
+    """
+
+    content_hash = models.CharField(_("Content hash"), max_length=64, unique=True)
+    name = models.CharField(_("Name"), max_length=255)
+    size = models.PositiveBigIntegerField(_("Size"))
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class DerivativeTask(models.Model):
+    """A newly stored image waiting for background processing.
+
+    Tasks are created in the upload request and processed by the background
+    worker pool or by the ``vditor_derivatives`` management command.
+    """
+
+    KIND_DERIVATIVES = "derivatives"
+    KIND_OPTIMIZE = "optimize"
+    KIND_CHOICES = [
+        (KIND_DERIVATIVES, _("Generate derivatives")),
+        (KIND_OPTIMIZE, _("Optimize")),
+    ]
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_DONE, _("Done")),
+        (STATUS_FAILED, _("Failed")),
+    ]
+
+    content_hash = models.CharField(_("Content hash"), max_length=64)
+    name = models.CharField(_("Name"), max_length=255)
+    kind = models.CharField(
+        _("Kind"), max_length=16, choices=KIND_CHOICES, default=KIND_DERIVATIVES
+    )
+    status = models.CharField(
+        _("Status"),
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=STATUS_PENDING,
+        db_index=True,
+    )
+    attempts = models.PositiveSmallIntegerField(_("Attempts"), default=0)
+    error = models.TextField(_("Error"), blank=True)
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
+    updated_at = models.DateTimeField(_("Updated at"), auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.name} ({self.status})"
+
+
+class ImageDerivative(models.Model):
+    """A resized copy of a stored image, used to build ``srcset``."""
+
+    content_hash = models.CharField(_("Content hash"), max_length=64, db_index=True)
+    width = models.PositiveIntegerField(_("Width"))
+    format = models.CharField(_("Format"), max_length=8)
+    name = models.CharField(_("Name"), max_length=255)
+    size = models.PositiveBigIntegerField(_("Size"))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["content_hash", "width", "format"],
+                name="vditor_unique_derivative",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class UploadOwnership(models.Model):
+    """Content an owner (a user or tenant) has uploaded, charged once.
+
+    Uploading content the owner already has is a dedup hit and is not
+    charged again.
+    """
+
+    owner = models.CharField(_("Owner"), max_length=255)
+    content_hash = models.CharField(_("Content hash"), max_length=64)
+    size = models.PositiveBigIntegerField(_("Size"))
+    created_at = models.DateTimeField(_("Created at"), auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["owner", "content_hash"],
+                name="vditor_unique_upload_ownership",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.owner}: {self.content_hash}"
+
+
+class QuotaUsage(models.Model):
+    """Storage used by an owner, maintained incrementally on upload.
+
+    Rebuilt from ``UploadOwnership`` and the stored files by the
+    ``vditor_reconcile_quota`` management command.
+    """
+
+    owner = models.CharField(_("Owner"), max_length=255, unique=True)
+    bytes_used = models.PositiveBigIntegerField(_("Bytes used"), default=0)
+    files = models.PositiveIntegerField(_("Files"), default=0)
+    updated_at = models.DateTimeField(_("Updated at"), auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.owner} ({self.bytes_used} bytes)"
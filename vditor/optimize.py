@@ -0,0 +1,343 @@
+"""
+Lossless size reduction of stored images for Django Vditor.
+
+Metadata (EXIF, XMP, IPTC, comments, embedded thumbnails) is stripped and
+PNG image data is recompressed, working directly on the file structure so
+pixels are never decoded or re-encoded. Optimized files keep the name and
+index entry of the original upload, so uploading the original again is
+still deduplicated.
+"""
+
+import logging
+import struct
+import zlib
+from typing import Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Strip metadata and recompress newly stored images
+OPTIMIZE_IMAGES = getattr(settings, "VDITOR_OPTIMIZE_IMAGES", False)
+
+# Larger images are optimized in the background instead of in the request
+OPTIMIZE_INLINE_MAX_SIZE = getattr(
+    settings, "VDITOR_OPTIMIZE_INLINE_MAX_SIZE", 512 * 1024
+)
+
+# PNGs whose image data decompresses to more than this (estimated from the
+# IHDR chunk) are recompressed in the background whatever their file size
+OPTIMIZE_INLINE_MAX_PNG_DATA_SIZE = getattr(
+    settings, "VDITOR_OPTIMIZE_INLINE_MAX_PNG_DATA_SIZE", 8 * 1024 * 1024
+)
+
+# PNG image data larger than this once decompressed is left as is
+MAX_PNG_DATA_SIZE = 256 * 1024 * 1024
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Signature, IHDR length and type, width, height, bit depth and color type
+PNG_IHDR_SIZE = 26
+
+# Samples per pixel of each PNG color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Ancillary PNG chunks that only carry metadata
+PNG_METADATA_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"tIME"}
+
+# JPEG markers
+JPEG_SOI = 0xD8
+JPEG_EOI = 0xD9
+JPEG_SOS = 0xDA
+JPEG_APP1 = 0xE1
+JPEG_APP2 = 0xE2
+JPEG_COM = 0xFE
+
+# APPn segments that affect decoding: JFIF (APP0), ICC profile (APP2) and
+# Adobe color transform (APP14)
+JPEG_KEPT_APP_MARKERS = {0xE0, 0xE2, 0xEE}
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# VP8X flags of chunks removed from WebP files
+WEBP_EXIF_FLAG = 0x08
+WEBP_XMP_FLAG = 0x04
+
+
+def png_data_size(header: bytes) -> Optional[int]:
+    """Estimate the decompressed size of PNG image data from its IHDR chunk.
+
+    Args:
+        header: At least the first ``PNG_IHDR_SIZE`` bytes of the file
+
+    Returns:
+        Size in bytes, or None if the header is not a readable PNG header
+    """
+    if (
+        len(header) < PNG_IHDR_SIZE
+        or not header.startswith(PNG_SIGNATURE)
+        or header[12:16] != b"IHDR"
+    ):
+        return None
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", header[16:26])
+    channels = PNG_CHANNELS.get(color_type)
+    if channels is None:
+        return None
+    # Each row starts with a filter type byte
+    return height * (1 + (width * channels * bit_depth + 7) // 8)
+
+
+def _optimize_png(data: bytes) -> Optional[bytes]:
+    """Drop PNG metadata chunks and recompress the image data."""
+    pos = len(PNG_SIGNATURE)
+    chunks = []
+    image_data = []
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos : pos + 8])
+        chunk_data = data[pos + 8 : pos + 8 + length]
+        pos += 12 + length
+        if chunk_type == b"IDAT":
+            if not image_data:
+                # Merged image data is written where the first IDAT was
+                chunks.append((b"IDAT", None))
+            image_data.append(chunk_data)
+        elif chunk_type not in PNG_METADATA_CHUNKS:
+            chunks.append((chunk_type, chunk_data))
+        if chunk_type == b"IEND":
+            break
+    if not image_data:
+        return None
+
+    compressed = b"".join(image_data)
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(compressed, MAX_PNG_DATA_SIZE)
+    if decompressor.unconsumed_tail:
+        compressed_data = compressed
+    else:
+        compressed_data = zlib.compress(raw, 9)
+        if len(compressed_data) >= len(compressed):
+            compressed_data = compressed
+
+    output = [PNG_SIGNATURE]
+    for chunk_type, chunk_data in chunks:
+        if chunk_data is None:
+            chunk_data = compressed_data
+        output.append(struct.pack(">I4s", len(chunk_data), chunk_type))
+        output.append(chunk_data)
+        output.append(struct.pack(">I", zlib.crc32(chunk_type + chunk_data)))
+    return b"".join(output)
+
+
+def _exif_orientation(segment: bytes) -> int:
+    """Read the orientation from an APP1 EXIF segment, 1 if missing."""
+    if not segment.startswith(b"Exif\0\0") or len(segment) < 14:
+        return 1
+    tiff = segment[6:]
+    byte_order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if byte_order is None:
+        return 1
+    try:
+        (ifd_offset,) = struct.unpack(byte_order + "I", tiff[4:8])
+        (entries,) = struct.unpack(byte_order + "H", tiff[ifd_offset : ifd_offset + 2])
+        for i in range(entries):
+            entry = ifd_offset + 2 + i * 12
+            tag, _type, _count, value = struct.unpack(
+                byte_order + "HHIH", tiff[entry : entry + 10]
+            )
+            if tag == EXIF_ORIENTATION_TAG:
+                return value
+    except struct.error:
+        pass
+    return 1
+
+
+def _orientation_segment(orientation: int) -> bytes:
+    """Build a minimal APP1 EXIF segment holding only the orientation."""
+    tiff = b"MM\0*" + struct.pack(
+        ">IHHHIHHI", 8, 1, EXIF_ORIENTATION_TAG, 3, 1, orientation, 0, 0
+    )
+    payload = b"Exif\0\0" + tiff
+    return struct.pack(">BBH", 0xFF, JPEG_APP1, len(payload) + 2) + payload
+
+
+def _jpeg_image_end(data: bytes, pos: int) -> int:
+    """Find the end of a JPEG image, starting at its first scan.
+
+    Returns:
+        Offset just past the EOI marker, or -1 if the image is truncated
+    """
+    while pos + 2 <= len(data):
+        marker = data[pos + 1]
+        if marker == JPEG_EOI:
+            return pos + 2
+        (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+        pos += 2 + length
+        if marker != JPEG_SOS:
+            continue
+        # Skip entropy-coded data: stuffed bytes, restart markers and fill
+        # bytes are part of the scan
+        while True:
+            pos = data.find(b"\xff", pos)
+            if pos < 0 or pos + 1 >= len(data):
+                return -1
+            next_byte = data[pos + 1]
+            if next_byte == 0xFF:
+                pos += 1
+            elif next_byte == 0 or 0xD0 <= next_byte <= 0xD7:
+                pos += 2
+            else:
+                break
+    return -1
+
+
+def _optimize_jpeg(data: bytes) -> Optional[bytes]:
+    """Drop JPEG metadata segments, keeping the orientation.
+
+    Data after the end of the image (such as the extra images of MPF files)
+    is dropped too. Scan data is copied unchanged.
+    """
+    output = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker == JPEG_SOS:
+            end = _jpeg_image_end(data, pos)
+            if end < 0:
+                return None
+            output.append(data[pos:end])
+            return b"".join(output)
+
+        (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+        segment = data[pos : pos + 2 + length]
+        payload = segment[4:]
+        pos += 2 + length
+        if marker == JPEG_APP1:
+            orientation = _exif_orientation(payload)
+            if orientation != 1:
+                output.append(_orientation_segment(orientation))
+        elif marker == JPEG_APP2 and not payload.startswith(b"ICC_PROFILE\0"):
+            continue
+        elif 0xE0 <= marker <= 0xEF and marker not in JPEG_KEPT_APP_MARKERS:
+            continue
+        elif marker == JPEG_COM:
+            continue
+        else:
+            output.append(segment)
+    return None
+
+
+def _optimize_webp(data: bytes) -> Optional[bytes]:
+    """Drop EXIF and XMP chunks from an extended WebP file."""
+    pos = 12
+    chunks = []
+    while pos + 8 <= len(data):
+        fourcc = data[pos : pos + 4]
+        (size,) = struct.unpack("<I", data[pos + 4 : pos + 8])
+        chunk = data[pos : pos + 8 + size + (size & 1)]
+        pos += len(chunk)
+        if fourcc == b"VP8X":
+            flags = chunk[8] & ~(WEBP_EXIF_FLAG | WEBP_XMP_FLAG)
+            chunk = chunk[:8] + bytes([flags]) + chunk[9:]
+        elif fourcc in (b"EXIF", b"XMP "):
+            continue
+        chunks.append(chunk)
+
+    body = b"WEBP" + b"".join(chunks)
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def optimize_image(data: bytes) -> bytes:
+    """Reduce the size of an image without changing its pixels.
+
+    Args:
+        data: PNG, JPEG or WebP file content
+
+    Returns:
+        Optimized content, or ``data`` itself if it cannot be made smaller
+    """
+    try:
+        if data.startswith(PNG_SIGNATURE):
+            optimized = _optimize_png(data)
+        elif data.startswith(b"\xff\xd8\xff"):
+            optimized = _optimize_jpeg(data)
+        elif data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+            optimized = _optimize_webp(data)
+        else:
+            optimized = None
+    except (zlib.error, struct.error, IndexError) as e:
+        logger.debug(f"Cannot optimize image: {e}")
+        optimized = None
+
+    if optimized is None or len(optimized) >= len(data):
+        return data
+    return optimized
+
+
+def optimize_stored_file(content_hash: str, stored_name: str) -> int:
+    """Optimize a stored upload in place.
+
+    The file keeps its name and its index entry for the original content
+    hash; only the recorded size changes.
+
+    Args:
+        content_hash: Hex SHA-256 digest of the original upload
+        stored_name: Stored name of the upload
+
+    Returns:
+        Number of bytes saved
+    """
+    from .models import StoredFile
+    from .views import _open_stored_file, _write_stored_file
+
+    with _open_stored_file(stored_name) as f:
+        data = f.read()
+    optimized = optimize_image(data)
+    saved = len(data) - len(optimized)
+    if not saved:
+        return 0
+
+    _write_stored_file(stored_name, optimized)
+    StoredFile.objects.filter(content_hash=content_hash).update(size=len(optimized))
+    logger.info(f"Optimized {stored_name}: saved {saved} bytes")
+    return saved
+
+
+def _fits_inline(stored_name: str) -> bool:
+    """Check whether a small upload is also cheap to recompress.
+
+    A small PNG can decompress to far more image data than its file size.
+    """
+    from .views import _open_stored_file
+
+    with _open_stored_file(stored_name) as f:
+        header = f.read(PNG_IHDR_SIZE)
+    if not header.startswith(PNG_SIGNATURE):
+        return True
+    data_size = png_data_size(header)
+    return data_size is not None and data_size <= OPTIMIZE_INLINE_MAX_PNG_DATA_SIZE
+
+
+def optimize_new_upload(content_hash: str, stored_name: str, size: int) -> None:
+    """Optimize a newly stored upload, inline if small or in the background.
+
+    Args:
+        content_hash: Hex SHA-256 digest of the upload
+        stored_name: Stored name of the upload
+        size: Size of the upload in bytes
+    """
+    if not OPTIMIZE_IMAGES:
+        return
+    if size <= OPTIMIZE_INLINE_MAX_SIZE and _fits_inline(stored_name):
+        optimize_stored_file(content_hash, stored_name)
+        return
+
+    from .derivatives import queue_task
+    from .models import DerivativeTask
+
+    queue_task(content_hash, stored_name, DerivativeTask.KIND_OPTIMIZE)
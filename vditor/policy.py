@@ -0,0 +1,303 @@
+"""
+Upload policies for Django Vditor.
+
+An ``UploadPolicy`` holds every rule uploads are validated against,
+compiled once: a first-byte dispatch table for magic numbers, a single
+filename regex and an extension to MIME type map. Policies are built from
+settings when the app is ready and shared by the upload views, the
+streaming upload handler and ``SecurityValidator``, so every entry point
+applies the same rules.
+
+Besides the default policy, a policy can be defined for each editor config
+in ``VDITOR_UPLOAD_POLICIES``. It is bound to an upload route by the
+``config`` extra argument of the route's URL pattern, never chosen by the
+request.
+"""
+
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Mapping, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.translation import gettext_lazy as _
+
+from .security import (
+    DEFAULT_ALLOWED_EXTENSIONS,
+    DEFAULT_ALLOWED_MIME_TYPES,
+    DEFAULT_MAX_FILE_SIZE,
+    SUSPICIOUS_PATTERNS,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLICY = "default"
+
+MAGIC_NUMBERS = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+    b"RIFF": "image/webp",  # WebP files start with RIFF
+}
+
+# MIME type of the content each extension must hold
+EXTENSION_MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+MAX_FILENAME_LENGTH = 255
+FORBIDDEN_FILENAME_CHARS = '<>:"/\\|?*\0'
+FORBIDDEN_FILENAMES = (
+    "CON",
+    "PRN",
+    "AUX",
+    "NUL",
+    *(f"COM{i}" for i in range(1, 10)),
+    *(f"LPT{i}" for i in range(1, 10)),
+)
+
+# Options of a policy that can be set in VDITOR_UPLOAD_POLICIES
+POLICY_OPTIONS = (
+    "max_file_size",
+    "allowed_extensions",
+    "allowed_mime_types",
+    "extension_mime_types",
+)
+
+# Path traversal, absolute, hidden, backup and temporary file names
+FILENAME_PATH_PATTERNS = (r"^/", r"\.\.", r"~", *SUSPICIOUS_PATTERNS)
+
+# Filename rules, in one regex; the name of the matching group selects the
+# error message
+FILENAME_RE = re.compile(
+    "|".join(
+        (
+            "(?P<chars>[" + re.escape(FORBIDDEN_FILENAME_CHARS) + "])",
+            # A reserved name with at most one extension, e.g. "con.png"
+            "(?P<reserved>^(?i:" + "|".join(FORBIDDEN_FILENAMES) + r")(?:\.[^.]*)?$)",
+            "(?P<path>" + "|".join(FILENAME_PATH_PATTERNS) + ")",
+        )
+    )
+)
+
+FILENAME_ERRORS = {
+    "chars": _("Filename contains forbidden characters."),
+    "reserved": _("Filename is reserved by the system."),
+    "path": _("Invalid filename path."),
+}
+
+
+@dataclass(frozen=True)
+class UploadPolicy:
+    """Compiled, immutable set of rules uploads are validated against.
+
+    Build policies with ``build_upload_policy`` rather than directly, so the
+    lookup tables are derived consistently.
+    """
+
+    name: str
+    max_file_size: int
+    allowed_extensions: frozenset
+    allowed_mime_types: frozenset
+    extension_mime_types: Mapping[str, str]
+    # First byte -> ((magic bytes, MIME type), ...)
+    magic_numbers: Mapping[int, tuple]
+
+    def detect_mime_type(self, header: bytes) -> str:
+        """Detect the MIME type of a file from its magic numbers.
+
+        Args:
+            header: First bytes of the file
+
+        Returns:
+            Detected MIME type or empty string if unknown
+        """
+        if not header:
+            return ""
+        for magic_bytes, mime_type in self.magic_numbers.get(header[0], ()):
+            if header.startswith(magic_bytes):
+                return mime_type
+        return ""
+
+    def validate_filename(self, filename: str) -> tuple[bool, str]:
+        """Validate a filename for security issues.
+
+        Returns:
+            tuple: (is_valid, error_message)
+        """
+        if not filename:
+            return False, _("File must have a name.")
+        if len(filename) > MAX_FILENAME_LENGTH:
+            return False, _("Filename is too long.")
+        match = FILENAME_RE.search(filename)
+        if match is not None:
+            return False, FILENAME_ERRORS[match.lastgroup]
+        return True, ""
+
+    def validate_type(
+        self, filename: str, content_type: Optional[str]
+    ) -> tuple[bool, str]:
+        """Validate the extension and declared MIME type of a file.
+
+        Returns:
+            tuple: (is_valid, error_message)
+        """
+        if Path(filename).suffix.lower() not in self.allowed_extensions:
+            allowed = ", ".join(sorted(self.allowed_extensions))
+            return False, _(f"File type not supported. Allowed types: {allowed}")
+        if content_type and content_type not in self.allowed_mime_types:
+            return False, _("Invalid file content type.")
+        return True, ""
+
+    def validate_header(self, header: bytes, file_ext: str) -> tuple[bool, str]:
+        """Validate the magic numbers at the start of a file.
+
+        Args:
+            header: First bytes of the file (at least 32 when available)
+            file_ext: Lowercased file extension
+
+        Returns:
+            tuple: (is_valid, error_message)
+        """
+        detected_type = self.detect_mime_type(header)
+        if not detected_type:
+            return True, ""
+        if detected_type not in self.allowed_mime_types:
+            return False, _("File content does not match allowed types.")
+        if self.extension_mime_types.get(file_ext) != detected_type:
+            return False, _("File extension does not match file content.")
+        return True, ""
+
+
+def build_upload_policy(name: str, **options: Any) -> UploadPolicy:
+    """Build an upload policy, falling back to the global settings.
+
+    Args:
+        name: Policy name, usually the name of an editor config
+        **options: Any of ``POLICY_OPTIONS``
+
+    Returns:
+        UploadPolicy
+
+    Raises:
+        ImproperlyConfigured: If an option is unknown
+    """
+    unknown = set(options) - set(POLICY_OPTIONS)
+    if unknown:
+        raise ImproperlyConfigured(
+            f"Unknown options {sorted(unknown)} in upload policy '{name}'. "
+            f"Valid options: {list(POLICY_OPTIONS)}"
+        )
+
+    allowed_extensions = frozenset(
+        ext.lower()
+        for ext in options.get(
+            "allowed_extensions",
+            getattr(settings, "VDITOR_ALLOWED_EXTENSIONS", DEFAULT_ALLOWED_EXTENSIONS),
+        )
+    )
+    allowed_mime_types = frozenset(
+        options.get(
+            "allowed_mime_types",
+            getattr(settings, "VDITOR_ALLOWED_MIME_TYPES", DEFAULT_ALLOWED_MIME_TYPES),
+        )
+    )
+    extension_mime_types = {
+        ext: mime_type
+        for ext, mime_type in options.get(
+            "extension_mime_types", EXTENSION_MIME_TYPES
+        ).items()
+        if ext in allowed_extensions
+    }
+
+    magic_numbers: dict[int, list] = {}
+    for magic_bytes, mime_type in MAGIC_NUMBERS.items():
+        magic_numbers.setdefault(magic_bytes[0], []).append((magic_bytes, mime_type))
+
+    return UploadPolicy(
+        name=name,
+        max_file_size=options.get(
+            "max_file_size",
+            getattr(settings, "VDITOR_MAX_FILE_SIZE", DEFAULT_MAX_FILE_SIZE),
+        ),
+        allowed_extensions=allowed_extensions,
+        allowed_mime_types=allowed_mime_types,
+        extension_mime_types=MappingProxyType(extension_mime_types),
+        magic_numbers=MappingProxyType(
+            {
+                first_byte: tuple(entries)
+                for first_byte, entries in magic_numbers.items()
+            }
+        ),
+    )
+
+
+_policies: Optional[Mapping[str, UploadPolicy]] = None
+_policies_lock = threading.Lock()
+
+
+def load_upload_policies() -> Mapping[str, UploadPolicy]:
+    """Build the default policy and the policies of ``VDITOR_UPLOAD_POLICIES``.
+
+    Called when the app is ready; the policies are then shared by every
+    request.
+
+    Raises:
+        ImproperlyConfigured: If ``VDITOR_UPLOAD_POLICIES`` is invalid
+    """
+    global _policies
+
+    configured: Any = getattr(settings, "VDITOR_UPLOAD_POLICIES", {})
+    if not isinstance(configured, dict):
+        raise ImproperlyConfigured(
+            "VDITOR_UPLOAD_POLICIES setting must be a dictionary type."
+        )
+
+    policies = {DEFAULT_POLICY: build_upload_policy(DEFAULT_POLICY)}
+    for name, options in configured.items():
+        if not isinstance(options, dict):
+            raise ImproperlyConfigured(
+                f'VDITOR_UPLOAD_POLICIES["{name}"] setting must be a '
+                f"dictionary type."
+            )
+        policies[name] = build_upload_policy(name, **options)
+
+    with _policies_lock:
+        _policies = MappingProxyType(policies)
+    logger.debug(f"Loaded upload policies: {list(policies)}")
+    return _policies
+
+
+def get_upload_policy(name: str = DEFAULT_POLICY) -> Optional[UploadPolicy]:
+    """Get a loaded upload policy by name.
+
+    Args:
+        name: Policy name, usually the name of an editor config
+
+    Returns:
+        UploadPolicy, or None if no policy has that name
+    """
+    policies = _policies
+    if policies is None:
+        policies = load_upload_policies()
+    return policies.get(name)
+
+
+def reload_upload_policies(setting: str, **kwargs: Any) -> None:
+    """Rebuild the policies when an upload setting changes (in tests)."""
+    if setting in (
+        "VDITOR_MAX_FILE_SIZE",
+        "VDITOR_ALLOWED_EXTENSIONS",
+        "VDITOR_ALLOWED_MIME_TYPES",
+        "VDITOR_UPLOAD_POLICIES",
+    ):
+        load_upload_policies()
@@ -0,0 +1,207 @@
+"""
+Sampled profiling for Django Vditor.
+
+Functions decorated with ``profile_sampled`` run under ``cProfile`` once
+every N calls, where N is ``VDITOR_PROFILE_SAMPLE_RATE`` or a rate set for
+every worker with ``python manage.py vditor_cache profile --enable N``.
+Each profile is written as a ``.prof`` file to ``VDITOR_PROFILE_DIR``, which
+keeps only the newest ``VDITOR_PROFILE_MAX_FILES`` files, and
+``python manage.py vditor_cache profile`` merges them into a report of the
+hottest functions.
+
+Unsampled calls only increment a counter. At most one call per process is
+profiled at a time.
+"""
+
+import cProfile
+import itertools
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+from functools import wraps
+from inspect import iscoroutinefunction
+from pathlib import Path
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Profile one in this many calls; 0 disables profiling
+PROFILE_SAMPLE_RATE = getattr(settings, "VDITOR_PROFILE_SAMPLE_RATE", 0)
+
+# Directory profiles are written to, and the number of profiles kept there
+PROFILE_DIR = getattr(
+    settings,
+    "VDITOR_PROFILE_DIR",
+    os.path.join(tempfile.gettempdir(), "vditor-profiles"),
+)
+PROFILE_MAX_FILES = getattr(settings, "VDITOR_PROFILE_MAX_FILES", 100)
+
+# Cache shared by the workers and ``vditor_cache profile --enable``
+PROFILE_CACHE = getattr(settings, "VDITOR_PROFILE_CACHE", "default")
+
+# Seconds a worker reuses the sample rate read from the cache
+SAMPLE_RATE_POLL_INTERVAL = 5.0
+
+SAMPLE_RATE_CACHE_KEY = "vditor_profile_sample_rate"
+
+# Call counter of each profile name, so one name is sampled independently of
+# how often the others are called
+_calls: dict[str, "itertools.count[int]"] = {}
+
+# Only one profiler may be active per process
+_profile_lock = threading.Lock()
+
+# (monotonic time to read the cache again, rate read from the cache or None)
+_sample_rate_override: tuple[float, Optional[int]] = (0.0, None)
+
+
+def get_sample_rate() -> int:
+    """Get the current sample rate, 0 when profiling is disabled.
+
+    A rate set with ``set_sample_rate`` takes precedence over
+    ``VDITOR_PROFILE_SAMPLE_RATE``; it is read from the cache at most every
+    ``SAMPLE_RATE_POLL_INTERVAL`` seconds.
+    """
+    global _sample_rate_override
+    poll_at, rate = _sample_rate_override
+    now = time.monotonic()
+    if now >= poll_at:
+        try:
+            rate = caches[PROFILE_CACHE].get(SAMPLE_RATE_CACHE_KEY)
+        except Exception as e:
+            logger.warning(f"Failed to read profiling sample rate: {e}")
+            rate = None
+        _sample_rate_override = (now + SAMPLE_RATE_POLL_INTERVAL, rate)
+    return PROFILE_SAMPLE_RATE if rate is None else rate
+
+
+def set_sample_rate(rate: Optional[int], timeout: Optional[int] = None) -> None:
+    """Set the sample rate of every worker sharing the cache.
+
+    Workers pick up the new rate within ``SAMPLE_RATE_POLL_INTERVAL``
+    seconds.
+
+    Args:
+        rate: Profile one in this many calls, 0 to disable profiling, or
+            None to go back to ``VDITOR_PROFILE_SAMPLE_RATE``
+        timeout: Seconds until ``VDITOR_PROFILE_SAMPLE_RATE`` applies again,
+            None to keep the rate until it is changed
+    """
+    global _sample_rate_override
+    cache = caches[PROFILE_CACHE]
+    if rate is None:
+        cache.delete(SAMPLE_RATE_CACHE_KEY)
+    else:
+        cache.set(SAMPLE_RATE_CACHE_KEY, rate, timeout)
+    # Apply the change to this process immediately
+    _sample_rate_override = (0.0, None)
+
+
+def list_profiles(name: Optional[str] = None) -> list[Path]:
+    """List the profiles written so far, oldest first.
+
+    Args:
+        name: Only list profiles of this profiled function, e.g. "upload"
+    """
+    directory = Path(PROFILE_DIR)
+    if not directory.is_dir():
+        return []
+    pattern = f"{name}-*.prof" if name else "*.prof"
+    profiles = []
+    for path in directory.glob(pattern):
+        try:
+            profiles.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            continue
+    return [path for _mtime, path in sorted(profiles)]
+
+
+def _rotate_profiles() -> None:
+    """Delete the oldest profiles beyond ``PROFILE_MAX_FILES``."""
+    profiles = list_profiles()
+    excess = len(profiles) - PROFILE_MAX_FILES
+    for path in profiles[:excess] if excess > 0 else ():
+        path.unlink(missing_ok=True)
+
+
+def _write_profile(profiler, name: str) -> None:
+    try:
+        directory = Path(PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{name}-{time.time_ns()}-{os.getpid()}.prof"
+        profiler.dump_stats(path)
+        _rotate_profiles()
+    except Exception as e:
+        logger.warning(f"Failed to write profile of {name}: {e}")
+
+
+def profile_sampled(name: str):
+    """Decorate a function to profile one in every N calls.
+
+    Coroutine functions are returned unchanged: cProfile only sees the
+    thread that starts them.
+
+    Args:
+        name: Name of the profiled function, used in profile file names
+    """
+
+    def decorator(func):
+        if iscoroutinefunction(func):
+            return func
+        calls = _calls.setdefault(name, itertools.count(1))
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            rate = get_sample_rate()
+            if not rate or next(calls) % rate:
+                return func(*args, **kwargs)
+            if not _profile_lock.acquire(blocking=False):
+                return func(*args, **kwargs)
+            try:
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError as e:
+                    # Another profiler, e.g. a coverage tool, is active
+                    logger.warning(f"Cannot profile {name}: {e}")
+                    return func(*args, **kwargs)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                    _write_profile(profiler, name)
+            finally:
+                _profile_lock.release()
+
+        return wrapper
+
+    return decorator
+
+
+def merge_profiles(paths: list[Path], stream=None) -> Optional[pstats.Stats]:
+    """Merge profiles into one ``pstats.Stats``.
+
+    Args:
+        paths: Profiles from ``list_profiles``
+        stream: Stream reports are printed to
+
+    Returns:
+        Merged statistics, or None when no profile could be read
+    """
+    stats = None
+    for path in paths:
+        try:
+            if stats is None:
+                stats = pstats.Stats(str(path), stream=stream)
+            else:
+                stats.add(str(path))
+        except Exception as e:
+            # Rotated away or partially written
+            logger.warning(f"Skipping unreadable profile {path}: {e}")
+    return stats
@@ -0,0 +1,165 @@
+"""
+Upload quotas for Django Vditor.
+
+Storage used by each owner (a user, a tenant, ...) is kept in a
+``QuotaUsage`` row that is updated incrementally when an upload is stored,
+and written through to the Django cache so checking a quota costs a cache
+read instead of a ``SUM`` over every upload. Each owner is charged once per
+distinct content: uploading content the owner already has is free.
+
+Limits are set per owner kind, the part of the owner key before ":", e.g.
+``{"user": 1024 ** 3, "tenant": 50 * 1024 ** 3}``.
+"""
+
+import logging
+from typing import Optional, Sequence
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.http import HttpRequest
+from django.utils.module_loading import import_string
+
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Bytes each kind of owner may store; empty disables quotas
+QUOTA_LIMITS = getattr(settings, "VDITOR_QUOTA_LIMITS", {})
+
+# Dotted path to a function returning the owner keys of a request
+QUOTA_OWNERS = getattr(
+    settings, "VDITOR_QUOTA_OWNERS", "vditor.quota.default_quota_owners"
+)
+
+QUOTA_CACHE = getattr(settings, "VDITOR_QUOTA_CACHE", "default")
+
+# Seconds cached usage is kept; the database row is the source of truth
+USAGE_CACHE_TIMEOUT = 60 * 60
+
+
+def default_quota_owners(request: HttpRequest) -> list[str]:
+    """Charge uploads to the authenticated user, if any.
+
+    Returns:
+        ``["user:<pk>"]``, or an empty list for anonymous requests
+    """
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return [f"user:{user.pk}"]
+    return []
+
+
+def get_quota_owners(request: HttpRequest) -> list[str]:
+    """Get the owners an upload request is charged to.
+
+    Returns:
+        Owner keys such as ``"user:1"`` or ``"tenant:acme"``; empty when
+        quotas are disabled
+    """
+    if not QUOTA_LIMITS:
+        return []
+    return list(import_string(QUOTA_OWNERS)(request))
+
+
+def get_quota_limit(owner: str) -> Optional[int]:
+    """Get the number of bytes an owner may store, None if unlimited."""
+    return QUOTA_LIMITS.get(owner.partition(":")[0])
+
+
+def _usage_cache_key(owner: str) -> str:
+    return f"vditor_quota_{owner}"
+
+
+def get_usage(owner: str) -> int:
+    """Get the bytes stored by an owner, from the cache when possible."""
+    from .models import QuotaUsage
+
+    cache = caches[QUOTA_CACHE]
+    key = _usage_cache_key(owner)
+    usage = cache.get(key)
+    if usage is None:
+        usage = (
+            QuotaUsage.objects.filter(owner=owner)
+            .values_list("bytes_used", flat=True)
+            .first()
+        ) or 0
+        cache.set(key, usage, USAGE_CACHE_TIMEOUT)
+    return usage
+
+
+def check_quota(owners: Sequence[str], size: int) -> Optional[str]:
+    """Check whether storing ``size`` more bytes fits every owner's quota.
+
+    Args:
+        owners: Owner keys from ``get_quota_owners``
+        size: Bytes about to be stored
+
+    Returns:
+        The first owner whose quota would be exceeded, or None
+    """
+    for owner in owners:
+        limit = get_quota_limit(owner)
+        if limit is not None and get_usage(owner) + size > limit:
+            return owner
+    return None
+
+
+def _add_usage(owner: str, size: int) -> None:
+    """Atomically add a stored file to an owner's usage row."""
+    from .models import QuotaUsage
+
+    updated = QuotaUsage.objects.filter(owner=owner).update(
+        bytes_used=F("bytes_used") + size, files=F("files") + 1
+    )
+    if not updated:
+        try:
+            with transaction.atomic():
+                QuotaUsage.objects.create(owner=owner, bytes_used=size, files=1)
+        except IntegrityError:
+            # Created by a concurrent upload
+            QuotaUsage.objects.filter(owner=owner).update(
+                bytes_used=F("bytes_used") + size, files=F("files") + 1
+            )
+
+
+def refresh_usage_cache(owners: Sequence[str]) -> None:
+    """Write the usage rows of owners through to the cache."""
+    from .models import QuotaUsage
+
+    cache = caches[QUOTA_CACHE]
+    usage = dict(
+        QuotaUsage.objects.filter(owner__in=owners).values_list("owner", "bytes_used")
+    )
+    cache.set_many(
+        {_usage_cache_key(owner): usage.get(owner, 0) for owner in owners},
+        USAGE_CACHE_TIMEOUT,
+    )
+
+
+def charge_upload(owners: Sequence[str], content_hash: str, size: int) -> None:
+    """Charge a stored upload to its owners.
+
+    Owners that already have this content are not charged again.
+
+    Args:
+        owners: Owner keys from ``get_quota_owners``
+        content_hash: Hex SHA-256 digest of the upload
+        size: Size of the upload in bytes
+    """
+    from .models import UploadOwnership
+
+    if not owners:
+        return
+    charged = []
+    with span("quota"), transaction.atomic():
+        for owner in owners:
+            _ownership, created = UploadOwnership.objects.get_or_create(
+                owner=owner, content_hash=content_hash, defaults={"size": size}
+            )
+            if created:
+                _add_usage(owner, size)
+                charged.append(owner)
+        if charged:
+            transaction.on_commit(lambda: refresh_usage_cache(charged))
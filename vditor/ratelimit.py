@@ -0,0 +1,222 @@
+"""
+Rate limiting for the Django Vditor upload endpoints.
+
+Limits the number of upload requests and the number of bytes each client
+may send per window. Clients are identified by user ID when authenticated
+and by IP address otherwise, resolving ``X-Forwarded-For`` only behind
+trusted proxies. Counters live in the Django cache and are only changed
+with atomic ``incr``/``decr``, so limits hold across processes with a
+shared cache (Redis, Memcached) and within one process with LocMem.
+
+Requests are checked from their headers, before the body is parsed.
+"""
+
+import ipaddress
+import logging
+import math
+import time
+from functools import wraps
+from inspect import iscoroutinefunction
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpRequest, JsonResponse
+from django.utils.translation import gettext_lazy as _
+
+from .metrics import record_rejection
+
+logger = logging.getLogger(__name__)
+
+# Upload requests and bytes a client may send per window; None disables
+RATE_LIMIT_REQUESTS = getattr(settings, "VDITOR_RATE_LIMIT_REQUESTS", None)
+RATE_LIMIT_BYTES = getattr(settings, "VDITOR_RATE_LIMIT_BYTES", None)
+RATE_LIMIT_WINDOW = getattr(settings, "VDITOR_RATE_LIMIT_WINDOW", 60)
+RATE_LIMIT_CACHE = getattr(settings, "VDITOR_RATE_LIMIT_CACHE", "default")
+
+# Addresses or networks of reverse proxies allowed to set X-Forwarded-For
+TRUSTED_PROXIES = tuple(
+    ipaddress.ip_network(proxy, strict=False)
+    for proxy in getattr(settings, "VDITOR_TRUSTED_PROXIES", ())
+)
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def get_client_address(request: HttpRequest) -> str:
+    """Get the address of the client that sent a request.
+
+    ``X-Forwarded-For`` is only used when the request comes from a trusted
+    proxy; the client is then the last address not added by a trusted proxy.
+
+    Args:
+        request: HTTP request
+
+    Returns:
+        Client IP address, or "unknown"
+    """
+    address = request.META.get("REMOTE_ADDR", "") or "unknown"
+    if not _is_trusted_proxy(address):
+        return address
+    forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "")
+    for hop in reversed(forwarded.split(",")):
+        hop = hop.strip()
+        if hop and not _is_trusted_proxy(hop):
+            return hop
+    return address
+
+
+def get_client_key(request: HttpRequest) -> str:
+    """Get the identity uploads are rate limited by.
+
+    Returns:
+        "user:<pk>" for authenticated users, "ip:<address>" otherwise
+    """
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    return f"ip:{get_client_address(request)}"
+
+
+def _incr(cache, key: str, delta: int) -> int:
+    """Atomically add to a counter, creating it if missing or expired.
+
+    Raises:
+        ValueError: If the cache cannot hold the counter, e.g. DummyCache
+    """
+    # Two windows: the counter is read as the previous window later on
+    cache.add(key, 0, RATE_LIMIT_WINDOW * 2)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Expired between add() and incr(); retried once
+        cache.add(key, 0, RATE_LIMIT_WINDOW * 2)
+        return cache.incr(key, delta)
+
+
+def _decr(cache, key: str, delta: int) -> None:
+    try:
+        cache.decr(key, delta)
+    except ValueError:
+        pass
+
+
+def check_rate_limit(client_key: str, size: int) -> Optional[int]:
+    """Count an upload request against its client's limits.
+
+    Uses a sliding window estimated from two fixed-window counters: the
+    count of the previous window is weighted by the part of it still
+    inside the sliding window. A rejected request is not counted.
+
+    Args:
+        client_key: Identity from ``get_client_key``
+        size: Request body size in bytes
+
+    Returns:
+        Seconds to wait before retrying if a limit is exceeded, else None
+    """
+    limits = [
+        (kind, limit, amount)
+        for kind, limit, amount in (
+            ("requests", RATE_LIMIT_REQUESTS, 1),
+            ("bytes", RATE_LIMIT_BYTES, size),
+        )
+        if limit is not None
+    ]
+    if not limits:
+        return None
+
+    now = time.time()
+    window = int(now // RATE_LIMIT_WINDOW)
+    elapsed = now - window * RATE_LIMIT_WINDOW
+    previous_weight = 1 - elapsed / RATE_LIMIT_WINDOW
+    retry_after = max(1, math.ceil(RATE_LIMIT_WINDOW - elapsed))
+
+    cache = caches[RATE_LIMIT_CACHE]
+    prefix = f"vditor_rate_{client_key}"
+    try:
+        previous = cache.get_many(
+            [f"{prefix}_{kind}_{window - 1}" for kind, _limit, _amount in limits]
+        )
+        counted = []
+        for kind, limit, amount in limits:
+            key = f"{prefix}_{kind}_{window}"
+            current = _incr(cache, key, amount)
+            counted.append((key, amount))
+            estimate = (
+                previous.get(f"{prefix}_{kind}_{window - 1}", 0) * previous_weight
+                + current
+            )
+            if estimate > limit:
+                for counted_key, counted_amount in counted:
+                    _decr(cache, counted_key, counted_amount)
+                return retry_after
+    except Exception as e:
+        # Never block uploads because the cache is unavailable
+        logger.warning(f"Failed to check upload rate limit: {e}")
+    return None
+
+
+def _request_size(request: HttpRequest) -> int:
+    try:
+        return max(0, int(request.META.get("CONTENT_LENGTH") or 0))
+    except ValueError:
+        return 0
+
+
+def _check_request(request: HttpRequest) -> Optional[JsonResponse]:
+    """Check a request against its client's limits.
+
+    Returns:
+        A 429 response if a limit is exceeded, else None
+    """
+    client_key = get_client_key(request)
+    retry_after = check_rate_limit(client_key, _request_size(request))
+    if retry_after is None:
+        return None
+
+    logger.warning(f"Upload rate limit exceeded by {client_key}")
+    record_rejection("rate_limit")
+    response = JsonResponse(
+        {
+            "msg": _("Too many uploads, please retry later."),
+            "code": 1,
+        },
+        status=429,
+    )
+    response["Retry-After"] = str(retry_after)
+    return response
+
+
+def rate_limit_uploads(view):
+    """Decorate an upload view with per-client rate limiting.
+
+    The check only reads request headers, so it runs before the body is
+    parsed. Works with sync and async views.
+    """
+    if iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            rejected = await sync_to_async(_check_request)(request)
+            if rejected is not None:
+                return rejected
+            return await view(request, *args, **kwargs)
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        rejected = _check_request(request)
+        if rejected is not None:
+            return rejected
+        return view(request, *args, **kwargs)
+
+    return wrapper
@@ -7,8 +7,9 @@ file validation, content sanitization, and upload protection.
 
 import logging
 import re
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterable, Optional
 
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
@@ -73,19 +74,115 @@ SUSPICIOUS_PATTERNS = [
 ]
 
 
+# Content that must not appear in uploaded files
+DANGEROUS_CONTENT_PATTERNS = (
+    b"<?php",
+    b"<%",
+    b"<script",
+    b"javascript:",
+    b"vbscript:",
+    b"data:text/html",
+)
+
+# Shorter patterns occur by chance in compressed image data; a 1MB image
+# almost always contains "<%" somewhere
+MIN_BINARY_PATTERN_LENGTH = 5
+
+# Scan uploads for dangerous content while they are hashed
+SCAN_UPLOAD_CONTENT = getattr(settings, "VDITOR_SCAN_UPLOAD_CONTENT", False)
+UPLOAD_SCAN_PATTERNS = tuple(
+    getattr(
+        settings,
+        "VDITOR_UPLOAD_SCAN_PATTERNS",
+        [
+            pattern
+            for pattern in DANGEROUS_CONTENT_PATTERNS
+            if len(pattern) >= MIN_BINARY_PATTERN_LENGTH
+        ],
+    )
+)
+
+
+@lru_cache(maxsize=None)
+def _compile_content_patterns(patterns: tuple[bytes, ...]) -> "re.Pattern[bytes]":
+    return re.compile(
+        b"|".join(re.escape(pattern) for pattern in patterns), re.IGNORECASE
+    )
+
+
+class ContentScanner:
+    """Scan content chunk by chunk for dangerous patterns.
+
+    All patterns are matched case-insensitively by a single compiled regex
+    in one pass over each chunk. The last bytes of every chunk are kept so
+    patterns split across chunk boundaries are still found; chunks are
+    never joined or copied.
+    """
+
+    def __init__(self, patterns: Iterable[bytes] = DANGEROUS_CONTENT_PATTERNS) -> None:
+        patterns = tuple(patterns)
+        self._regex = _compile_content_patterns(patterns)
+        self._overlap = max(len(pattern) for pattern in patterns) - 1
+        self._tail = b""
+        self.match: Optional[bytes] = None
+
+    @property
+    def is_clean(self) -> bool:
+        return self.match is None
+
+    def feed(self, chunk: bytes) -> bool:
+        """Scan the next chunk of content.
+
+        Args:
+            chunk: Next bytes of the content
+
+        Returns:
+            True while no dangerous pattern has been found
+        """
+        if self.match is not None:
+            return False
+
+        found = None
+        if self._tail:
+            # Only matches that start in the tail and end in this chunk
+            found = self._regex.search(self._tail + chunk[: self._overlap])
+        if found is None:
+            found = self._regex.search(chunk)
+        if found is not None:
+            self.match = found.group(0)
+            return False
+
+        if self._overlap:
+            if len(chunk) >= self._overlap:
+                self._tail = chunk[-self._overlap :]
+            else:
+                self._tail = (self._tail + chunk)[-self._overlap :]
+        return True
+
+
+def new_content_scanner() -> Optional[ContentScanner]:
+    """Create a scanner for one upload, or None if scanning is disabled."""
+    if not SCAN_UPLOAD_CONTENT:
+        return None
+    return ContentScanner(UPLOAD_SCAN_PATTERNS)
+
+
 class SecurityValidator:
-    """Validates files and content for security issues."""
+    """Validates files and content for security issues.
 
-    def __init__(self):
-        self.max_file_size = getattr(
-            settings, "VDITOR_MAX_FILE_SIZE", DEFAULT_MAX_FILE_SIZE
-        )
-        self.allowed_extensions = getattr(
-            settings, "VDITOR_ALLOWED_EXTENSIONS", DEFAULT_ALLOWED_EXTENSIONS
-        )
-        self.allowed_mime_types = getattr(
-            settings, "VDITOR_ALLOWED_MIME_TYPES", DEFAULT_ALLOWED_MIME_TYPES
-        )
+    Limits and filename rules come from an upload policy (see
+    ``vditor.policy``), the same ones the upload views apply.
+    """
+
+    def __init__(self, policy=None):
+        if policy is None:
+            from .policy import get_upload_policy
+
+            policy = get_upload_policy()
+        self.policy = policy
+        self.max_file_size = policy.max_file_size
+        self.allowed_extensions = policy.allowed_extensions
+        self.allowed_mime_types = policy.allowed_mime_types
 
     def validate_filename(self, filename: str) -> tuple[bool, str]:
         """Validate filename for security issues.
@@ -104,16 +201,8 @@ class SecurityValidator:
         if file_ext in DANGEROUS_EXTENSIONS:
             return False, _("File type is not allowed for security reasons")
 
-        # Check for suspicious patterns
-        for pattern in SUSPICIOUS_PATTERNS:
-            if re.search(pattern, filename):
-                return False, _("Filename contains suspicious patterns")
-
-        # Check filename length
-        if len(filename) > 255:
-            return False, _("Filename is too long")
-
-        return True, ""
+        # Suspicious patterns, reserved names and length
+        return self.policy.validate_filename(filename)
 
     def validate_file_content(self, content: bytes) -> tuple[bool, str]:
         """Validate file content for security issues.
@@ -127,19 +216,25 @@ class SecurityValidator:
         if not content:
             return False, _("File content is empty")
 
-        # Check for suspicious content patterns
-        dangerous_patterns = [
-            b"<?php",
-            b"<%",
-            b"<script",
-            b"javascript:",
-            b"vbscript:",
-            b"data:text/html",
-        ]
-
-        content_lower = content.lower()
-        for pattern in dangerous_patterns:
-            if pattern in content_lower:
+        return self.validate_file_stream([content])
+
+    def validate_file_stream(
+        self,
+        chunks: Iterable[bytes],
+        patterns: Iterable[bytes] = DANGEROUS_CONTENT_PATTERNS,
+    ) -> tuple[bool, str]:
+        """Validate file content for security issues, chunk by chunk.
+
+        Args:
+            chunks: File content, e.g. ``uploaded_file.chunks()``
+            patterns: Dangerous byte patterns to look for
+
+        Returns:
+            tuple: (is_valid, error_message)
+        """
+        scanner = ContentScanner(patterns)
+        for chunk in chunks:
+            if not scanner.feed(chunk):
                 return False, _("File contains potentially dangerous content")
 
         return True, ""
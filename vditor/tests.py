@@ -13,6 +13,9 @@ from vditor.configs import VditorConfig, get_default_config
 from vditor.fields import VditorTextField, VditorTextFormField
 from django import forms
 
+# Signature and IHDR chunk of a 1x1 PNG, to prefix fake image content
+PNG_HEADER = b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR" + b"\x00\x00\x00\x01" * 2
+
 
 @override_settings(MEDIA_ROOT="/tmp/media", MEDIA_URL="/media/")
 class VditorImagesUploadViewTest(TestCase):
@@ -70,6 +73,557 @@ class VditorImagesUploadViewTest(TestCase):
         self.assertEqual(response.json()["code"], 1)
         self.assertEqual(response.json()["msg"], "No file uploaded.")
 
+    def test_duplicate_upload_is_deduplicated(self):
+        image_content = b"fake_image_content"
+        for expected_msg in ("Success!", "File uploaded successfully (deduplicated)."):
+            image_file = SimpleUploadedFile(
+                "test_image.png", image_content, content_type="image/png"
+            )
+            response = self.client.post(
+                reverse("uploads"), {"file[]": image_file}, format="multipart"
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["msg"], expected_msg)
+
+        # Only the final file remains; temporary files are cleaned up
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT)), 1)
+
+    def test_same_content_under_other_name_is_deduplicated(self):
+        from vditor.models import StoredFile
+
+        image_content = b"fake_image_content"
+        urls = []
+        for name in ("first.png", "second.png"):
+            response = self.client.post(
+                reverse("uploads"),
+                {"file[]": SimpleUploadedFile(name, image_content, "image/png")},
+                format="multipart",
+            )
+            urls.append(response.json()["data"]["succMap"][name])
+
+        self.assertEqual(urls[0], urls[1])
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT)), 1)
+        self.assertEqual(StoredFile.objects.count(), 1)
+
+    def test_indexed_file_missing_is_stored_again(self):
+        image_content = b"fake_image_content"
+        for _attempt in range(2):
+            for name in os.listdir(settings.MEDIA_ROOT):
+                os.remove(os.path.join(settings.MEDIA_ROOT, name))
+            response = self.client.post(
+                reverse("uploads"),
+                {"file[]": SimpleUploadedFile("a.png", image_content, "image/png")},
+                format="multipart",
+            )
+            self.assertEqual(response.json()["msg"], "Success!")
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT)), 1)
+
+    def test_sharded_layout(self):
+        import hashlib
+
+        image_content = b"fake_image_content"
+        content_hash = hashlib.sha256(image_content).hexdigest()
+        with patch("vditor.views.UPLOAD_LAYOUT", "sharded"):
+            response = self.client.post(
+                reverse("uploads"),
+                {"file[]": SimpleUploadedFile("a.png", image_content, "image/png")},
+                format="multipart",
+            )
+
+        stored_name = f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.png"
+        self.assertEqual(
+            response.json()["data"]["succMap"]["a.png"],
+            settings.MEDIA_URL + stored_name,
+        )
+        self.assertTrue(os.path.isfile(os.path.join(settings.MEDIA_ROOT, stored_name)))
+
+    def test_migrate_flat_uploads_to_sharded_layout(self):
+        import hashlib
+        from io import StringIO
+        from django.core.management import call_command
+        from vditor.models import StoredFile
+        from vditor_app.models import VditorTest
+
+        image_content = b"fake_image_content"
+        content_hash = hashlib.sha256(image_content).hexdigest()
+        response = self.client.post(
+            reverse("uploads"),
+            {"file[]": SimpleUploadedFile("a.png", image_content, "image/png")},
+            format="multipart",
+        )
+        flat_url = response.json()["data"]["succMap"]["a.png"]
+        # Same content stored under another name before content dedup
+        flat_copy = f"{content_hash[:16]}_b.png"
+        with open(os.path.join(settings.MEDIA_ROOT, flat_copy), "wb") as f:
+            f.write(image_content)
+        post = VditorTest.objects.create(
+            name="post",
+            content=f"![a]({flat_url}) ![b]({settings.MEDIA_URL}{flat_copy})",
+        )
+
+        with patch("vditor.views.UPLOAD_LAYOUT", "sharded"):
+            call_command("vditor_migrate_layout", batch_size=1, stdout=StringIO())
+
+        stored_name = f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.png"
+        new_url = settings.MEDIA_URL + stored_name
+        post.refresh_from_db()
+        self.assertEqual(post.content, f"![a]({new_url}) ![b]({new_url})")
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), [content_hash[:2]])
+        self.assertEqual(StoredFile.objects.get().name, stored_name)
+
+    def _png(self, width, height):
+        from io import BytesIO
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new("RGB", (width, height), (200, 30, 30)).save(buffer, "PNG")
+        return buffer.getvalue()
+
+    @patch("vditor.derivatives.DERIVATIVE_WORKERS", 0)
+    @patch("vditor.derivatives.DERIVATIVE_WIDTHS", (100, 400))
+    def test_derivatives_generated_from_task_table(self):
+        import hashlib
+        from io import StringIO
+        from django.core.management import call_command
+        from vditor.models import DerivativeTask, ImageDerivative
+
+        try:
+            image_content = self._png(200, 100)
+        except ImportError:
+            self.skipTest("Pillow is not installed")
+        content_hash = hashlib.sha256(image_content).hexdigest()
+        self.client.post(
+            reverse("uploads"),
+            {"file[]": SimpleUploadedFile("shot.png", image_content, "image/png")},
+            format="multipart",
+        )
+        self.assertEqual(DerivativeTask.objects.get().status, "pending")
+
+        call_command("vditor_derivatives", stdout=StringIO())
+
+        self.assertEqual(DerivativeTask.objects.get().status, "done")
+        # Narrower widths only; the original serves the widest candidate
+        derivative = ImageDerivative.objects.get()
+        self.assertEqual((derivative.width, derivative.format), (100, "webp"))
+        with open(os.path.join(settings.MEDIA_ROOT, derivative.name), "rb") as f:
+            self.assertEqual(f.read(4), b"RIFF")
+
+        response = self.client.get(reverse("uploads_by_hash", args=[content_hash]))
+        self.assertEqual(
+            response.json()["data"]["srcset"],
+            f"{settings.MEDIA_URL}{derivative.name} 100w",
+        )
+
+    @patch("vditor.derivatives.DERIVATIVE_WORKERS", 0)
+    @patch("vditor.derivatives.DERIVATIVE_WIDTHS", (100,))
+    def test_failed_derivative_task_is_retried(self):
+        from vditor.derivatives import process_task, queue_derivatives
+        from vditor.models import DerivativeTask
+
+        task = queue_derivatives("ab" * 32, "missing.png")
+        self.assertFalse(process_task(task.pk))
+
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ("pending", 1))
+        self.assertTrue(task.error)
+        self.assertIsNone(queue_derivatives("cd" * 32, "animation.gif"))
+        self.assertEqual(DerivativeTask.objects.count(), 1)
+
+    @patch("vditor.derivatives.DERIVATIVE_WORKERS", 1)
+    @patch("vditor.derivatives.DERIVATIVE_WIDTHS", (100,))
+    def test_failed_task_resubmitted_by_worker(self):
+        from vditor.derivatives import _run_task
+        from vditor.models import DerivativeTask
+
+        task = DerivativeTask.objects.create(
+            content_hash="ab" * 32, name="missing.png", kind="derivatives"
+        )
+        with (
+            patch("vditor.derivatives._get_executor") as get_executor,
+            patch("vditor.derivatives.connections"),
+        ):
+            executor = get_executor.return_value
+            _run_task(task.pk)
+            executor.submit.assert_called_once_with(_run_task, task.pk)
+
+            DerivativeTask.objects.filter(pk=task.pk).update(attempts=2)
+            executor.reset_mock()
+            _run_task(task.pk)
+            executor.submit.assert_not_called()
+
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ("failed", 3))
+
+    @patch("vditor.derivatives.DERIVATIVE_WORKERS", 0)
+    @patch("vditor.derivatives.DERIVATIVE_WIDTHS", ())
+    @patch("vditor.optimize.OPTIMIZE_IMAGES", True)
+    def test_command_drains_optimize_tasks_without_widths(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from vditor.models import DerivativeTask
+
+        task = DerivativeTask.objects.create(
+            content_hash="ab" * 32, name="missing.png", kind="optimize"
+        )
+        with patch("vditor.optimize.optimize_stored_file") as optimize_stored_file:
+            call_command("vditor_derivatives", stdout=StringIO())
+
+        optimize_stored_file.assert_called_once_with("ab" * 32, "missing.png")
+        task.refresh_from_db()
+        self.assertEqual(task.status, "done")
+
+    def test_upload_reads_file_once(self):
+        from vditor.views import _store_uploaded_file
+        from pathlib import Path
+
+        image_file = SimpleUploadedFile(
+            "test_image.png", b"fake_image_content", content_type="image/png"
+        )
+        with patch.object(
+            image_file, "chunks", wraps=image_file.chunks
+        ) as mocked_chunks:
+            unique_filename, deduplicated, bytes_written = _store_uploaded_file(
+                image_file, Path(settings.MEDIA_ROOT), "test_image", ".png"
+            )
+
+        self.assertEqual(mocked_chunks.call_count, 1)
+        self.assertFalse(deduplicated)
+        self.assertEqual(bytes_written, len(b"fake_image_content"))
+        self.assertTrue(unique_filename.endswith("_test_image.png"))
+
+    def _temporary_upload(self, content):
+        from django.core.files.uploadedfile import TemporaryUploadedFile
+
+        upload = TemporaryUploadedFile(
+            "test_image.png", "image/png", len(content), None
+        )
+        upload.write(content)
+        upload.seek(0)
+        self.addCleanup(upload.close)
+        return upload
+
+    def test_temporary_upload_is_linked_into_place(self):
+        from vditor.views import _store_uploaded_file
+        from pathlib import Path
+
+        upload = self._temporary_upload(b"fake_image_content")
+        source_inode = os.stat(upload.temporary_file_path()).st_ino
+        unique_filename, deduplicated, _ = _store_uploaded_file(
+            upload, Path(settings.MEDIA_ROOT), "test_image", ".png"
+        )
+
+        stored = os.path.join(settings.MEDIA_ROOT, unique_filename)
+        self.assertFalse(deduplicated)
+        if os.stat(stored).st_dev == os.stat(upload.temporary_file_path()).st_dev:
+            self.assertEqual(os.stat(stored).st_ino, source_inode)
+        with open(stored, "rb") as f:
+            self.assertEqual(f.read(), b"fake_image_content")
+
+    def test_temporary_upload_cross_device_copy(self):
+        import errno
+        from vditor.views import _store_uploaded_file
+        from pathlib import Path
+
+        upload = self._temporary_upload(b"fake_image_content")
+        with patch("vditor.views.os.link", side_effect=OSError(errno.EXDEV, "")):
+            unique_filename, deduplicated, bytes_written = _store_uploaded_file(
+                upload, Path(settings.MEDIA_ROOT), "test_image", ".png"
+            )
+
+        self.assertFalse(deduplicated)
+        self.assertEqual(bytes_written, len(b"fake_image_content"))
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), [unique_filename])
+        with open(os.path.join(settings.MEDIA_ROOT, unique_filename), "rb") as f:
+            self.assertEqual(f.read(), b"fake_image_content")
+
+    def test_batch_upload_processes_every_file(self):
+        files = [
+            SimpleUploadedFile(f"image_{i}.png", b"content %d" % i * 4, "image/png")
+            for i in range(3)
+        ]
+        files.append(SimpleUploadedFile("script.exe", b"x" * 100, "image/png"))
+
+        response = self.client.post(
+            reverse("uploads"), {"file[]": files}, format="multipart"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["code"], 0)
+        self.assertEqual(
+            sorted(data["data"]["succMap"]),
+            ["image_0.png", "image_1.png", "image_2.png"],
+        )
+        self.assertEqual(data["data"]["errFiles"], ["script.exe"])
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT)), 3)
+
+    def test_batch_upload_all_rejected(self):
+        files = [
+            SimpleUploadedFile(f"script_{i}.exe", b"x" * 100, "image/png")
+            for i in range(2)
+        ]
+
+        response = self.client.post(
+            reverse("uploads"), {"file[]": files}, format="multipart"
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["code"], 1)
+        self.assertEqual(
+            response.json()["data"]["errFiles"], ["script_0.exe", "script_1.exe"]
+        )
+
+    def test_async_upload_matches_sync_contract(self):
+        files = [
+            SimpleUploadedFile("image_0.png", b"content 0" * 4, "image/png"),
+            SimpleUploadedFile("script.exe", b"x" * 100, "image/png"),
+        ]
+
+        response = self.client.post(
+            reverse("uploads_async"), {"file[]": files}, format="multipart"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["code"], 0)
+        self.assertEqual(list(data["data"]["succMap"]), ["image_0.png"])
+        self.assertEqual(data["data"]["errFiles"], ["script.exe"])
+
+    def test_async_upload_metrics_recorded_off_event_loop(self):
+        import asyncio
+
+        on_loop = []
+
+        def record(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                on_loop.append(False)
+            else:
+                on_loop.append(True)
+
+        files = [
+            SimpleUploadedFile("script.exe", b"x" * 100, "image/png"),
+            SimpleUploadedFile("empty.png", b"", "image/png"),
+        ]
+        with (
+            patch("vditor.views.record_rejection", side_effect=record),
+            patch("vditor.views.update_upload_metrics", side_effect=record),
+        ):
+            response = self.client.post(
+                reverse("uploads_async"), {"file[]": files}, format="multipart"
+            )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(on_loop)
+        self.assertNotIn(True, on_loop)
+
+    def test_async_no_file_uploaded(self):
+        response = self.client.post(reverse("uploads_async"))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["msg"], "No file uploaded.")
+
+    def test_raw_body_upload(self):
+        image_content = PNG_HEADER + b"raw_image_content" * 8000
+
+        response = self.client.put(
+            reverse("uploads_raw", args=["raw_image.png"]),
+            data=image_content,
+            content_type="application/octet-stream",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["code"], 0)
+        file_url = data["data"]["succMap"]["raw_image.png"]
+        stored_name = file_url.rsplit("/", 1)[-1]
+        with open(os.path.join(settings.MEDIA_ROOT, stored_name), "rb") as f:
+            self.assertEqual(f.read(), image_content)
+
+    def _storage_settings(self):
+        return override_settings(
+            STORAGES={
+                **settings.STORAGES,
+                "vditor": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+            }
+        )
+
+    def test_upload_to_storage_backend(self):
+        from django.core.files.storage import storages
+
+        image_content = b"fake_image_content"
+        with self._storage_settings(), patch("vditor.views.UPLOAD_STORAGE", "vditor"):
+            urls = []
+            for name in ("a.png", "b.png"):
+                response = self.client.post(
+                    reverse("uploads"),
+                    {"file[]": SimpleUploadedFile(name, image_content, "image/png")},
+                    format="multipart",
+                )
+                urls.append(response.json()["data"]["succMap"][name])
+            storage = storages["vditor"]
+            stored_name = urls[0][len(settings.MEDIA_URL) :]
+            with storage.open(stored_name) as f:
+                self.assertEqual(f.read(), image_content)
+
+        self.assertEqual(urls[0], urls[1])
+        self.assertEqual(
+            response.json()["msg"], "File uploaded successfully (deduplicated)."
+        )
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), [])
+
+    def test_raw_body_upload_to_storage_backend(self):
+        from django.core.files.storage import storages
+
+        image_content = PNG_HEADER + b"raw_image_content" * 8000
+        with self._storage_settings(), patch("vditor.views.UPLOAD_STORAGE", "vditor"):
+            response = self.client.put(
+                reverse("uploads_raw", args=["raw_image.png"]),
+                data=image_content,
+                content_type="image/png",
+            )
+            file_url = response.json()["data"]["succMap"]["raw_image.png"]
+            with storages["vditor"].open(file_url[len(settings.MEDIA_URL) :]) as f:
+                self.assertEqual(f.read(), image_content)
+
+    def test_upload_reports_dimensions(self):
+        import struct
+
+        header = b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR"
+        image = header + struct.pack(">II", 64, 32) + b"\x08\x02" + b"x" * 100
+        bomb = header + struct.pack(">II", 50000, 50000) + b"\x08\x02" + b"x" * 100
+        response = self.client.post(
+            reverse("uploads"),
+            {
+                "file[]": [
+                    SimpleUploadedFile("image.png", image, "image/png"),
+                    SimpleUploadedFile("bomb.png", bomb, "image/png"),
+                ]
+            },
+            format="multipart",
+        )
+
+        data = response.json()["data"]
+        self.assertEqual(data["dimensions"], {"image.png": {"width": 64, "height": 32}})
+        self.assertEqual(data["errFiles"], ["bomb.png"])
+
+    @patch("vditor.views.STREAMING_VALIDATION", False)
+    def test_decompression_bomb_rejected(self):
+        import struct
+
+        bomb = (
+            b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR"
+            + struct.pack(">II", 50000, 50000)
+            + b"\x08\x02"
+            + b"x" * 100
+        )
+        response = self.client.post(
+            reverse("uploads"),
+            {"file[]": SimpleUploadedFile("bomb.png", bomb, "image/png")},
+            format="multipart",
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("exceed the maximum allowed", response.json()["msg"])
+
+    def test_jpeg_bomb_behind_metadata_rejected(self):
+        import struct
+
+        app1 = b"\xff\xe1" + struct.pack(">H", 65535) + b"x" * 65533
+        bomb = (
+            b"\xff\xd8"
+            + app1
+            + b"\xff\xc0\x00\x11\x08"
+            + struct.pack(">HH", 60000, 60000)
+            + b"x" * 100
+        )
+        for streaming in (True, False):
+            with patch("vditor.views.STREAMING_VALIDATION", streaming):
+                response = self.client.post(
+                    reverse("uploads"),
+                    {"file[]": SimpleUploadedFile("bomb.jpg", bomb, "image/jpeg")},
+                    format="multipart",
+                )
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("exceed the maximum allowed", response.json()["msg"])
+
+        response = self.client.put(
+            reverse("uploads_raw", args=["bomb.jpg"]),
+            data=bomb,
+            content_type="image/jpeg",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("exceed the maximum allowed", response.json()["msg"])
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), [])
+
+    def test_unreadable_image_dimensions_rejected(self):
+        response = self.client.post(
+            reverse("uploads"),
+            {
+                "file[]": SimpleUploadedFile(
+                    "image.png", b"\x89PNG\r\n\x1a\n" + b"x" * 100, "image/png"
+                )
+            },
+            format="multipart",
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["msg"], "Image dimensions could not be read.")
+
+    def test_raw_body_upload_validated(self):
+        response = self.client.put(
+            reverse("uploads_raw", args=["raw_image.jpg"]),
+            data=PNG_HEADER + b"x" * 100,
+            content_type="image/jpeg",
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()["msg"], "File extension does not match file content."
+        )
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), [])
+
+    def test_streaming_rejection_reported(self):
+        files = [
+            SimpleUploadedFile("photo.jpg", PNG_HEADER + b"x" * 100, "image/jpeg"),
+            SimpleUploadedFile("image.png", b"valid content" * 4, "image/png"),
+        ]
+
+        response = self.client.post(
+            reverse("uploads"), {"file[]": files}, format="multipart"
+        )
+
+        data = response.json()
+        self.assertEqual(data["code"], 0)
+        self.assertEqual(list(data["data"]["succMap"]), ["image.png"])
+        self.assertEqual(data["data"]["errFiles"], ["photo.jpg"])
+
+    def test_lookup_by_content_hash(self):
+        import hashlib
+
+        image_content = b"fake_image_content"
+        content_hash = hashlib.sha256(image_content).hexdigest()
+        lookup_url = reverse("uploads_by_hash", args=[content_hash])
+
+        self.assertEqual(self.client.get(lookup_url).status_code, 404)
+
+        upload = self.client.post(
+            reverse("uploads"),
+            {"file[]": SimpleUploadedFile("logo.png", image_content, "image/png")},
+            format="multipart",
+        )
+        response = self.client.get(lookup_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["data"]["url"],
+            upload.json()["data"]["succMap"]["logo.png"],
+        )
+        self.assertEqual(self.client.head(lookup_url).status_code, 200)
+
+    def test_lookup_by_invalid_hash(self):
+        response = self.client.get(reverse("uploads_by_hash", args=["not-a-hash"]))
+        self.assertEqual(response.status_code, 400)
+
     def test_file_save_error(self):
         image_content = b"fake_image_content"
         image_file = SimpleUploadedFile(
@@ -88,6 +642,1325 @@ class VditorImagesUploadViewTest(TestCase):
         self.assertIn("Failed to", response.json()["msg"])
 
 
+class VditorContentIndexTest(TestCase):
+    """Test the persistent content hash index."""
+
+    def setUp(self):
+        from vditor.dedup import content_index
+
+        content_index.reset()
+        self.addCleanup(content_index.reset)
+
+    def test_bloom_filter_membership(self):
+        import hashlib
+        from vditor.dedup import BloomFilter
+
+        bloom = BloomFilter(1000, 0.01)
+        added = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(100)]
+        for content_hash in added:
+            bloom.add(content_hash)
+
+        self.assertTrue(all(content_hash in bloom for content_hash in added))
+        absent = [hashlib.sha256(f"x{i}".encode()).hexdigest() for i in range(1000)]
+        false_positives = sum(content_hash in bloom for content_hash in absent)
+        self.assertLess(false_positives, 50)
+
+    def test_record_and_lookup(self):
+        from vditor.dedup import content_index
+
+        content_hash = "ab" * 32
+        self.assertIsNone(content_index.lookup(content_hash))
+        self.assertFalse(content_index.might_contain(content_hash))
+
+        self.assertEqual(content_index.record(content_hash, "a.png", 10), "a.png")
+        self.assertEqual(content_index.lookup(content_hash), "a.png")
+        # A concurrent record of the same content keeps the first name
+        self.assertEqual(content_index.record(content_hash, "b.png", 10), "a.png")
+
+        content_index.forget(content_hash)
+        self.assertIsNone(content_index.lookup(content_hash))
+
+
+class VditorOptimizeTest(TestCase):
+    """Test lossless size reduction of stored images."""
+
+    def _png_chunk(self, chunk_type, data):
+        import struct
+        import zlib
+
+        return (
+            struct.pack(">I", len(data))
+            + chunk_type
+            + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data))
+        )
+
+    def _png(self, text=b""):
+        import struct
+        import zlib
+
+        width, height = 16, 16
+        raw = b"".join(b"\0" + b"\x80" * width * 3 for _row in range(height))
+        chunks = [
+            self._png_chunk(
+                b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+            )
+        ]
+        if text:
+            chunks.append(self._png_chunk(b"tEXt", b"Comment\0" + text))
+        chunks.append(self._png_chunk(b"IDAT", zlib.compress(raw, 0)))
+        chunks.append(self._png_chunk(b"IEND", b""))
+        return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+    def test_png_metadata_stripped_and_recompressed(self):
+        import zlib
+        from vditor.optimize import optimize_image
+
+        original = self._png(text=b"x" * 500)
+        optimized = optimize_image(original)
+
+        self.assertLess(len(optimized), len(original))
+        self.assertNotIn(b"tEXt", optimized)
+
+        def image_data(png):
+            idat = png.index(b"IDAT")
+            length = int.from_bytes(png[idat - 4 : idat], "big")
+            return zlib.decompress(png[idat + 4 : idat + 4 + length])
+
+        self.assertEqual(image_data(optimized), image_data(original))
+        # Already optimal content is returned unchanged
+        self.assertIs(optimize_image(optimized), optimized)
+
+    def test_jpeg_metadata_stripped_keeping_orientation(self):
+        from io import BytesIO
+        from vditor.optimize import optimize_image
+
+        try:
+            from PIL import Image
+        except ImportError:
+            self.skipTest("Pillow is not installed")
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation
+        exif[0x010E] = "x" * 2000  # ImageDescription
+        buffer = BytesIO()
+        Image.new("RGB", (32, 16), (10, 20, 30)).save(
+            buffer, "JPEG", exif=exif, comment=b"comment"
+        )
+        original = buffer.getvalue()
+        optimized = optimize_image(original)
+
+        self.assertLess(len(optimized), len(original) - 2000)
+        self.assertNotIn(b"comment", optimized)
+        image = Image.open(BytesIO(optimized))
+        self.assertEqual(dict(image.getexif()), {0x0112: 6})
+        # Scan data is copied byte for byte
+        self.assertTrue(original.endswith(optimized[optimized.index(b"\xff\xda") :]))
+
+    def test_png_data_size_read_from_ihdr(self):
+        from vditor.optimize import png_data_size
+
+        # 16 rows of a filter byte and 16 RGB pixels
+        self.assertEqual(png_data_size(self._png()), 16 * (1 + 16 * 3))
+        self.assertIsNone(png_data_size(b"\xff\xd8\xff\xe0" + b"\0" * 30))
+
+    @patch("vditor.optimize.OPTIMIZE_IMAGES", True)
+    @patch("vditor.derivatives.DERIVATIVE_WORKERS", 0)
+    @override_settings(MEDIA_ROOT="/tmp/media-optimize")
+    def test_small_png_with_large_image_data_queued(self):
+        import shutil
+        import struct
+        import zlib
+        from vditor.models import DerivativeTask
+        from vditor.optimize import optimize_new_upload
+
+        os.makedirs(settings.MEDIA_ROOT)
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+        # 4096x4096 RGBA decompresses to 64MB but compresses to a few KB
+        ihdr = struct.pack(">IIBBBBB", 4096, 4096, 8, 6, 0, 0, 0)
+        content = (
+            b"\x89PNG\r\n\x1a\n"
+            + self._png_chunk(b"IHDR", ihdr)
+            + self._png_chunk(b"tEXt", b"Comment\0" + b"x" * 500)
+            + self._png_chunk(b"IDAT", zlib.compress(b"\0" * 1024))
+            + self._png_chunk(b"IEND", b"")
+        )
+        path = os.path.join(settings.MEDIA_ROOT, "image.png")
+        with open(path, "wb") as f:
+            f.write(content)
+
+        optimize_new_upload("ab" * 32, "image.png", len(content))
+
+        self.assertEqual(DerivativeTask.objects.get().kind, "optimize")
+        self.assertEqual(os.path.getsize(path), len(content))
+
+    @patch("vditor.optimize.OPTIMIZE_IMAGES", True)
+    @override_settings(MEDIA_ROOT="/tmp/media-optimize", MEDIA_URL="/media/")
+    def test_upload_optimized_inline_and_still_deduplicated(self):
+        import shutil
+
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+        original = self._png(text=b"x" * 500)
+        responses = [
+            self.client.post(
+                reverse("uploads"),
+                {"file[]": SimpleUploadedFile(name, original, "image/png")},
+                format="multipart",
+            ).json()
+            for name in ("a.png", "b.png")
+        ]
+
+        self.assertEqual(
+            responses[1]["data"]["succMap"]["b.png"],
+            responses[0]["data"]["succMap"]["a.png"],
+        )
+        stored_name = responses[0]["data"]["succMap"]["a.png"][len("/media/") :]
+        with open(os.path.join(settings.MEDIA_ROOT, stored_name), "rb") as f:
+            stored = f.read()
+        self.assertLess(len(stored), len(original))
+        self.assertNotIn(b"tEXt", stored)
+
+    @override_settings(MEDIA_ROOT="/tmp/media-optimize")
+    def test_optimize_command(self):
+        import hashlib
+        import shutil
+        from io import StringIO
+        from django.core.management import call_command
+        from vditor.dedup import content_index
+        from vditor.models import StoredFile
+
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, "ab"))
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+        original = self._png(text=b"x" * 500)
+        paths = {}
+        for name in ("image.png", "foreign.png"):
+            paths[name] = os.path.join(settings.MEDIA_ROOT, "ab", name)
+            with open(paths[name], "wb") as f:
+                f.write(original)
+        content_hash = hashlib.sha256(original).hexdigest()
+        StoredFile.objects.create(
+            content_hash=content_hash, name="ab/image.png", size=len(original)
+        )
+
+        out = StringIO()
+        call_command("vditor_optimize", dry_run=True, stdout=out)
+        self.assertIn("Would save", out.getvalue())
+        self.assertEqual(os.path.getsize(paths["image.png"]), len(original))
+
+        call_command("vditor_optimize", stdout=StringIO())
+        size = os.path.getsize(paths["image.png"])
+        self.assertLess(size, len(original))
+        self.assertEqual(StoredFile.objects.get(content_hash=content_hash).size, size)
+        with open(paths["image.png"], "rb") as f:
+            optimized_hash = hashlib.sha256(f.read()).hexdigest()
+        self.assertEqual(content_index.lookup(optimized_hash), "ab/image.png")
+        # Files the app did not store are left alone
+        self.assertEqual(os.path.getsize(paths["foreign.png"]), len(original))
+
+
+class VditorUploadHandlerTest(TestCase):
+    """Test streaming validation while the upload is received."""
+
+    def _handler(self, file_name, content_type="image/png", content_length=None):
+        from django.test import RequestFactory
+        from vditor.uploadhandler import VditorUploadHandler
+
+        request = RequestFactory().post("/")
+        handler = VditorUploadHandler(request)
+        handler.new_file("file[]", file_name, content_type, content_length)
+        return request, handler
+
+    def test_hash_computed_while_streaming(self):
+        import hashlib
+
+        content = PNG_HEADER + b"x" * 100
+        request, handler = self._handler("image.png")
+        self.assertEqual(handler.receive_data_chunk(content[:40], 0), content[:40])
+        handler.receive_data_chunk(content[40:], 40)
+        self.assertIsNone(handler.file_complete(len(content)))
+
+        self.assertEqual(
+            request.vditor_upload_digests[("file[]", "image.png", len(content))],
+            [hashlib.sha256(content).hexdigest()],
+        )
+
+    def test_wrong_magic_skipped_on_first_chunk(self):
+        from django.core.files.uploadhandler import SkipFile
+
+        request, handler = self._handler("image.jpg", "image/jpeg")
+        with self.assertRaises(SkipFile):
+            handler.receive_data_chunk(PNG_HEADER + b"x" * 100, 0)
+        self.assertEqual(
+            request.vditor_upload_errors["image.jpg"],
+            "File extension does not match file content.",
+        )
+
+    def test_oversized_upload_aborted(self):
+        from django.core.files.uploadhandler import StopUpload
+
+        request, handler = self._handler("image.png")
+        handler.max_file_size = 100
+        handler.receive_data_chunk(b"x" * 64, 0)
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b"x" * 64, 64)
+        self.assertIn("image.png", request.vditor_upload_errors)
+
+    def test_decompression_bomb_skipped(self):
+        import struct
+        from django.core.files.uploadhandler import SkipFile
+
+        header = b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR" + struct.pack(
+            ">II", 50000, 50000
+        )
+        request, handler = self._handler("bomb.png")
+        with self.assertRaises(SkipFile):
+            handler.receive_data_chunk(header + b"\x08\x02" + b"x" * 100, 0)
+        self.assertIn("50000x50000", request.vditor_upload_errors["bomb.png"])
+
+    @patch("vditor.security.SCAN_UPLOAD_CONTENT", True)
+    def test_dangerous_content_skipped_across_chunks(self):
+        from django.core.files.uploadhandler import SkipFile
+
+        request, handler = self._handler("image.png")
+        handler.receive_data_chunk(PNG_HEADER + b"x" * 100 + b"<scr", 0)
+        with self.assertRaises(SkipFile):
+            handler.receive_data_chunk(b"ipt>alert(1)</script>", 112)
+        self.assertEqual(
+            request.vditor_upload_errors["image.png"],
+            "File contains potentially dangerous content.",
+        )
+
+
+class VditorMemoryBudgetTest(TestCase):
+    """Test spooling uploads to disk once the memory budget is used up."""
+
+    def _handler(self, budget, file_name="image.png"):
+        from vditor.uploadhandler import MemoryBudgetUploadHandler
+
+        handler = MemoryBudgetUploadHandler(budget=budget)
+        handler.new_file("file[]", file_name, "image/png", None)
+        return handler
+
+    def test_upload_kept_in_memory_within_budget(self):
+        from django.core.files.uploadedfile import InMemoryUploadedFile
+        from vditor.uploadhandler import MemoryBudget
+
+        budget = MemoryBudget(1024)
+        handler = self._handler(budget)
+        handler.receive_data_chunk(b"x" * 100, 0)
+        uploaded = handler.file_complete(100)
+
+        self.assertIsInstance(uploaded, InMemoryUploadedFile)
+        self.assertEqual(uploaded.read(), b"x" * 100)
+        self.assertEqual(budget.gauges()["in_memory_bytes"], 100)
+        uploaded.close()
+        self.assertEqual(budget.gauges()["in_memory_bytes"], 0)
+        self.assertEqual(budget.gauges()["peak_in_memory_bytes"], 100)
+
+    def test_upload_spilled_once_budget_used_up(self):
+        import tempfile
+        from django.core.files.uploadedfile import TemporaryUploadedFile
+        from vditor.uploadhandler import MemoryBudget
+
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, spool_dir)
+        budget = MemoryBudget(150)
+        with patch("vditor.uploadhandler.UPLOAD_SPOOL_DIR", spool_dir):
+            handler = self._handler(budget)
+            handler.receive_data_chunk(b"a" * 100, 0)
+            handler.receive_data_chunk(b"b" * 100, 100)
+            uploaded = handler.file_complete(200)
+
+        self.assertIsInstance(uploaded, TemporaryUploadedFile)
+        self.assertEqual(os.path.dirname(uploaded.temporary_file_path()), spool_dir)
+        self.assertEqual(uploaded.read(), b"a" * 100 + b"b" * 100)
+        self.assertEqual(budget.gauges()["in_memory_bytes"], 0)
+        self.assertEqual(budget.gauges()["spilled_files"], 1)
+        uploaded.close()
+
+    @override_settings(MEDIA_ROOT="/tmp/media-budget", MEDIA_URL="/media/")
+    def test_upload_view_releases_budget(self):
+        import shutil
+        from vditor.uploadhandler import MemoryBudget
+
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+        budget = MemoryBudget(1024)
+        image_file = SimpleUploadedFile(
+            "image.png", PNG_HEADER + b"x" * 100, content_type="image/png"
+        )
+        with patch("vditor.uploadhandler.upload_memory_budget", budget):
+            response = self.client.post(reverse("uploads"), {"file[]": image_file})
+
+        self.assertEqual(response.json()["code"], 0)
+        self.assertEqual(budget.gauges()["peak_in_memory_bytes"], 124)
+        self.assertEqual(budget.gauges()["in_memory_bytes"], 0)
+
+
+@override_settings(MEDIA_ROOT="/tmp/media-admission", MEDIA_URL="/media/")
+class VditorAdmissionTest(TestCase):
+    """Test admission control of the upload endpoints."""
+
+    def setUp(self):
+        import shutil
+
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+
+    def test_full_queue_rejected(self):
+        from vditor.admission import AdmissionController
+
+        controller = AdmissionController(limit=1, queue_size=0, queue_timeout=1.0)
+        admission = controller.acquire()
+        self.assertIsNotNone(admission)
+        self.assertIsNone(controller.acquire())
+
+        controller.release(admission)
+        self.assertIsNotNone(controller.acquire())
+        gauges = controller.gauges()
+        self.assertEqual(gauges["admitted"], 2)
+        self.assertEqual(gauges["rejected"], 1)
+        self.assertEqual(gauges["active"], 1)
+
+    def test_waiting_request_admitted_when_slot_freed(self):
+        import threading
+        import time
+        from vditor.admission import AdmissionController
+
+        controller = AdmissionController(limit=1, queue_size=1, queue_timeout=5.0)
+        admission = controller.acquire()
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(controller.acquire()))
+        waiter.start()
+        while controller.gauges()["queue_depth"] == 0:
+            time.sleep(0.001)
+        controller.release(admission)
+        waiter.join()
+
+        self.assertIsNotNone(results[0])
+        self.assertEqual(controller.gauges()["max_queue_depth"], 1)
+        self.assertGreater(controller.gauges()["max_wait_time"], 0)
+
+    def test_wait_times_out(self):
+        from vditor.admission import AdmissionController
+
+        controller = AdmissionController(limit=1, queue_size=1, queue_timeout=0.01)
+        controller.acquire()
+        self.assertIsNone(controller.acquire())
+        self.assertEqual(controller.gauges()["queue_depth"], 0)
+
+    def test_global_slots_shared_through_cache(self):
+        from vditor.admission import AdmissionController
+
+        first = AdmissionController(2, 0, 0.01, global_limit=1)
+        second = AdmissionController(2, 0, 0.01, global_limit=1)
+        admission = first.acquire()
+        self.assertIsNotNone(admission.slot_key)
+        self.assertIsNone(second.acquire())
+
+        first.release(admission)
+        second.release(second.acquire())
+
+    def test_busy_upload_view_returns_retry_after(self):
+        from vditor.admission import AdmissionController
+
+        controller = AdmissionController(limit=0, queue_size=0, queue_timeout=0)
+        image_file = SimpleUploadedFile(
+            "a.png", PNG_HEADER + b"x" * 100, content_type="image/png"
+        )
+        with patch("vditor.admission.upload_admission", controller):
+            response = self.client.post(reverse("uploads"), {"file[]": image_file})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(response.json()["code"], 1)
+
+    def test_slot_taken_after_body_received(self):
+        from vditor import views
+        from vditor.admission import AdmissionController
+
+        controller = AdmissionController(limit=1, queue_size=0, queue_timeout=0)
+        image_file = SimpleUploadedFile(
+            "a.png", PNG_HEADER + b"x" * 100, content_type="image/png"
+        )
+        active_after_parsing = []
+        original = views._streamed_upload_results
+
+        def streamed_upload_results(*args):
+            active_after_parsing.append(controller.gauges()["active"])
+            return original(*args)
+
+        with (
+            patch("vditor.admission.upload_admission", controller),
+            patch("vditor.views._streamed_upload_results", streamed_upload_results),
+        ):
+            response = self.client.post(reverse("uploads"), {"file[]": image_file})
+            # Requests without files never take a slot
+            self.client.post(reverse("uploads"))
+
+        self.assertEqual(response.json()["code"], 0)
+        self.assertEqual(active_after_parsing, [0, 0])
+        self.assertEqual(controller.gauges()["admitted"], 1)
+
+    def test_raw_upload_slot_taken_after_body_received(self):
+        from vditor.admission import AdmissionController
+        from vditor.views import RequestBodyUpload
+
+        controller = AdmissionController(limit=1, queue_size=0, queue_timeout=0)
+        active_while_receiving = []
+        original = RequestBodyUpload.chunks
+
+        def chunks(upload, *args):
+            for chunk in original(upload, *args):
+                active_while_receiving.append(controller.gauges()["active"])
+                yield chunk
+
+        with (
+            patch("vditor.admission.upload_admission", controller),
+            patch.object(RequestBodyUpload, "chunks", chunks),
+        ):
+            response = self.client.put(
+                reverse("uploads_raw", args=["a.png"]),
+                data=PNG_HEADER + b"x" * 200000,
+                content_type="image/png",
+            )
+
+        self.assertEqual(response.json()["code"], 0)
+        self.assertTrue(active_while_receiving)
+        self.assertEqual(set(active_while_receiving), {0})
+        self.assertEqual(controller.gauges()["admitted"], 1)
+
+
+class VditorRateLimitTest(TestCase):
+    """Test per-client upload rate limiting on the LocMem cache."""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+
+    @patch("vditor.ratelimit.RATE_LIMIT_REQUESTS", 2)
+    def test_request_limit(self):
+        from vditor.ratelimit import check_rate_limit
+
+        self.assertIsNone(check_rate_limit("ip:10.0.0.1", 0))
+        self.assertIsNone(check_rate_limit("ip:10.0.0.1", 0))
+        retry_after = check_rate_limit("ip:10.0.0.1", 0)
+        self.assertGreaterEqual(retry_after, 1)
+        # Other clients have their own budget
+        self.assertIsNone(check_rate_limit("ip:10.0.0.2", 0))
+
+    @patch("vditor.ratelimit.RATE_LIMIT_REQUESTS", 2)
+    @patch("vditor.ratelimit.RATE_LIMIT_CACHE", "dummy")
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "dummy": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+        }
+    )
+    def test_fails_open_on_dummy_cache(self):
+        from vditor.ratelimit import check_rate_limit
+
+        with self.assertLogs("vditor.ratelimit", "WARNING"):
+            self.assertIsNone(check_rate_limit("ip:10.0.0.1", 0))
+
+    @patch("vditor.ratelimit.RATE_LIMIT_BYTES", 1000)
+    def test_byte_limit_rejects_before_parsing(self):
+        with patch("vditor.views._process_uploads") as process_uploads:
+            response = self.client.post(
+                reverse("uploads"),
+                {"file[]": SimpleUploadedFile("a.png", b"x" * 2000)},
+            )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        process_uploads.assert_not_called()
+
+    @patch("vditor.ratelimit.RATE_LIMIT_BYTES", 1000)
+    def test_rejected_request_not_counted(self):
+        from vditor.ratelimit import check_rate_limit
+
+        self.assertIsNotNone(check_rate_limit("user:1", 2000))
+        self.assertIsNone(check_rate_limit("user:1", 900))
+
+    def test_client_address_behind_trusted_proxy(self):
+        import ipaddress
+        from django.test import RequestFactory
+        from vditor.ratelimit import get_client_address, get_client_key
+
+        factory = RequestFactory()
+        request = factory.post(
+            "/",
+            REMOTE_ADDR="10.0.0.5",
+            HTTP_X_FORWARDED_FOR="203.0.113.7, 10.0.0.9",
+        )
+        # Untrusted peers cannot choose their address
+        self.assertEqual(get_client_address(request), "10.0.0.5")
+
+        proxies = (ipaddress.ip_network("10.0.0.0/8"),)
+        with patch("vditor.ratelimit.TRUSTED_PROXIES", proxies):
+            self.assertEqual(get_client_address(request), "203.0.113.7")
+            self.assertEqual(get_client_key(request), "ip:203.0.113.7")
+
+
+@override_settings(MEDIA_ROOT="/tmp/media-idempotency", MEDIA_URL="/media/")
+class VditorIdempotencyTest(TestCase):
+    """Test replaying upload responses for retried Idempotency-Keys."""
+
+    def setUp(self):
+        import shutil
+        from django.core.cache import cache
+
+        cache.clear()
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+
+    def _upload(self, key, content=PNG_HEADER + b"x" * 100):
+        image_file = SimpleUploadedFile("a.png", content, content_type="image/png")
+        return self.client.post(
+            reverse("uploads"), {"file[]": image_file}, HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_stored_response(self):
+        first = self._upload("upload-1")
+        self.assertEqual(first.status_code, 200)
+
+        with patch("vditor.views._process_uploads") as process_uploads:
+            retry = self._upload("upload-1")
+        process_uploads.assert_not_called()
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+
+        # Keys are not shared between clients
+        other = self.client.post(
+            reverse("uploads"), HTTP_IDEMPOTENCY_KEY="upload-1", REMOTE_ADDR="10.0.0.2"
+        )
+        self.assertEqual(other.json()["msg"], "No file uploaded.")
+
+    def test_failed_attempt_not_stored(self):
+        with patch("vditor.views._process_uploads", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self._upload("upload-2")
+        self.assertEqual(self._upload("upload-2").status_code, 200)
+
+    def test_concurrent_retry_conflicts(self):
+        from django.core.cache import cache
+        from django.test import RequestFactory
+        from vditor.idempotency import _cache_key
+
+        request = RequestFactory().post(reverse("uploads"))
+        cache.set(_cache_key(request, "upload-3"), "in-progress")
+        response = self._upload("upload-3")
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("Retry-After", response)
+
+
+@override_settings(MEDIA_ROOT="/tmp/media-quota", MEDIA_URL="/media/")
+@patch("vditor.quota.QUOTA_LIMITS", {"user": 1000})
+class VditorQuotaTest(TestCase):
+    """Test per-owner upload quotas."""
+
+    def setUp(self):
+        import shutil
+        from django.contrib.auth.models import User
+        from django.core.cache import cache
+
+        cache.clear()
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+        self.user = User.objects.create_user("writer")
+        self.client.force_login(self.user)
+        self.owner = f"user:{self.user.pk}"
+
+    def _upload(self, content):
+        image_file = SimpleUploadedFile("a.png", content, content_type="image/png")
+        return self.client.post(reverse("uploads"), {"file[]": image_file})
+
+    def test_usage_charged_once_per_content(self):
+        from vditor.models import QuotaUsage
+        from vditor.quota import get_usage
+
+        content = PNG_HEADER + b"x" * 100
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self._upload(content).json()["code"], 0)
+            self.assertEqual(self._upload(content).json()["code"], 0)
+
+        usage = QuotaUsage.objects.get(owner=self.owner)
+        self.assertEqual((usage.bytes_used, usage.files), (124, 1))
+        self.assertEqual(get_usage(self.owner), 124)
+
+    def test_upload_over_quota_rejected_before_parsing(self):
+        from vditor.models import QuotaUsage
+
+        QuotaUsage.objects.create(owner=self.owner, bytes_used=990, files=1)
+        with patch("vditor.views._process_uploads") as process_uploads:
+            response = self._upload(PNG_HEADER + b"x" * 100)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json()["msg"], "Upload quota exceeded.")
+        process_uploads.assert_not_called()
+
+    def test_reconcile_rebuilds_usage_from_disk(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from vditor.models import QuotaUsage
+        from vditor.quota import get_usage
+
+        self._upload(PNG_HEADER + b"x" * 100)
+        QuotaUsage.objects.filter(owner=self.owner).update(bytes_used=5, files=7)
+        QuotaUsage.objects.create(owner="user:999", bytes_used=50, files=1)
+
+        call_command("vditor_reconcile_quota", stdout=StringIO())
+
+        usage = QuotaUsage.objects.get(owner=self.owner)
+        self.assertEqual((usage.bytes_used, usage.files), (124, 1))
+        self.assertFalse(QuotaUsage.objects.filter(owner="user:999").exists())
+        self.assertEqual(get_usage(self.owner), 124)
+
+    def test_reconcile_keeps_freshly_charged_usage(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from vditor.models import QuotaUsage, StoredFile
+
+        content = PNG_HEADER + b"x" * 100
+        self.assertEqual(self._upload(content).json()["code"], 0)
+        # Optimization can shrink the stored file below the charged size
+        name = StoredFile.objects.values_list("name", flat=True).get()
+        with open(os.path.join(settings.MEDIA_ROOT, name), "wb") as f:
+            f.write(PNG_HEADER)
+        usage = QuotaUsage.objects.get(owner=self.owner)
+        self.assertEqual(usage.bytes_used, len(content))
+
+        out = StringIO()
+        call_command("vditor_reconcile_quota", stdout=out)
+
+        self.assertIn("Updated usage of 0 of 1 owners", out.getvalue())
+        usage.refresh_from_db()
+        self.assertEqual((usage.bytes_used, usage.files), (len(content), 1))
+
+    def test_reconcile_scan_lists_storage_without_sizes(self):
+        from unittest.mock import MagicMock
+        from vditor.management.commands.vditor_reconcile_quota import _scan_storage
+
+        storage = MagicMock()
+        storage.listdir.side_effect = lambda directory: {
+            "": (["ab"], ["a.png"]),
+            "ab": ([], ["b.png"]),
+        }[directory]
+
+        self.assertEqual(_scan_storage(storage), {"a.png", "ab/b.png"})
+        storage.size.assert_not_called()
+
+    def test_reconcile_drops_uploads_no_longer_stored(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from vditor.models import QuotaUsage, StoredFile
+
+        self._upload(PNG_HEADER + b"x" * 100)
+        for name in StoredFile.objects.values_list("name", flat=True):
+            os.remove(os.path.join(settings.MEDIA_ROOT, name))
+
+        call_command("vditor_reconcile_quota", stdout=StringIO())
+
+        self.assertFalse(QuotaUsage.objects.filter(owner=self.owner).exists())
+
+
+@override_settings(MEDIA_ROOT="/tmp/media-metrics", MEDIA_URL="/media/")
+class VditorMetricsTest(TestCase):
+    """Test upload histograms aggregated through the cache."""
+
+    def setUp(self):
+        import shutil
+        from django.core.cache import cache
+
+        cache.clear()
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+
+    def test_estimate_quantile_interpolates_within_bucket(self):
+        from vditor.metrics import estimate_quantile
+
+        buckets = (1.0, 2.0, 4.0)
+        self.assertEqual(estimate_quantile(buckets, [0, 10, 0, 0], 0.5), 1.5)
+        self.assertEqual(estimate_quantile(buckets, [9, 0, 0, 1], 0.99), 4.0)
+        self.assertEqual(estimate_quantile(buckets, [0, 0, 0, 0], 0.5), 0.0)
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "dummy": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+        }
+    )
+    def test_counters_given_up_on_dummy_cache(self):
+        from vditor.metrics import CacheCounters
+
+        with self.assertLogs("vditor.metrics", "WARNING") as logs:
+            CacheCounters("dummy").incr_many({"a": 1, "b": 2})
+        self.assertIn("dropped 2 counts", logs.output[0])
+
+    def test_histograms_aggregate_across_workers(self):
+        from vditor.metrics import get_upload_metrics, record_upload
+
+        # Every worker increments the same cache counters
+        for _ in range(90):
+            record_upload(2048, 0.02, success=True)
+        for _ in range(10):
+            record_upload(2048, 3.0, success=True)
+        record_upload(10, 0.001, success=False)
+
+        metrics = get_upload_metrics()
+        self.assertEqual(metrics["successful"]["count"], 100)
+        self.assertAlmostEqual(metrics["successful"]["total_time"], 31.8)
+        self.assertLessEqual(metrics["successful"]["time_p50"], 0.025)
+        self.assertGreater(metrics["successful"]["time_p99"], 2.5)
+        self.assertEqual(metrics["failed"]["count"], 1)
+
+    @patch("vditor.metrics.METRICS_CACHE", None)
+    def test_per_process_counters(self):
+        from django.core.cache import cache
+        from vditor.metrics import get_upload_metrics, record_upload
+        from vditor.metrics import reset_upload_metrics
+
+        self.addCleanup(reset_upload_metrics)
+        record_upload(100, 0.5, success=True)
+
+        self.assertEqual(get_upload_metrics()["successful"]["count"], 1)
+        self.assertIsNone(cache.get("vditor_metrics_successful_count"))
+
+    def test_batch_upload_metrics_flushed(self):
+        from vditor.metrics import flush_metrics, get_upload_metrics, read_counters
+
+        # Too short to be checked while streaming; rejected on the upload pool
+        files = [
+            SimpleUploadedFile(f"{i}.png", b"x", content_type="image/png")
+            for i in range(3)
+        ]
+        self.client.post(reverse("uploads"), {"file[]": files})
+        flush_metrics()
+
+        self.assertEqual(get_upload_metrics()["failed"]["count"], 3)
+        self.assertEqual(read_counters()["rejected_empty"], 3)
+
+    def test_metrics_command_reads_shared_counters(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        image_file = SimpleUploadedFile(
+            "a.png", PNG_HEADER + b"x" * 100, content_type="image/png"
+        )
+        self.client.post(reverse("uploads"), {"file[]": image_file})
+
+        out = StringIO()
+        call_command("vditor_cache", "metrics", stdout=out)
+        self.assertIn("SUCCESSFUL Uploads:\n  Count: 1", out.getvalue())
+        self.assertIn("Time p50/p95/p99", out.getvalue())
+
+    def test_metrics_endpoint_disabled_by_default(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 404)
+
+    @patch("vditor.metrics.METRICS_ENDPOINT", True)
+    @patch("vditor.metrics.METRICS_TOKEN", "secret")
+    def test_metrics_endpoint_requires_token(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 401)
+
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong"
+        )
+        self.assertEqual(response.status_code, 401)
+
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+        )
+        self.assertEqual(response.status_code, 200)
+
+    @patch("vditor.metrics.METRICS_ENDPOINT", True)
+    def test_metrics_endpoint_exposition(self):
+        from vditor.admission import AdmissionController
+        from vditor.cache_utils import ConfigCache
+
+        controller = AdmissionController(limit=8, queue_size=16, queue_timeout=2.0)
+        content = PNG_HEADER + b"x" * 100
+        with patch("vditor.admission.upload_admission", controller):
+            for _ in range(2):
+                image_file = SimpleUploadedFile(
+                    "a.png", content, content_type="image/png"
+                )
+                self.client.post(reverse("uploads"), {"file[]": image_file})
+            bad_file = SimpleUploadedFile("a.exe", content, content_type="image/png")
+            self.client.post(reverse("uploads"), {"file[]": bad_file})
+            ConfigCache.get_config("missing")
+
+            response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            response["Content-Type"].startswith("text/plain; version=0.0.4")
+        )
+        body = response.content.decode()
+        self.assertIn("# TYPE vditor_upload_duration_seconds histogram", body)
+        self.assertIn(
+            'vditor_upload_duration_seconds_bucket{outcome="successful",le="+Inf"} 2',
+            body,
+        )
+        self.assertIn('vditor_upload_size_bytes_count{outcome="successful"} 2', body)
+        self.assertIn('vditor_upload_rejections_total{reason="type"} 1', body)
+        self.assertIn('vditor_upload_dedup_total{result="hit"} 1', body)
+        self.assertIn("vditor_upload_dedup_hit_ratio 0.5", body)
+        self.assertIn(
+            'vditor_cache_requests_total{cache="config",result="miss"} 1', body
+        )
+        self.assertIn("# TYPE vditor_upload_memory_bytes gauge", body)
+        self.assertIn("vditor_upload_memory_bytes 0\n", body)
+        # Rejected while streaming, before taking a slot
+        self.assertIn("vditor_upload_admission_admitted_total 2\n", body)
+        self.assertIn("vditor_upload_admission_queue_depth 0\n", body)
+
+
+@override_settings(MEDIA_ROOT="/tmp/media-tracing", MEDIA_URL="/media/")
+class VditorTracingTest(TestCase):
+    """Test timing spans and the Server-Timing header."""
+
+    def setUp(self):
+        import shutil
+
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+
+    def _upload(self, *names):
+        files = [
+            SimpleUploadedFile(
+                name,
+                PNG_HEADER + name.encode() * 20,
+                content_type="image/png",
+            )
+            for name in names
+        ]
+        return self.client.post(reverse("uploads"), {"file[]": files})
+
+    def test_span_is_noop_when_disabled(self):
+        from vditor.tracing import _NOOP_SPAN, span
+
+        with span("hash") as current:
+            current.set_attribute("size", 1)
+        self.assertIs(current, _NOOP_SPAN)
+        self.assertNotIn("Server-Timing", self._upload("a.png"))
+
+    @patch("vditor.tracing.TRACING", True)
+    def test_server_timing_reports_upload_stages(self):
+        response = self._upload("a.png", "b.png")
+
+        self.assertEqual(response.json()["code"], 0)
+        stages = [
+            entry.split(";")[0] for entry in response["Server-Timing"].split(", ")
+        ]
+        # Spans of files prepared on the upload thread pool are included
+        for stage in ("parse", "validate", "hash", "dedup", "write", "total"):
+            self.assertIn(stage, stages)
+        self.assertEqual(len(stages), len(set(stages)))
+
+    @patch("vditor.tracing.TRACING", True)
+    @patch("vditor.tracing.SERVER_TIMING", False)
+    def test_server_timing_header_can_be_disabled(self):
+        self.assertNotIn("Server-Timing", self._upload("a.png"))
+
+    def test_hooks_receive_nested_spans(self):
+        from vditor.tracing import (
+            SpanHook,
+            register_span_hook,
+            unregister_span_hook,
+        )
+        from vditor.configs import VditorConfig
+        from vditor.widgets import VditorWidget
+
+        class RecordingHook(SpanHook):
+            def __init__(self):
+                self.events = []
+
+            def on_start(self, span):
+                self.events.append(("start", span.name))
+
+            def on_end(self, span):
+                self.events.append(("end", span.name, span.duration_ns))
+
+        class FailingHook(SpanHook):
+            def on_end(self, span):
+                raise RuntimeError("exporter down")
+
+        hook = RecordingHook()
+        for registered in (hook, FailingHook()):
+            register_span_hook(registered)
+            self.addCleanup(unregister_span_hook, registered)
+
+        VditorConfig("default")
+        VditorWidget().render("content", "text")
+        response = self._upload("a.png")
+
+        self.assertIn("Server-Timing", response)
+        names = [event[1] for event in hook.events if event[0] == "end"]
+        self.assertIn("config", names)
+        self.assertIn("render", names)
+        self.assertEqual(names[-1], "total")
+        ends = [event for event in hook.events if event[0] == "end"]
+        self.assertTrue(all(event[2] >= 0 for event in ends))
+        self.assertEqual(hook.events[-1][0], "end")
+
+
+@override_settings(MEDIA_ROOT="/tmp/media-profiling", MEDIA_URL="/media/")
+@patch("vditor.profiling.PROFILE_DIR", "/tmp/vditor-test-profiles")
+class VditorProfilingTest(TestCase):
+    """Test sampled profiling of uploads and widget renders."""
+
+    def setUp(self):
+        import shutil
+        from django.core.cache import cache
+
+        cache.clear()
+        for directory in (settings.MEDIA_ROOT, "/tmp/vditor-test-profiles"):
+            self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        patcher = patch("vditor.profiling._sample_rate_override", (0.0, None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _upload(self, index):
+        image_file = SimpleUploadedFile(
+            f"{index}.png",
+            PNG_HEADER + bytes([index]) * 100,
+            content_type="image/png",
+        )
+        return self.client.post(reverse("uploads"), {"file[]": image_file})
+
+    def test_no_profiles_when_disabled(self):
+        from vditor.profiling import list_profiles
+
+        self._upload(1)
+        self.assertEqual(list_profiles(), [])
+
+    @patch("vditor.profiling.PROFILE_SAMPLE_RATE", 2)
+    def test_one_in_n_uploads_profiled(self):
+        from vditor.profiling import list_profiles
+
+        for index in range(4):
+            self.assertEqual(self._upload(index).json()["code"], 0)
+
+        profiles = list_profiles("upload")
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(path.suffix == ".prof" for path in profiles))
+
+    @patch("vditor.profiling.PROFILE_SAMPLE_RATE", 2)
+    def test_profile_names_sampled_independently(self):
+        from vditor.profiling import list_profiles
+        from vditor.widgets import VditorWidget
+
+        widget = VditorWidget()
+        for index in range(4):
+            self.assertEqual(self._upload(index).json()["code"], 0)
+            widget.render("content", "text")
+
+        self.assertEqual(len(list_profiles("upload")), 2)
+        self.assertEqual(len(list_profiles("render")), 2)
+
+    @patch("vditor.profiling.PROFILE_SAMPLE_RATE", 1)
+    @patch("vditor.profiling.PROFILE_MAX_FILES", 2)
+    def test_profile_directory_is_rotated(self):
+        from vditor.profiling import list_profiles
+        from vditor.widgets import VditorWidget
+
+        widget = VditorWidget()
+        for _ in range(4):
+            widget.render("content", "text")
+
+        self.assertEqual(len(list_profiles("render")), 2)
+
+    def test_profile_command_enables_and_reports(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from vditor.profiling import get_sample_rate
+
+        call_command("vditor_cache", "profile", "--enable", "1", stdout=StringIO())
+        self.assertEqual(get_sample_rate(), 1)
+        self._upload(1)
+
+        out = StringIO()
+        call_command("vditor_cache", "profile", "--name", "upload", stdout=out)
+        self.assertIn("Merged 1 profiles", out.getvalue())
+        self.assertIn("vditor_images_upload_view", out.getvalue())
+
+        call_command("vditor_cache", "profile", "--disable", stdout=StringIO())
+        self.assertEqual(get_sample_rate(), 0)
+
+
+class VditorBenchTest(TestCase):
+    """Test the benchmark runner and baselines."""
+
+    def test_run_benchmark_discards_warmup(self):
+        from vditor.bench import Benchmark, run_benchmark
+
+        calls = []
+        benchmark = Benchmark("noop", lambda: calls.append(1), setup=tuple)
+        result = run_benchmark(benchmark, warmup=3, min_rounds=4, min_time=0)
+
+        self.assertEqual(result.rounds, 4)
+        self.assertEqual(result.calls_per_round, 1)
+        self.assertEqual(len(calls), 7)
+        self.assertLessEqual(result.min, result.median)
+        self.assertLessEqual(result.median, result.max)
+        self.assertIsNone(result.throughput)
+
+    def test_upload_benchmark_releases_upload_memory(self):
+        from vditor.bench import _upload_benchmark, bench_environment, run_benchmark
+        from vditor.uploadhandler import MemoryBudget
+
+        budget = MemoryBudget(1024 * 1024)
+        with (
+            patch("vditor.uploadhandler.UPLOAD_MEMORY_BUDGET", budget.limit),
+            patch("vditor.uploadhandler.upload_memory_budget", budget),
+            bench_environment(),
+        ):
+            benchmark = _upload_benchmark(4096, 2)
+            run_benchmark(benchmark, warmup=0, min_rounds=3, min_time=0)
+
+        gauges = budget.gauges()
+        self.assertGreater(gauges["peak_in_memory_bytes"], 0)
+        self.assertEqual(gauges["in_memory_bytes"], 0)
+
+    def test_compare_results_flags_regressions(self):
+        from vditor.bench import BenchmarkResult, compare_results
+
+        def result(name, median):
+            return BenchmarkResult(
+                name, 5, 1, median, median, 0, 0, median, median, None
+            )
+
+        baseline = {
+            "results": {
+                "fast": {"median": 1.0},
+                "slow": {"median": 1.0},
+            }
+        }
+        comparisons = compare_results(
+            [result("fast", 1.1), result("slow", 1.5), result("new", 9.0)],
+            baseline,
+            threshold=0.2,
+        )
+
+        self.assertEqual(
+            [(c.name, c.regressed) for c in comparisons],
+            [("fast", False), ("slow", True)],
+        )
+
+    def test_bench_command_saves_and_gates_on_baseline(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from io import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from vditor.models import StoredFile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "baseline.json")
+        options = [
+            "--filter",
+            "upload/4KBx4",
+            "--filter",
+            "validate/filename",
+            "--warmup",
+            "0",
+            "--min-rounds",
+            "2",
+            "--min-time",
+            "0",
+        ]
+
+        out = StringIO()
+        call_command("vditor_bench", *options, "--save", path, stdout=out)
+        with open(path) as f:
+            baseline = json.load(f)
+        self.assertEqual(
+            sorted(baseline["results"]), ["upload/4KBx4", "validate/filename"]
+        )
+        self.assertIn("MB/s", out.getvalue())
+        # Uploads are rolled back
+        self.assertFalse(StoredFile.objects.exists())
+
+        for result in baseline["results"].values():
+            result["median"] /= 1000
+        with open(path, "w") as f:
+            json.dump(baseline, f)
+        with self.assertRaisesMessage(CommandError, "regressed"):
+            call_command("vditor_bench", *options, "--compare", path, stdout=StringIO())
+
+
+class VditorUploadPolicyTest(TestCase):
+    """Test compiled upload policies."""
+
+    def test_magic_number_dispatch(self):
+        from vditor.policy import get_upload_policy
+
+        policy = get_upload_policy()
+        self.assertEqual(policy.detect_mime_type(b"\xff\xd8\xff\xe0"), "image/jpeg")
+        self.assertEqual(policy.detect_mime_type(b"GIF89a..."), "image/gif")
+        self.assertEqual(policy.detect_mime_type(b"BM...."), "")
+        self.assertEqual(policy.detect_mime_type(b""), "")
+        self.assertEqual(
+            policy.validate_header(b"\x89PNG\r\n\x1a\n", ".jpg")[1],
+            "File extension does not match file content.",
+        )
+
+    def test_filename_rules_shared_with_security_validator(self):
+        from vditor.policy import get_upload_policy
+        from vditor.security import SecurityValidator
+
+        policy = get_upload_policy()
+        validator = SecurityValidator()
+        for filename in ("../a.png", "a<b.png", "con.png", "a.png~", ".hidden.png"):
+            self.assertFalse(policy.validate_filename(filename)[0], filename)
+            self.assertFalse(validator.validate_filename(filename)[0], filename)
+        self.assertTrue(policy.validate_filename("con.tar.png")[0])
+        self.assertEqual(
+            policy.validate_filename("LPT1.png")[1],
+            "Filename is reserved by the system.",
+        )
+
+    @override_settings(
+        VDITOR_UPLOAD_POLICIES={
+            "avatars": {"max_file_size": 50, "allowed_extensions": {".png"}}
+        }
+    )
+    def test_named_policy_selected_by_config(self):
+        from vditor.policy import get_upload_policy
+
+        policy = get_upload_policy("avatars")
+        self.assertEqual(policy.max_file_size, 50)
+        self.assertEqual(dict(policy.extension_mime_types), {".png": "image/png"})
+
+        image_file = SimpleUploadedFile(
+            "a.jpg", b"\xff\xd8\xff" + b"x" * 20, content_type="image/jpeg"
+        )
+        from django.test import RequestFactory
+        from vditor.views import vditor_images_upload_view
+
+        request = RequestFactory().post("/", {"file[]": image_file})
+        response = vditor_images_upload_view(request, config="avatars")
+        self.assertIn("a.jpg", json.loads(response.content)["data"]["errFiles"])
+
+        request = RequestFactory().post("/")
+        response = vditor_images_upload_view(request, config="missing")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            json.loads(response.content)["msg"], "Unknown upload configuration."
+        )
+
+    @override_settings(
+        VDITOR_UPLOAD_POLICIES={
+            "avatars": {"max_file_size": 50, "allowed_extensions": {".png"}}
+        },
+        MEDIA_ROOT="/tmp/media-policy",
+        MEDIA_URL="/media/",
+    )
+    def test_policy_not_selected_by_query_parameter(self):
+        import shutil
+
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+        # The 124-byte image breaks the avatars size limit but not the default
+        image_file = SimpleUploadedFile(
+            "a.png", PNG_HEADER + b"x" * 100, content_type="image/png"
+        )
+        response = self.client.post(
+            reverse("uploads") + "?config=avatars", {"file[]": image_file}
+        )
+        self.assertIn("a.png", response.json()["data"]["succMap"])
+
+    def test_unknown_policy_option(self):
+        from vditor.policy import build_upload_policy
+
+        with self.assertRaises(ImproperlyConfigured):
+            build_upload_policy("broken", max_size=10)
+
+
+class VditorImageInfoTest(TestCase):
+    """Test reading image dimensions from file headers."""
+
+    def test_png(self):
+        import struct
+        from vditor.imageinfo import probe_image_dimensions
+
+        header = b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR" + struct.pack(">II", 640, 480)
+        self.assertEqual(probe_image_dimensions(header), (640, 480))
+        self.assertIsNone(probe_image_dimensions(header[:20]))
+
+    def test_gif(self):
+        from vditor.imageinfo import probe_image_dimensions
+
+        self.assertEqual(probe_image_dimensions(b"GIF89a\x80\x02\xe0\x01"), (640, 480))
+
+    def test_jpeg_after_metadata(self):
+        import struct
+        from vditor.imageinfo import probe_image_dimensions
+
+        exif = b"Exif\0\0" + b"x" * 3000
+        header = (
+            b"\xff\xd8"
+            + b"\xff\xe1"
+            + struct.pack(">H", len(exif) + 2)
+            + exif
+            + b"\xff\xc2\x00\x11\x08"
+            + struct.pack(">HH", 480, 640)
+        )
+        self.assertEqual(probe_image_dimensions(header), (640, 480))
+        # Frame header not received yet
+        self.assertIsNone(probe_image_dimensions(header[:1000]))
+
+    def test_jpeg_segments_walked_across_chunks(self):
+        import struct
+        from vditor.imageinfo import ImageProbe
+
+        app1 = b"\xff\xe1" + struct.pack(">H", 65535) + b"x" * 65533
+        jpeg = (
+            b"\xff\xd8"
+            + app1 * 3
+            + b"\xff\xc0\x00\x11\x08"
+            + struct.pack(">HH", 480, 640)
+        )
+        for chunk_size in (1, 7, 1000, 64 * 1024):
+            probe = ImageProbe()
+            for start in range(0, len(jpeg), chunk_size):
+                if probe.feed(jpeg[start : start + chunk_size]):
+                    break
+            self.assertTrue(probe.done)
+            self.assertEqual((probe.format, probe.dimensions), ("jpeg", (640, 480)))
+            # Skipped segments are not buffered
+            self.assertLess(len(probe._pending), 9)
+
+    def test_webp(self):
+        import struct
+        from vditor.imageinfo import probe_image_dimensions
+
+        riff = b"RIFF\0\0\0\0WEBP"
+        lossy = (
+            riff
+            + b"VP8 \0\0\0\0"
+            + b"\0\0\0\x9d\x01\x2a"
+            + struct.pack("<HH", 640, 480)
+        )
+        lossless = (
+            riff
+            + b"VP8L\0\0\0\0\x2f"
+            + struct.pack("<I", (640 - 1) | ((480 - 1) << 14))
+        )
+        extended = (
+            riff
+            + b"VP8X\0\0\0\0"
+            + b"\0" * 4
+            + (640 - 1).to_bytes(3, "little")
+            + (480 - 1).to_bytes(3, "little")
+        )
+        for header in (lossy, lossless, extended):
+            self.assertEqual(probe_image_dimensions(header), (640, 480))
+
+    def test_unknown_format(self):
+        from vditor.imageinfo import probe_image_dimensions
+
+        self.assertIsNone(probe_image_dimensions(b"fake_image_content"))
+
+
 class VditorWidgetTest(TestCase):
     def test_init(self):
         # Clear cache to ensure we test actual configuration
@@ -161,6 +2034,16 @@ class VditorWidgetTest(TestCase):
             },
         )
 
+    @override_settings(VDITOR_UPLOAD_PREFLIGHT=True)
+    def test_render_upload_preflight(self):
+        rendered_html = VditorWidget().render("test_name", "test_value")
+        self.assertIn("var preflightUrl = '/vditor/uploads/by", rendered_html)
+        self.assertIn("config.upload.file", rendered_html)
+
+    def test_render_without_upload_preflight(self):
+        rendered_html = VditorWidget().render("test_name", "test_value")
+        self.assertNotIn("config.upload.file", rendered_html)
+
     def test_build_attrs(self):
         widget = VditorWidget()
         base_attrs = {"rows": 10}
@@ -302,6 +2185,43 @@ class VditorSecurityTest(TestCase):
         is_valid, error = _validate_uploaded_file(valid_file)
         self.assertTrue(is_valid)
 
+    def test_content_scanner_matches_across_chunks(self):
+        from vditor.security import ContentScanner
+
+        scanner = ContentScanner()
+        self.assertTrue(scanner.feed(b"x" * 100 + b"<SCR"))
+        self.assertFalse(scanner.feed(b"IPT>alert(1)"))
+        self.assertFalse(scanner.is_clean)
+
+        self.assertTrue(ContentScanner().feed(b"plain text, no markup"))
+
+    def test_file_stream_validation(self):
+        from vditor.security import SecurityValidator
+
+        validator = SecurityValidator()
+        self.assertTrue(validator.validate_file_content(b"x" * 100)[0])
+        self.assertFalse(
+            validator.validate_file_stream([b"x" * 100 + b"javas", b"cript:"])[0]
+        )
+
+    @override_settings(MEDIA_ROOT="/tmp/media-scan")
+    @patch("vditor.security.SCAN_UPLOAD_CONTENT", True)
+    def test_dangerous_upload_rejected_while_hashing(self):
+        import shutil
+        from pathlib import Path
+        from vditor.views import UploadError, _store_uploaded_file
+
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        upload = SimpleUploadedFile(
+            "image.png",
+            PNG_HEADER + b"x" * 100 + b"<script>alert(1)</script>",
+            content_type="image/png",
+        )
+        with self.assertRaises(UploadError):
+            _store_uploaded_file(upload, Path(settings.MEDIA_ROOT), "image", ".png")
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), [])
+
 
 class VditorCacheTest(TestCase):
     """Test caching functionality."""
@@ -0,0 +1,263 @@
+"""
+Timing spans for Django Vditor.
+
+``span("name")`` times a block of code with ``perf_counter_ns``::
+
+    with span("hash", file=uploaded_file.name):
+        content_hash = _hash_upload(uploaded_file)
+
+Spans are only recorded when ``VDITOR_TRACING`` is set or a hook is
+registered; otherwise ``span`` returns a shared no-op object, so
+instrumented code costs one function call.
+
+Views decorated with ``server_timing`` report the spans of each request,
+summed per name, in a ``Server-Timing`` response header that browser
+developer tools display. Every span is also passed to the registered hooks
+(``VDITOR_TRACING_HOOKS`` or ``register_span_hook``), e.g.
+``OpenTelemetryHook`` to export spans to an OpenTelemetry tracer.
+"""
+
+import logging
+import time
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from typing import Any, Optional
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Record spans even without hooks, for the Server-Timing header
+TRACING = getattr(settings, "VDITOR_TRACING", False)
+
+# Add a Server-Timing header to the responses of traced views
+SERVER_TIMING = getattr(settings, "VDITOR_SERVER_TIMING", True)
+
+# Dotted paths to SpanHook classes instantiated at startup
+TRACING_HOOKS = getattr(settings, "VDITOR_TRACING_HOOKS", [])
+
+_hooks: list["SpanHook"] = []
+
+# (name, duration_ns) of the spans finished during the current request
+_request_timings: ContextVar[Optional[list]] = ContextVar(
+    "vditor_request_timings", default=None
+)
+
+
+class SpanHook:
+    """Receives every span; subclass and override what you need.
+
+    Hooks are called in the thread that runs the span and must not raise.
+    """
+
+    def on_start(self, span: "Span") -> None:
+        pass
+
+    def on_end(self, span: "Span") -> None:
+        pass
+
+
+class Span:
+    """A timed block of code.
+
+    Attributes:
+        name: Short stage name, also used in the Server-Timing header
+        attributes: Details of the span passed to hooks
+        start_ns: ``perf_counter_ns`` when the span started
+        end_ns: ``perf_counter_ns`` when the span ended, or None
+        hook_state: Free slot for hooks, e.g. an OpenTelemetry span
+    """
+
+    __slots__ = ("name", "attributes", "start_ns", "end_ns", "hook_state")
+
+    def __init__(self, name: str, attributes: dict) -> None:
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = 0
+        self.end_ns: Optional[int] = None
+        self.hook_state: dict = {}
+
+    @property
+    def duration_ns(self) -> int:
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        return end_ns - self.start_ns
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self.start_ns = time.perf_counter_ns()
+        for hook in _hooks:
+            try:
+                hook.on_start(self)
+            except Exception as e:
+                logger.warning(f"Span hook {hook!r} failed: {e}")
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.end_ns = time.perf_counter_ns()
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        timings = _request_timings.get()
+        if timings is not None:
+            # list.append is atomic, spans may end on upload worker threads
+            timings.append((self.name, self.end_ns - self.start_ns))
+        for hook in reversed(_hooks):
+            try:
+                hook.on_end(self)
+            except Exception as e:
+                logger.warning(f"Span hook {hook!r} failed: {e}")
+        return False
+
+
+class _NoopSpan:
+    """Span returned while tracing is disabled."""
+
+    __slots__ = ()
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **attributes: Any):
+    """Time a block of code.
+
+    Args:
+        name: Short stage name, e.g. "parse", "validate" or "hash"
+        **attributes: Details passed to hooks
+
+    Returns:
+        Context manager yielding the span (a no-op when tracing is disabled)
+    """
+    if not (TRACING or _hooks):
+        return _NOOP_SPAN
+    return Span(name, attributes)
+
+
+def register_span_hook(hook: SpanHook) -> None:
+    """Pass every span to a hook from now on."""
+    _hooks.append(hook)
+
+
+def unregister_span_hook(hook: SpanHook) -> None:
+    """Stop passing spans to a hook."""
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def load_tracing_hooks() -> None:
+    """Instantiate and register the hooks named by ``VDITOR_TRACING_HOOKS``."""
+    for path in TRACING_HOOKS:
+        try:
+            register_span_hook(import_string(path)())
+        except Exception as e:
+            logger.error(f"Failed to load span hook '{path}': {e}")
+
+
+def format_server_timing(timings: list) -> str:
+    """Build a Server-Timing header value, summing spans with the same name.
+
+    Args:
+        timings: (name, duration_ns) pairs in the order the spans ended
+
+    Returns:
+        Header value such as ``parse;dur=1.204, hash;dur=3.5``
+    """
+    totals: dict[str, int] = {}
+    for name, duration_ns in timings:
+        totals[name] = totals.get(name, 0) + duration_ns
+    return ", ".join(
+        f"{name};dur={duration_ns / 1_000_000:.3f}"
+        for name, duration_ns in totals.items()
+    )
+
+
+def _add_server_timing(response, timings: list) -> None:
+    if SERVER_TIMING and response is not None and timings:
+        response["Server-Timing"] = format_server_timing(timings)
+
+
+def server_timing(view):
+    """Decorate a view to collect its spans into a Server-Timing header.
+
+    The whole view is timed as ``total``. Works with sync and async views;
+    spans on other threads are collected when they run in a copy of the
+    request's context (``contextvars.copy_context``).
+    """
+    if iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if not (TRACING or _hooks):
+                return await view(request, *args, **kwargs)
+            timings = []
+            token = _request_timings.set(timings)
+            try:
+                with span("total", path=request.path):
+                    response = await view(request, *args, **kwargs)
+            finally:
+                _request_timings.reset(token)
+            _add_server_timing(response, timings)
+            return response
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not (TRACING or _hooks):
+            return view(request, *args, **kwargs)
+        timings = []
+        token = _request_timings.set(timings)
+        try:
+            with span("total", path=request.path):
+                response = view(request, *args, **kwargs)
+        finally:
+            _request_timings.reset(token)
+        _add_server_timing(response, timings)
+        return response
+
+    return wrapper
+
+
+class OpenTelemetryHook(SpanHook):
+    """Export spans to OpenTelemetry.
+
+    Requires ``opentelemetry-api`` (``pip install django-vditor[tracing]``)
+    and a configured tracer provider. Spans are nested under the active
+    OpenTelemetry span, e.g. the request span of an instrumented server.
+    """
+
+    def __init__(self, tracer_name: str = "vditor") -> None:
+        from opentelemetry import context, trace
+
+        self._context = context
+        self._trace = trace
+        self._tracer = trace.get_tracer(tracer_name)
+
+    def on_start(self, span: Span) -> None:
+        otel_span = self._tracer.start_span(f"vditor.{span.name}")
+        span.hook_state["otel_span"] = otel_span
+        span.hook_state["otel_token"] = self._context.attach(
+            self._trace.set_span_in_context(otel_span)
+        )
+
+    def on_end(self, span: Span) -> None:
+        otel_span = span.hook_state.pop("otel_span", None)
+        if otel_span is None:
+            return
+        for key, value in span.attributes.items():
+            if isinstance(value, (str, bool, int, float)):
+                otel_span.set_attribute(f"vditor.{key}", value)
+        self._context.detach(span.hook_state.pop("otel_token"))
+        otel_span.end()
@@ -0,0 +1,331 @@
+"""
+Upload handlers for Django Vditor.
+
+This module provides a streaming upload handler that validates and hashes
+files while the request body is still being received, so invalid uploads
+are rejected before they are fully transferred and buffered, and a storing
+handler that keeps uploads in memory only within a process-wide budget.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional
+
+from django.conf import settings
+from django.core.files.uploadedfile import (
+    InMemoryUploadedFile,
+    TemporaryUploadedFile,
+    UploadedFile,
+)
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from django.utils.translation import gettext_lazy as _
+
+from .imageinfo import ImageProbe, validate_image_dimensions
+from .policy import UploadPolicy, get_upload_policy
+from .security import new_content_scanner
+
+logger = logging.getLogger(__name__)
+
+# Number of leading bytes needed to check magic numbers
+HEADER_SIZE = 32
+
+# Bytes of uploads all requests of this process may hold in memory at once;
+# further uploads are spooled to disk. None keeps Django's upload handlers.
+UPLOAD_MEMORY_BUDGET = getattr(
+    settings, "VDITOR_UPLOAD_MEMORY_BUDGET", 64 * 1024 * 1024
+)
+
+# Directory uploads are spooled to once the budget is used up, e.g. a tmpfs
+# mount; defaults to FILE_UPLOAD_TEMP_DIR
+UPLOAD_SPOOL_DIR = getattr(settings, "VDITOR_UPLOAD_SPOOL_DIR", None)
+
+
+class VditorUploadHandler(FileUploadHandler):
+    """Validate and hash uploaded files as their chunks arrive.
+
+    Must be installed before Django's storing handlers. Chunks are passed
+    through unchanged; the handler only inspects them. Results are recorded
+    on the request:
+
+    - ``request.vditor_upload_digests`` maps ``(field_name, file_name, size)``
+      to the SHA-256 hex digests of completed files, in upload order.
+    - ``request.vditor_upload_errors`` maps rejected file names to the reason
+      they were rejected.
+
+    Image dimensions are read as soon as they have arrived, skipping over
+    JPEG metadata segments without buffering them, so decompression bombs
+    are rejected without receiving their image data.
+    With ``VDITOR_SCAN_UPLOAD_CONTENT``, every chunk is also scanned for
+    dangerous content as it is hashed.
+
+    A file that fails a name, type or content rule is skipped with
+    ``SkipFile`` so the rest of a batch is still received; its remaining
+    bytes are discarded instead of being buffered. A file that exceeds the
+    size limit aborts the whole upload with ``StopUpload`` without reading
+    the rest of the request body.
+    """
+
+    def __init__(self, request=None, policy: Optional[UploadPolicy] = None) -> None:
+        super().__init__(request)
+        self.policy = policy or get_upload_policy()
+        self.max_file_size = self.policy.max_file_size
+        self._hash: Optional["hashlib._Hash"] = None
+        self._header = b""
+        self._header_checked = False
+        self._probe: Optional[ImageProbe] = None
+        self._dimensions_checked = False
+        self._scanner = None
+        self._pending_error: Optional[str] = None
+        self._pending_reason = "error"
+        self._pending_abort = False
+        if request is not None:
+            request.vditor_upload_digests = defaultdict(list)
+            request.vditor_upload_errors = {}
+            request.vditor_upload_error_reasons = {}
+
+    def _reject(self, message: str, reason: str, abort: bool = False) -> None:
+        """Record why the current file was rejected and stop receiving it.
+
+        Args:
+            message: Reason reported to the editor
+            reason: Rule that rejected the file, from
+                ``vditor.metrics.REJECTION_REASONS``
+            abort: Abort the whole upload instead of skipping this file
+        """
+        logger.warning(
+            f"Upload of '{self.file_name}' rejected while streaming: {message}"
+        )
+        if self.request is not None:
+            self.request.vditor_upload_errors[self.file_name] = message
+            self.request.vditor_upload_error_reasons[self.file_name] = reason
+        if abort:
+            raise StopUpload(connection_reset=True)
+        raise SkipFile()
+
+    def new_file(self, field_name, file_name, *args, **kwargs) -> None:
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self._hash = hashlib.sha256()
+        self._header = b""
+        self._header_checked = False
+        self._probe = ImageProbe()
+        self._dimensions_checked = False
+        self._scanner = new_content_scanner()
+
+        # Rejection is deferred to the first chunk: raising here would run
+        # before later handlers open a file for this upload, and Django would
+        # then close the file of the previous, already completed upload.
+        is_valid, error_msg = self.policy.validate_filename(file_name)
+        self._pending_reason = "filename"
+        if is_valid:
+            is_valid, error_msg = self.policy.validate_type(
+                file_name, self.content_type
+            )
+            self._pending_reason = "type"
+        self._pending_error = None if is_valid else error_msg
+        self._pending_abort = False
+        if self.content_length and self.content_length > self.max_file_size:
+            self._pending_error = self._size_error()
+            self._pending_reason = "size"
+            self._pending_abort = True
+
+    def receive_data_chunk(self, raw_data: bytes, start: int) -> bytes:
+        if self._pending_error:
+            self._reject(
+                self._pending_error, self._pending_reason, abort=self._pending_abort
+            )
+        if start + len(raw_data) > self.max_file_size:
+            self._reject(self._size_error(), "size", abort=True)
+
+        if not self._header_checked:
+            self._header += raw_data[: HEADER_SIZE - len(self._header)]
+            if len(self._header) >= HEADER_SIZE:
+                self._check_header()
+        if not self._dimensions_checked:
+            self._probe.feed(raw_data)
+            if self._header_checked and self._probe.done:
+                self._check_dimensions()
+
+        self._hash.update(raw_data)
+        if self._scanner is not None and not self._scanner.feed(raw_data):
+            self._reject(_("File contains potentially dangerous content."), "content")
+        return raw_data
+
+    def file_complete(self, file_size: int) -> None:
+        # Files too short to check here, or that end before their dimensions,
+        # are validated again by the view
+        if self._pending_error:
+            return None
+        if self.request is not None:
+            key = (self.field_name, self.file_name, file_size)
+            self.request.vditor_upload_digests[key].append(self._hash.hexdigest())
+        return None
+
+    def _check_header(self) -> None:
+        self._header_checked = True
+        file_ext = Path(self.file_name).suffix.lower()
+        is_valid, error_msg = self.policy.validate_header(self._header, file_ext)
+        self._header = b""
+        if not is_valid:
+            self._reject(error_msg, "header")
+
+    def _check_dimensions(self) -> None:
+        self._dimensions_checked = True
+        is_valid, error_msg = validate_image_dimensions(self._probe)
+        if not is_valid:
+            self._reject(error_msg, "dimensions")
+
+    def _size_error(self) -> str:
+        size_mb = self.max_file_size / (1024 * 1024)
+        return _(f"File size exceeds maximum allowed size of {size_mb:.1f}MB.")
+
+
+class MemoryBudget:
+    """Process-wide count of upload bytes held in memory.
+
+    Thread-safe; shared by every request served by the process.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self._used = 0
+        self._peak = 0
+        self._spilled = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size: int) -> bool:
+        """Reserve memory for ``size`` more bytes, if the budget has room.
+
+        Returns:
+            True if the bytes may be kept in memory
+        """
+        with self._lock:
+            if self._used + size > self.limit:
+                return False
+            self._used += size
+            self._peak = max(self._peak, self._used)
+            return True
+
+    def release(self, size: int) -> None:
+        with self._lock:
+            self._used -= size
+
+    def record_spill(self) -> None:
+        with self._lock:
+            self._spilled += 1
+
+    def gauges(self) -> dict:
+        """Get the current state of the budget.
+
+        Returns:
+            Dictionary with ``in_memory_bytes``, ``peak_in_memory_bytes``,
+            ``budget_bytes`` and ``spilled_files``
+        """
+        with self._lock:
+            return {
+                "in_memory_bytes": self._used,
+                "peak_in_memory_bytes": self._peak,
+                "budget_bytes": self.limit,
+                "spilled_files": self._spilled,
+            }
+
+
+upload_memory_budget = MemoryBudget(UPLOAD_MEMORY_BUDGET or 0)
+
+
+class _BudgetedBuffer(io.BytesIO):
+    """In-memory upload content, released from the budget when closed."""
+
+    def __init__(self, budget: MemoryBudget) -> None:
+        super().__init__()
+        self.budget = budget
+        self.reserved = 0
+
+    def close(self) -> None:
+        if not self.closed:
+            self.budget.release(self.reserved)
+            self.reserved = 0
+        super().close()
+
+
+class SpooledUploadedFile(TemporaryUploadedFile):
+    """A temporary upload file created in ``VDITOR_UPLOAD_SPOOL_DIR``."""
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        _, ext = os.path.splitext(name)
+        file = tempfile.NamedTemporaryFile(
+            suffix=".upload" + ext,
+            dir=UPLOAD_SPOOL_DIR or settings.FILE_UPLOAD_TEMP_DIR,
+        )
+        UploadedFile.__init__(
+            self, file, name, content_type, size, charset, content_type_extra
+        )
+
+
+class MemoryBudgetUploadHandler(FileUploadHandler):
+    """Store uploads in memory while the process-wide budget has room.
+
+    Replaces Django's ``MemoryFileUploadHandler`` and
+    ``TemporaryFileUploadHandler``. Each file is kept in memory while it is
+    no larger than ``FILE_UPLOAD_MAX_MEMORY_SIZE`` and ``upload_memory_budget``
+    can reserve its bytes; otherwise it is spooled to a temporary file, and
+    bytes already buffered are moved there and released. The memory of an
+    in-memory upload is released when the file is closed, which Django does
+    once the response has been sent.
+    """
+
+    def __init__(self, request=None, budget: Optional[MemoryBudget] = None) -> None:
+        super().__init__(request)
+        self.budget = budget or upload_memory_budget
+        self.file = None
+
+    def new_file(self, *args, **kwargs) -> None:
+        super().new_file(*args, **kwargs)
+        self.file = _BudgetedBuffer(self.budget)
+
+    def receive_data_chunk(self, raw_data: bytes, start: int) -> None:
+        if isinstance(self.file, _BudgetedBuffer):
+            if start + len(raw_data) <= settings.FILE_UPLOAD_MAX_MEMORY_SIZE and (
+                self.budget.reserve(len(raw_data))
+            ):
+                self.file.reserved += len(raw_data)
+                self.file.write(raw_data)
+                return None
+            self._spill()
+        self.file.write(raw_data)
+        return None
+
+    def _spill(self) -> None:
+        """Move the buffered bytes of the current file to a temporary file."""
+        buffer = self.file
+        self.file = SpooledUploadedFile(
+            self.file_name, self.content_type, 0, self.charset, self.content_type_extra
+        )
+        self.file.write(buffer.getbuffer())
+        buffer.close()
+        self.budget.record_spill()
+
+    def file_complete(self, file_size: int) -> UploadedFile:
+        if isinstance(self.file, _BudgetedBuffer):
+            self.file.seek(0)
+            return InMemoryUploadedFile(
+                file=self.file,
+                field_name=self.field_name,
+                name=self.file_name,
+                content_type=self.content_type,
+                size=file_size,
+                charset=self.charset,
+                content_type_extra=self.content_type_extra,
+            )
+        self.file.seek(0)
+        self.file.size = file_size
+        return self.file
+
+    def upload_interrupted(self) -> None:
+        if self.file is not None:
+            self.file.close()
@@ -1,5 +1,20 @@
 from django.urls import path
-from .views import vditor_images_upload_view
+from .views import (
+    vditor_images_upload_async_view,
+    vditor_metrics_view,
+    vditor_images_upload_view,
+    vditor_raw_upload_view,
+    vditor_upload_by_hash_view,
+)
 
-
-urlpatterns = [path("uploads/", vditor_images_upload_view, name="uploads")]
+urlpatterns = [
+    path("uploads/", vditor_images_upload_view, name="uploads"),
+    path("uploads/async/", vditor_images_upload_async_view, name="uploads_async"),
+    path(
+        "uploads/by-hash/<str:content_hash>",
+        vditor_upload_by_hash_view,
+        name="uploads_by_hash",
+    ),
+    path("uploads/<str:filename>", vditor_raw_upload_view, name="uploads_raw"),
+    path("metrics/", vditor_metrics_view, name="metrics"),
+]
@@ -1,224 +1,209 @@
+import asyncio
+import contextvars
+import errno
 import hashlib
+import hmac
+import io
 import logging
 import os
+import re
+import tempfile
 import time
-import threading
+import uuid
 from pathlib import Path
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, NamedTuple, Optional, Sequence, Union
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.files.uploadedfile import UploadedFile
-from django.http import HttpRequest, JsonResponse
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage, storages
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler,
+)
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse
 from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.vary import vary_on_headers
+from django.utils.module_loading import import_string
 from werkzeug.utils import secure_filename
 
 from django.utils.translation import gettext_lazy as _
 
+from .admission import UploadsBusy, async_upload_slot, busy_response, upload_slot
+from .dedup import content_index
+from .idempotency import idempotent_upload
+from .imageinfo import PROBE_SIZE, ImageProbe, validate_image_dimensions
+from . import metrics as upload_metrics
+from .metrics import get_upload_metrics, incr_counter  # noqa: F401
+from .metrics import record_rejection, record_upload
+from .policy import DEFAULT_POLICY, UploadPolicy, get_upload_policy
+from .profiling import profile_sampled
+from .quota import charge_upload, check_quota, get_quota_owners
+from .ratelimit import get_client_address, rate_limit_uploads
+from .security import new_content_scanner
+from .tracing import server_timing, span
+
 logger = logging.getLogger(__name__)
 
-# Performance metrics with thread safety
-_upload_metrics = defaultdict(lambda: {'count': 0, 'total_time': 0, 'total_size': 0})
-_upload_metrics_lock = threading.Lock()
+# Promote uploads Django already spooled to disk instead of copying them
+ZERO_COPY_UPLOADS = getattr(settings, "VDITOR_UPLOAD_ZERO_COPY", True)
 
-# Configuration constants
-MAX_FILE_SIZE = getattr(
-    settings, "VDITOR_MAX_FILE_SIZE", 10 * 1024 * 1024
-)  # 10MB default
-ALLOWED_EXTENSIONS = getattr(
-    settings, "VDITOR_ALLOWED_EXTENSIONS", {".jpg", ".jpeg", ".png", ".gif", ".webp"}
-)
-ALLOWED_MIME_TYPES = getattr(
-    settings,
-    "VDITOR_ALLOWED_MIME_TYPES",
-    {
-        "image/jpeg",
-        "image/png",
-        "image/gif",
-        "image/webp",
-    },
+# Validate and hash uploads while the request body is still being received
+STREAMING_VALIDATION = getattr(settings, "VDITOR_STREAMING_VALIDATION", True)
+
+# Maximum number of files hashed and written concurrently for batch uploads
+UPLOAD_WORKERS = getattr(settings, "VDITOR_UPLOAD_WORKERS", 4)
+
+# Layout of stored uploads under MEDIA_ROOT: "flat" stores
+# "<hash16>_<name>.<ext>" at the top level, "sharded" stores
+# "<hash[0:2]>/<hash[2:4]>/<hash>.<ext>"
+UPLOAD_LAYOUT = getattr(settings, "VDITOR_UPLOAD_LAYOUT", "flat")
+UPLOAD_LAYOUTS = ("flat", "sharded")
+
+# Storage backend for uploads: an alias from STORAGES or a dotted path to a
+# Storage class. Uploads are written to MEDIA_ROOT directly when unset.
+UPLOAD_STORAGE = getattr(settings, "VDITOR_STORAGE", None)
+_storage_instances: dict[str, Storage] = {}
+
+_upload_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_WORKERS, thread_name_prefix="vditor-upload"
 )
 
-# Security constants
-MAGIC_NUMBERS = {
-    b"\xff\xd8\xff": "image/jpeg",
-    b"\x89PNG\r\n\x1a\n": "image/png",
-    b"GIF87a": "image/gif",
-    b"GIF89a": "image/gif",
-    b"RIFF": "image/webp",  # WebP files start with RIFF
-}
-
-MAX_FILENAME_LENGTH = 255
-FORBIDDEN_FILENAME_CHARS = set('<>:"/\\|?*\0')
-FORBIDDEN_FILENAMES = {
-    "CON",
-    "PRN",
-    "AUX",
-    "NUL",
-    "COM1",
-    "COM2",
-    "COM3",
-    "COM4",
-    "COM5",
-    "COM6",
-    "COM7",
-    "COM8",
-    "COM9",
-    "LPT1",
-    "LPT2",
-    "LPT3",
-    "LPT4",
-    "LPT5",
-    "LPT6",
-    "LPT7",
-    "LPT8",
-    "LPT9",
-}
+CONTENT_HASH_RE = re.compile(r"[0-9a-f]{64}")
 
 
 def update_upload_metrics(
     file_size: int, processing_time: float, success: bool = True
 ) -> None:
     """Update upload performance metrics.
-    
+
     Args:
         file_size: Size of uploaded file in bytes
         processing_time: Time taken to process upload in seconds
         success: Whether upload was successful
     """
-    try:
-        metric_key = 'successful' if success else 'failed'
-        with _upload_metrics_lock:
-            _upload_metrics[metric_key]['count'] += 1
-            _upload_metrics[metric_key]['total_time'] += processing_time
-            _upload_metrics[metric_key]['total_size'] += file_size
-    except Exception as e:
-        logger.warning(f"Failed to update upload metrics: {e}")
-
-
-def get_upload_metrics() -> dict:
-    """Get current upload performance metrics.
-    
-    Returns:
-        Dictionary with upload metrics
-    """
-    metrics = {}
-    with _upload_metrics_lock:
-        for key, data in _upload_metrics.items():
-            if data['count'] > 0:
-                metrics[key] = {
-                    'count': data['count'],
-                    'avg_time': data['total_time'] / data['count'],
-                    'total_size': data['total_size'],
-                    'avg_size': data['total_size'] / data['count']
-                }
-    return metrics
+    record_upload(file_size, processing_time, success)
 
 
-
-def _validate_filename_security(filename: str) -> tuple[bool, str]:
+def _validate_filename_security(
+    filename: str, policy: Optional[UploadPolicy] = None
+) -> tuple[bool, str]:
     """Validate filename for security issues.
 
     Args:
         filename: Original filename to validate
+        policy: Upload policy to apply, the default policy if None
 
     Returns:
         tuple: (is_valid, error_message)
     """
-    if not filename:
-        return False, _("File must have a name.")
-
-    if len(filename) > MAX_FILENAME_LENGTH:
-        return False, _("Filename is too long.")
+    return (policy or get_upload_policy()).validate_filename(filename)
 
-    # Check for forbidden characters
-    if any(char in FORBIDDEN_FILENAME_CHARS for char in filename):
-        return False, _("Filename contains forbidden characters.")
 
-    # Check for Windows forbidden filenames
-    name_without_ext = Path(filename).stem.upper()
-    if name_without_ext in FORBIDDEN_FILENAMES:
-        return False, _("Filename is reserved by the system.")
+def _validate_file_type(
+    filename: str,
+    content_type: Optional[str],
+    policy: Optional[UploadPolicy] = None,
+) -> tuple[bool, str]:
+    """Validate the file extension and declared MIME type of an upload.
 
-    # Check for path traversal attempts
-    if ".." in filename or filename.startswith("/") or "~" in filename:
-        return False, _("Invalid filename path.")
-
-    return True, ""
+    Returns:
+        tuple: (is_valid, error_message)
+    """
+    return (policy or get_upload_policy()).validate_type(filename, content_type)
 
 
-def _detect_file_type_by_magic(file_content: bytes) -> str:
-    """Detect file type by magic numbers for security.
+def _validate_file_header(
+    first_chunk: bytes, file_ext: str, policy: Optional[UploadPolicy] = None
+) -> tuple[bool, str]:
+    """Validate the magic numbers at the start of a file.
 
     Args:
-        file_content: First few bytes of the file
+        first_chunk: First bytes of the file (at least 32 when available)
+        file_ext: Lowercased file extension
+        policy: Upload policy to apply, the default policy if None
 
     Returns:
-        Detected MIME type or empty string if unknown
+        tuple: (is_valid, error_message)
     """
-    for magic_bytes, mime_type in MAGIC_NUMBERS.items():
-        if file_content.startswith(magic_bytes):
-            return mime_type
-    return ""
+    return (policy or get_upload_policy()).validate_header(first_chunk, file_ext)
+
+
+def _dangerous_content_error() -> "UploadError":
+    return UploadError(
+        _("File contains potentially dangerous content."), reason="content"
+    )
 
 
-def _validate_uploaded_file(uploaded_file: UploadedFile) -> tuple[bool, str]:
+def _validate_uploaded_file(
+    uploaded_file: UploadedFile, policy: Optional[UploadPolicy] = None
+) -> tuple[bool, str]:
     """Validate uploaded file for security and constraints.
 
+    Image dimensions read from the file are stored on it as
+    ``uploaded_file.image_dimensions`` (None when unknown), and the rule
+    that rejected the file as ``uploaded_file.rejection_reason``.
+
+    Args:
+        uploaded_file: File to validate
+        policy: Upload policy to apply, the default policy if None
+
     Returns:
         tuple: (is_valid, error_message)
     """
+    uploaded_file.image_dimensions = None
+    uploaded_file.rejection_reason = None
+    policy = policy or get_upload_policy()
+
     # Validate filename
-    is_valid_filename, error_msg = _validate_filename_security(uploaded_file.name)
+    is_valid_filename, error_msg = policy.validate_filename(uploaded_file.name)
     if not is_valid_filename:
+        uploaded_file.rejection_reason = "filename"
         return False, error_msg
 
     # Check file size
-    if uploaded_file.size > MAX_FILE_SIZE:
-        size_mb = MAX_FILE_SIZE / (1024 * 1024)
+    if uploaded_file.size > policy.max_file_size:
+        size_mb = policy.max_file_size / (1024 * 1024)
+        uploaded_file.rejection_reason = "size"
         return False, _(f"File size exceeds maximum allowed size of {size_mb:.1f}MB.")
 
     # Check minimum file size (avoid empty files)
     if uploaded_file.size < 10:  # At least 10 bytes
+        uploaded_file.rejection_reason = "empty"
         return False, _("File is too small or empty.")
 
-    # Check file extension
-    file_ext = Path(uploaded_file.name).suffix.lower()
-    if file_ext not in ALLOWED_EXTENSIONS:
-        allowed = ", ".join(sorted(ALLOWED_EXTENSIONS))
-        return False, _(f"File type not supported. Allowed types: {allowed}")
-
-    # Check declared MIME type
-    content_type = uploaded_file.content_type
-    if content_type and content_type not in ALLOWED_MIME_TYPES:
-        return False, _("Invalid file content type.")
+    # Check file extension and declared MIME type
+    is_valid_type, error_msg = policy.validate_type(
+        uploaded_file.name, uploaded_file.content_type
+    )
+    if not is_valid_type:
+        uploaded_file.rejection_reason = "type"
+        return False, error_msg
 
-    # Read first chunk to validate magic numbers
+    # Read first chunk to validate magic numbers and image dimensions
     try:
         uploaded_file.seek(0)  # Ensure we're at the beginning
-        first_chunk = uploaded_file.read(32)  # Read first 32 bytes
+        first_chunk = uploaded_file.read(PROBE_SIZE)
         uploaded_file.seek(0)  # Reset for later use
 
-        # Validate file magic numbers
-        detected_type = _detect_file_type_by_magic(first_chunk)
-        if detected_type and detected_type not in ALLOWED_MIME_TYPES:
-            return False, _("File content does not match allowed types.")
-
-        # Additional validation: ensure extension matches content
-        if detected_type:
-            expected_exts = {
-                "image/jpeg": {".jpg", ".jpeg"},
-                "image/png": {".png"},
-                "image/gif": {".gif"},
-                "image/webp": {".webp"},
-            }
-            if (
-                detected_type in expected_exts
-                and file_ext not in expected_exts[detected_type]
-            ):
-                return False, _("File extension does not match file content.")
+        file_ext = Path(uploaded_file.name).suffix.lower()
+        is_valid_header, error_msg = policy.validate_header(first_chunk, file_ext)
+        if not is_valid_header:
+            uploaded_file.rejection_reason = "header"
+            return False, error_msg
+
+        probe = _probe_uploaded_image(uploaded_file, first_chunk)
+        if probe.done:
+            is_valid_size, error_msg = validate_image_dimensions(probe)
+            if not is_valid_size:
+                uploaded_file.rejection_reason = "dimensions"
+                return False, error_msg
+            uploaded_file.image_dimensions = probe.dimensions
 
     except Exception as e:
         logger.warning(f"Could not validate file magic numbers: {e}")
@@ -228,31 +213,1134 @@ def _validate_uploaded_file(uploaded_file: UploadedFile) -> tuple[bool, str]:
     return True, ""
 
 
+def _probe_uploaded_image(
+    uploaded_file: UploadedFile, first_chunk: bytes
+) -> ImageProbe:
+    """Read the dimensions of an upload whose first chunk was already read.
+
+    JPEG segments are walked past the first chunk until the frame header is
+    found. Request bodies cannot be rewound that far; their probe is left
+    unfinished and they check their dimensions while they are streamed.
+    """
+    probe = ImageProbe()
+    if probe.feed(first_chunk) or isinstance(uploaded_file, RequestBodyUpload):
+        return probe
+    try:
+        uploaded_file.seek(len(first_chunk))
+        while not probe.done:
+            chunk = uploaded_file.read(PROBE_SIZE)
+            if not chunk:
+                probe.close()
+            else:
+                probe.feed(chunk)
+    finally:
+        uploaded_file.seek(0)
+    return probe
+
+
+def _stream_to_temp_file(
+    uploaded_file: UploadedFile, upload_path: Path, content_hash: Optional[str] = None
+) -> tuple[Path, str, int]:
+    """Write an upload to a temporary file while hashing it.
+
+    Each chunk is read exactly once: it updates the SHA-256 digest, is
+    scanned for dangerous content (``VDITOR_SCAN_UPLOAD_CONTENT``) and is
+    written to disk in the same iteration.
+
+    Args:
+        uploaded_file: File to persist
+        upload_path: Directory the temporary file is created in
+        content_hash: Already known SHA-256 hex digest; skips hashing and
+            scanning, which were done when it was computed
+
+    Returns:
+        tuple: (temp_path, content_hash, bytes_written)
+
+    Raises:
+        UploadError: If the file contains dangerous content
+    """
+    file_hash = None if content_hash else hashlib.sha256()
+    scanner = None if content_hash else new_content_scanner()
+    bytes_written = 0
+    temp_path = upload_path / f".{uuid.uuid4().hex}.tmp"
+
+    try:
+        with open(temp_path, "xb") as f:
+            for chunk in uploaded_file.chunks():
+                if file_hash is not None:
+                    file_hash.update(chunk)
+                if scanner is not None and not scanner.feed(chunk):
+                    raise _dangerous_content_error()
+                f.write(chunk)
+                bytes_written += len(chunk)
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    if file_hash is not None:
+        content_hash = file_hash.hexdigest()
+    return temp_path, content_hash, bytes_written
+
+
+def _kernel_copy(source_path: str, dest_path: Path) -> int:
+    """Copy a file without passing its data through userspace buffers.
+
+    Uses ``copy_file_range`` where available and falls back to ``sendfile``,
+    then to a regular buffered copy.
+
+    Args:
+        source_path: Path of the file to copy
+        dest_path: Path of the new file, which must not exist yet
+
+    Returns:
+        Number of bytes copied
+    """
+    with open(source_path, "rb") as src, open(dest_path, "xb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        for copy_func in ("copy_file_range", "sendfile"):
+            if not hasattr(os, copy_func):
+                continue
+            try:
+                while copied < size:
+                    if copy_func == "copy_file_range":
+                        sent = os.copy_file_range(
+                            src.fileno(), dst.fileno(), size - copied
+                        )
+                    else:
+                        sent = os.sendfile(
+                            dst.fileno(), src.fileno(), copied, size - copied
+                        )
+                    if sent == 0:
+                        break
+                    copied += sent
+                return copied
+            except OSError as e:
+                if copied:
+                    raise
+                logger.debug(f"{copy_func} unavailable for upload copy: {e}")
+
+        while chunk := src.read(64 * 1024):
+            dst.write(chunk)
+            copied += len(chunk)
+        return copied
+
+
+def _get_upload_storage() -> Optional[Storage]:
+    """Get the configured upload storage, or None to use MEDIA_ROOT directly."""
+    if not UPLOAD_STORAGE:
+        return None
+    if UPLOAD_STORAGE in settings.STORAGES:
+        return storages[UPLOAD_STORAGE]
+    storage = _storage_instances.get(UPLOAD_STORAGE)
+    if storage is None:
+        storage = _storage_instances.setdefault(
+            UPLOAD_STORAGE, import_string(UPLOAD_STORAGE)()
+        )
+    return storage
+
+
+def _stored_url(stored_name: str) -> str:
+    """Get the public URL of a stored upload."""
+    storage = _get_upload_storage()
+    if storage is not None:
+        return storage.url(stored_name)
+    return os.path.join(settings.MEDIA_URL, stored_name)
+
+
+def _open_stored_file(stored_name: str):
+    """Open a stored upload for reading in binary mode."""
+    storage = _get_upload_storage()
+    if storage is not None:
+        return storage.open(stored_name, "rb")
+    return open(Path(settings.MEDIA_ROOT) / stored_name, "rb")
+
+
+def _write_stored_file(stored_name: str, content: bytes) -> None:
+    """Write a generated file under a stored name, replacing any existing one.
+
+    Local files are replaced atomically so readers never see partial data.
+    """
+    storage = _get_upload_storage()
+    if storage is not None:
+        if storage.exists(stored_name):
+            storage.delete(stored_name)
+        storage.save(stored_name, ContentFile(content))
+        return
+
+    file_path = Path(settings.MEDIA_ROOT) / stored_name
+    temp_path = file_path.parent / f".{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, "xb") as f:
+            f.write(content)
+        os.chmod(temp_path, 0o644)
+        temp_path.rename(file_path)
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def _hash_upload(uploaded_file: UploadedFile) -> str:
+    """Compute the SHA-256 hex digest of an upload without storing it.
+
+    The upload is scanned for dangerous content in the same pass.
+
+    Raises:
+        UploadError: If the file contains dangerous content
+    """
+    file_hash = hashlib.sha256()
+    scanner = new_content_scanner()
+    for chunk in uploaded_file.chunks():
+        file_hash.update(chunk)
+        if scanner is not None and not scanner.feed(chunk):
+            raise _dangerous_content_error()
+    return file_hash.hexdigest()
+
+
+def _stored_name(
+    content_hash: str, file_stem: str, file_ext: str, layout: Optional[str] = None
+) -> str:
+    """Get the name content is stored under, relative to MEDIA_ROOT.
+
+    Args:
+        content_hash: Hex SHA-256 digest of the content
+        file_stem: Sanitized filename stem
+        file_ext: Sanitized filename extension
+        layout: Storage layout, defaults to ``VDITOR_UPLOAD_LAYOUT``
+
+    Returns:
+        Stored name, using "/" as separator
+    """
+    layout = layout or UPLOAD_LAYOUT
+    if layout == "sharded":
+        return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}{file_ext}"
+    # Use first 16 chars of the hash for uniqueness
+    return f"{content_hash[:16]}_{file_stem}{file_ext}"
+
+
+def _promote_temporary_file(source_path: str, file_path: Path) -> int:
+    """Move an upload Django spooled to disk into place without copying it.
+
+    The spooled file is hard-linked to its final name. When the upload
+    directory lives on another filesystem, the file is copied in the kernel
+    to a temporary file which is then renamed atomically.
+
+    Args:
+        source_path: Path of the spooled upload
+        file_path: Final path of the stored file
+
+    Returns:
+        Number of bytes copied (0 when the file was linked)
+    """
+    try:
+        os.link(source_path, file_path)
+        os.chmod(file_path, 0o644)
+        return 0
+    except FileExistsError:
+        # Same content-addressed name already on disk
+        return 0
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EMLINK):
+            raise
+        logger.debug(f"Cannot link {source_path} into {file_path.parent}: {e}")
+
+    temp_path = file_path.parent / f".{uuid.uuid4().hex}.tmp"
+    try:
+        bytes_written = _kernel_copy(source_path, temp_path)
+        os.chmod(temp_path, 0o644)
+        temp_path.rename(file_path)
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    return bytes_written
+
+
+class StagedUpload(NamedTuple):
+    """An upload that has been hashed, and usually written, but not stored.
+
+    Staging only touches the filesystem, so it can run on worker threads;
+    storing consults the content index and must run in the request thread.
+    """
+
+    uploaded_file: UploadedFile
+    upload_path: Path
+    file_stem: str
+    file_ext: str
+    content_hash: str
+    # Temporary copy inside upload_path, renamed into place when stored
+    temp_path: Optional[Path] = None
+    # Spooled upload promoted into place without copying when stored
+    source_path: Optional[str] = None
+    bytes_written: int = 0
+    start_time: float = 0.0
+
+
+def _stage_upload(
+    uploaded_file: UploadedFile, upload_path: Path, file_stem: str, file_ext: str
+) -> StagedUpload:
+    """Hash an upload and write it to a temporary file in a single pass.
+
+    Nothing is written when the streaming upload handler already hashed the
+    file (``uploaded_file.content_hash``) and the content is probably stored
+    already, or when a spooled upload can be promoted without copying
+    (``VDITOR_UPLOAD_ZERO_COPY``). With a storage backend (``VDITOR_STORAGE``)
+    the file is only hashed; the backend streams it once it is named. Only
+    request bodies, which cannot be read twice, are spooled to
+    ``upload_path`` first.
+
+    Args:
+        uploaded_file: File to stage
+        upload_path: Destination directory
+        file_stem: Sanitized filename stem
+        file_ext: Sanitized filename extension
+
+    Returns:
+        StagedUpload ready for ``_store_staged_upload``
+    """
+    content_hash = getattr(uploaded_file, "content_hash", None)
+    if content_hash and content_index.might_contain(content_hash):
+        return StagedUpload(
+            uploaded_file, upload_path, file_stem, file_ext, content_hash
+        )
+
+    if _get_upload_storage() is not None and not isinstance(
+        uploaded_file, RequestBodyUpload
+    ):
+        return StagedUpload(
+            uploaded_file,
+            upload_path,
+            file_stem,
+            file_ext,
+            content_hash or _hash_upload(uploaded_file),
+        )
+
+    if ZERO_COPY_UPLOADS and isinstance(uploaded_file, TemporaryUploadedFile):
+        return StagedUpload(
+            uploaded_file,
+            upload_path,
+            file_stem,
+            file_ext,
+            content_hash or _hash_upload(uploaded_file),
+            source_path=uploaded_file.temporary_file_path(),
+        )
+
+    temp_path, content_hash, bytes_written = _stream_to_temp_file(
+        uploaded_file, upload_path, content_hash
+    )
+    return StagedUpload(
+        uploaded_file,
+        upload_path,
+        file_stem,
+        file_ext,
+        content_hash,
+        temp_path=temp_path,
+        bytes_written=bytes_written,
+    )
+
+
+def _store_staged_upload(staged: StagedUpload) -> tuple[str, bool, int]:
+    """Store a staged upload under its content-addressed name.
+
+    Content already in the index is deduplicated whatever name it was
+    uploaded under, and the staged copy is dropped. Otherwise the staged file
+    is atomically renamed (or promoted) into place and recorded.
+
+    Args:
+        staged: Upload returned by ``_stage_upload``
+
+    Returns:
+        tuple: (stored_name, deduplicated, bytes_written)
+    """
+    storage = _get_upload_storage()
+    if storage is not None:
+        return _save_staged_upload(staged, storage)
+
+    content_hash = staged.content_hash
+    bytes_written = staged.bytes_written
+    temp_path = staged.temp_path
+
+    try:
+        with span("dedup"):
+            existing_name = content_index.lookup(content_hash)
+            if existing_name is not None:
+                if (staged.upload_path / existing_name).exists():
+                    logger.info(
+                        f"Content already stored, using existing: {existing_name}"
+                    )
+                    return existing_name, True, bytes_written
+                logger.warning(
+                    f"Indexed file {existing_name} is missing, storing again"
+                )
+                content_index.forget(content_hash)
+
+        with span("write"):
+            unique_filename = _stored_name(
+                content_hash, staged.file_stem, staged.file_ext
+            )
+            file_path = staged.upload_path / unique_filename
+            file_path.parent.mkdir(parents=True, exist_ok=True, mode=0o755)
+
+            if staged.source_path:
+                bytes_written = _promote_temporary_file(staged.source_path, file_path)
+            else:
+                if temp_path is None:
+                    # Staging skipped writing because the content looked stored
+                    temp_path, _unused, bytes_written = _stream_to_temp_file(
+                        staged.uploaded_file, staged.upload_path, content_hash
+                    )
+
+                # Set secure file permissions before publishing the file
+                os.chmod(temp_path, 0o644)
+
+                # Atomic move to final location
+                temp_path.rename(file_path)
+
+            stored_name = content_index.record(
+                content_hash, unique_filename, staged.uploaded_file.size
+            )
+            if stored_name != unique_filename:
+                # Another worker stored the same content concurrently
+                file_path.unlink(missing_ok=True)
+                return stored_name, True, bytes_written
+    finally:
+        if temp_path is not None:
+            temp_path.unlink(missing_ok=True)
+
+    return unique_filename, False, bytes_written
+
+
+def _save_staged_upload(
+    staged: StagedUpload, storage: Storage
+) -> tuple[str, bool, int]:
+    """Store a staged upload through a Django storage backend.
+
+    Names are content-addressed, so a name that already exists in the
+    storage holds the same content and is reused without writing.
+
+    Args:
+        staged: Upload returned by ``_stage_upload``
+        storage: Storage backend to write to
+
+    Returns:
+        tuple: (stored_name, deduplicated, bytes_written)
+    """
+    content_hash = staged.content_hash
+    temp_path = staged.temp_path
+
+    try:
+        with span("dedup"):
+            existing_name = content_index.lookup(content_hash)
+            if existing_name is not None:
+                if storage.exists(existing_name):
+                    logger.info(
+                        f"Content already stored, using existing: {existing_name}"
+                    )
+                    return existing_name, True, 0
+                logger.warning(
+                    f"Indexed file {existing_name} is missing, storing again"
+                )
+                content_index.forget(content_hash)
+
+        with span("write"):
+            unique_filename = _stored_name(
+                content_hash, staged.file_stem, staged.file_ext
+            )
+            saved = False
+            if not storage.exists(unique_filename):
+                if temp_path is not None:
+                    with open(temp_path, "rb") as f:
+                        saved_name = storage.save(unique_filename, File(f))
+                else:
+                    saved_name = storage.save(unique_filename, staged.uploaded_file)
+                if saved_name != unique_filename:
+                    # Another node saved the same content since the check
+                    storage.delete(saved_name)
+                else:
+                    saved = True
+            bytes_written = staged.uploaded_file.size if saved else 0
+
+            stored_name = content_index.record(
+                content_hash, unique_filename, staged.uploaded_file.size
+            )
+            if stored_name != unique_filename:
+                # Another worker stored the same content concurrently
+                if saved:
+                    storage.delete(unique_filename)
+                return stored_name, True, bytes_written
+    finally:
+        if temp_path is not None:
+            temp_path.unlink(missing_ok=True)
+
+    return unique_filename, not saved, bytes_written
+
+
+def _store_uploaded_file(
+    uploaded_file: UploadedFile, upload_path: Path, file_stem: str, file_ext: str
+) -> tuple[str, bool, int]:
+    """Persist an upload under its content-addressed name.
+
+    Stages the file in a single hash-and-write pass and stores it; see
+    ``_stage_upload`` and ``_store_staged_upload``.
+
+    Args:
+        uploaded_file: File to persist
+        upload_path: Destination directory
+        file_stem: Sanitized filename stem
+        file_ext: Sanitized filename extension
+
+    Returns:
+        tuple: (stored_name, deduplicated, bytes_written)
+    """
+    return _store_staged_upload(
+        _stage_upload(uploaded_file, upload_path, file_stem, file_ext)
+    )
+
+
+class UploadError(Exception):
+    """Raised when a single uploaded file cannot be processed.
+
+    Attributes:
+        message: Error message returned to the editor
+        status: HTTP status code for single-file responses
+        reason: Rule that rejected the file, from
+            ``vditor.metrics.REJECTION_REASONS``
+    """
+
+    def __init__(self, message: str, status: int = 400, reason: str = "error") -> None:
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.reason = reason
+
+
+class RequestBodyUpload(UploadedFile):
+    """Uploaded file backed by the raw, unparsed request body.
+
+    The first chunk of the body is buffered when the file is first read so
+    validation can inspect the header and rewind; the rest is streamed from
+    the request while the file is being stored.
+    """
+
+    def __init__(
+        self,
+        request: HttpRequest,
+        name: str,
+        content_type: Optional[str],
+        size: int,
+    ) -> None:
+        super().__init__(request, name, content_type, size)
+        self._head: Optional[bytes] = None
+        self._position = 0
+
+    def _load_head(self) -> bytes:
+        if self._head is None:
+            self._head = self.file.read(min(self.size, self.DEFAULT_CHUNK_SIZE))
+        return self._head
+
+    def read(self, num_bytes: int = -1) -> bytes:
+        head = self._load_head()
+        data = b""
+        if self._position < len(head):
+            end = len(head) if num_bytes < 0 else self._position + num_bytes
+            data = head[self._position : end]
+            self._position += len(data)
+            if num_bytes >= 0:
+                num_bytes -= len(data)
+                if num_bytes == 0:
+                    return data
+
+        more = self.file.read(num_bytes)
+        self._position += len(more)
+        return data + more
+
+    def seek(self, position: int, whence: int = os.SEEK_SET) -> int:
+        head = self._load_head()
+        if whence != os.SEEK_SET or self._position > len(head) or position > len(head):
+            raise io.UnsupportedOperation(
+                "Request body can only be rewound within its first chunk."
+            )
+        self._position = position
+        return position
+
+    def tell(self) -> int:
+        return self._position
+
+    def chunks(self, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        """Stream the body, checking image dimensions as they arrive.
+
+        Validation only sees the first chunk, so dimensions past it (JPEG
+        frame headers after large metadata) are checked here.
+
+        Raises:
+            UploadError: If the body is truncated or the image dimensions
+                are invalid
+        """
+        self.seek(0)
+        chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        probe = ImageProbe()
+        while chunk := self.read(chunk_size):
+            if not probe.done and probe.feed(chunk):
+                self._check_dimensions(probe)
+            yield chunk
+        if self._position != self.size:
+            raise UploadError(_("Upload ended before the declared Content-Length."))
+        if not probe.done:
+            probe.close()
+            self._check_dimensions(probe)
+
+    def _check_dimensions(self, probe: ImageProbe) -> None:
+        is_valid, error_msg = validate_image_dimensions(probe)
+        if not is_valid:
+            raise UploadError(error_msg, reason="dimensions")
+        self.image_dimensions = probe.dimensions
+
+
+def _spool_request_body(
+    upload: RequestBodyUpload, policy: Optional[UploadPolicy] = None
+) -> TemporaryUploadedFile:
+    """Receive a raw request body into a temporary file.
+
+    Lets the raw upload view take its upload slot only once the body has
+    arrived, like the multipart views. The body is validated against its
+    first chunk before it is received, and hashed and scanned while it is
+    written, so it is not read again to be hashed.
+
+    Args:
+        upload: Request body to receive
+        policy: Upload policy to apply, the default policy if None
+
+    Returns:
+        Spooled upload, with ``content_hash`` set
+
+    Raises:
+        UploadError: If the body is invalid or ends early
+    """
+    from .uploadhandler import SpooledUploadedFile
+
+    is_valid, error_msg = _validate_uploaded_file(upload, policy)
+    if not is_valid:
+        raise UploadError(error_msg, reason=upload.rejection_reason or "error")
+
+    spooled = SpooledUploadedFile(upload.name, upload.content_type, upload.size, None)
+    file_hash = hashlib.sha256()
+    scanner = new_content_scanner()
+    try:
+        for chunk in upload.chunks():
+            file_hash.update(chunk)
+            if scanner is not None and not scanner.feed(chunk):
+                raise _dangerous_content_error()
+            spooled.write(chunk)
+        spooled.flush()
+        spooled.seek(0)
+    except BaseException:
+        spooled.close()
+        raise
+    spooled.content_hash = file_hash.hexdigest()
+    return spooled
+
+    def multiple_chunks(self, chunk_size: Optional[int] = None) -> bool:
+        return self.size > (chunk_size or self.DEFAULT_CHUNK_SIZE)
+
+
+# (file_url, deduplicated, (width, height) or None)
+UploadOutcome = tuple[str, bool, Optional[tuple[int, int]]]
+
+# (filename, outcome or None, error or None)
+UploadResult = tuple[str, Optional[UploadOutcome], Optional[UploadError]]
+
+
+def _prepare_upload(
+    uploaded_file: UploadedFile,
+    client_ip: str,
+    policy: Optional[UploadPolicy] = None,
+) -> StagedUpload:
+    """Validate a single uploaded file and stage it for storage.
+
+    Only touches the filesystem, so batches can be prepared concurrently on
+    the upload thread pool.
+
+    Args:
+        uploaded_file: File to process
+        client_ip: Client address used for logging
+        policy: Upload policy to apply, the default policy if None
+
+    Returns:
+        StagedUpload to pass to ``_complete_upload``
+
+    Raises:
+        UploadError: If the file is invalid or cannot be written
+    """
+    start_time = time.time()
+    original_filename = uploaded_file.name
+
+    try:
+        # Validate uploaded file
+        try:
+            with span("validate"):
+                is_valid, error_msg = _validate_uploaded_file(uploaded_file, policy)
+        except Exception as e:
+            logger.error(f"File validation error from {client_ip}: {e}")
+            raise UploadError(_("File validation failed."), status=500)
+        if not is_valid:
+            logger.warning(
+                f"Invalid file upload attempt from {client_ip}: {error_msg}. "
+                f"File: {original_filename}, Size: {uploaded_file.size}"
+            )
+            raise UploadError(
+                error_msg, reason=uploaded_file.rejection_reason or "error"
+            )
+
+        # Generate safe filename; the content hash is added once it is stored
+        try:
+            safe_filename = secure_filename(original_filename)
+            if not safe_filename:
+                safe_filename = "unnamed_file.jpg"  # Default with extension
+
+            file_stem = Path(safe_filename).stem[:50]  # Limit filename length
+            file_ext = Path(safe_filename).suffix
+            if _get_upload_storage() is not None:
+                # Only used to spool request bodies before they are saved
+                upload_path = Path(
+                    settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir()
+                )
+            else:
+                upload_path = Path(settings.MEDIA_ROOT)
+        except Exception as e:
+            logger.error(
+                f"Failed to process filename '{original_filename}' "
+                f"from {client_ip}: {e}"
+            )
+            raise UploadError(_("Invalid filename."))
+
+        # Ensure upload directory exists with secure permissions
+        try:
+            upload_path.mkdir(parents=True, exist_ok=True, mode=0o755)
+        except OSError as e:
+            logger.error(
+                f"Failed to create upload directory '{upload_path}' "
+                f"from {client_ip}: {e}"
+            )
+            raise UploadError(_("Failed to create upload directory."), status=500)
+
+        # Hash and write the file in a single pass over its chunks
+        try:
+            with span("hash", size=uploaded_file.size):
+                staged = _stage_upload(uploaded_file, upload_path, file_stem, file_ext)
+        except UploadError:
+            raise
+        except OSError as e:
+            logger.error(f"Failed to write file from {client_ip}: {e}")
+            raise UploadError(_("Failed to save uploaded file."), status=500)
+        except Exception as e:
+            logger.error(f"Unexpected error during file save from {client_ip}: {e}")
+            raise UploadError(_("An unexpected error occurred."), status=500)
+    except UploadError:
+        update_upload_metrics(
+            uploaded_file.size or 0, time.time() - start_time, success=False
+        )
+        raise
+
+    return staged._replace(start_time=start_time)
+
+
+def _complete_upload(staged: StagedUpload, client_ip: str) -> UploadOutcome:
+    """Store a prepared upload, deduplicating it against the content index.
+
+    Accesses the database, so it must run in the request thread.
+
+    Args:
+        staged: Upload returned by ``_prepare_upload``
+        client_ip: Client address used for logging
+
+    Returns:
+        tuple: (file_url, deduplicated, dimensions)
+
+    Raises:
+        UploadError: If the file cannot be saved
+    """
+    uploaded_file = staged.uploaded_file
+    try:
+        try:
+            stored_name, deduplicated, bytes_written = _store_staged_upload(staged)
+        except UploadError:
+            raise
+        except OSError as e:
+            logger.error(f"Failed to write file from {client_ip}: {e}")
+            raise UploadError(_("Failed to save uploaded file."), status=500)
+        except Exception as e:
+            logger.error(f"Unexpected error during file save from {client_ip}: {e}")
+            raise UploadError(_("An unexpected error occurred."), status=500)
+    except UploadError:
+        update_upload_metrics(
+            uploaded_file.size or 0, time.time() - staged.start_time, success=False
+        )
+        raise
+
+    if not deduplicated:
+        from .derivatives import queue_derivatives
+        from .optimize import optimize_new_upload
+
+        # Post-processing is optional; never fail the upload because of it
+        try:
+            optimize_new_upload(staged.content_hash, stored_name, uploaded_file.size)
+        except Exception as e:
+            logger.error(f"Failed to optimize {stored_name}: {e}")
+        try:
+            queue_derivatives(staged.content_hash, stored_name)
+        except Exception as e:
+            logger.error(f"Failed to queue derivatives for {stored_name}: {e}")
+
+    file_url = _stored_url(stored_name)
+    incr_counter("dedup_hits" if deduplicated else "dedup_misses")
+    update_upload_metrics(
+        uploaded_file.size, time.time() - staged.start_time, success=True
+    )
+    logger.info(
+        f"Processed upload from {client_ip}: {uploaded_file.name} -> "
+        f"{stored_name} ({bytes_written} bytes"
+        f"{', deduplicated' if deduplicated else ''})"
+    )
+    return file_url, deduplicated, getattr(uploaded_file, "image_dimensions", None)
+
+
+def _process_upload(uploaded_file: UploadedFile, client_ip: str) -> UploadOutcome:
+    """Validate and persist a single uploaded file.
+
+    Args:
+        uploaded_file: File to process
+        client_ip: Client address used for logging
+
+    Returns:
+        tuple: (file_url, deduplicated, dimensions)
+
+    Raises:
+        UploadError: If the file is invalid or cannot be saved
+    """
+    return _complete_upload(_prepare_upload(uploaded_file, client_ip), client_ip)
+
+
+def _prepare_upload_result(
+    uploaded_file: UploadedFile,
+    client_ip: str,
+    policy: Optional[UploadPolicy] = None,
+) -> Union[StagedUpload, UploadError]:
+    """Prepare a single file, returning errors instead of raising them."""
+    try:
+        return _prepare_upload(uploaded_file, client_ip, policy)
+    except UploadError as e:
+        return e
+
+
+def _complete_upload_results(
+    uploaded_files: list[UploadedFile],
+    prepared: list[Union[StagedUpload, UploadError]],
+    client_ip: str,
+    quota_owners: Sequence[str] = (),
+) -> list[UploadResult]:
+    """Complete prepared files in upload order, collecting errors.
+
+    Stored files are charged to ``quota_owners``.
+    """
+    results: list[UploadResult] = []
+    for uploaded_file, staged in zip(uploaded_files, prepared):
+        if isinstance(staged, UploadError):
+            results.append((uploaded_file.name, None, staged))
+            continue
+        try:
+            outcome = _complete_upload(staged, client_ip)
+        except UploadError as e:
+            results.append((uploaded_file.name, None, e))
+            continue
+        try:
+            charge_upload(quota_owners, staged.content_hash, uploaded_file.size)
+        except Exception as e:
+            # Reconciled later by vditor_reconcile_quota
+            logger.error(f"Failed to charge upload quota for {uploaded_file.name}: {e}")
+        results.append((uploaded_file.name, outcome, None))
+    return results
+
+
+def _process_uploads(
+    uploaded_files: list[UploadedFile],
+    client_ip: str,
+    policy: Optional[UploadPolicy] = None,
+    quota_owners: Sequence[str] = (),
+) -> list[UploadResult]:
+    """Process uploaded files, hashing and writing them concurrently.
+
+    A single file is processed inline. For batches, validation, hashing and
+    writing are spread over the shared upload thread pool, which bounds the
+    number of files written at the same time across all requests; storing
+    and indexing then happen in the request thread. An upload slot
+    (``vditor.admission.upload_slot``) is held throughout.
+
+    Args:
+        uploaded_files: Files to process
+        client_ip: Client address used for logging
+        policy: Upload policy to apply, the default policy if None
+        quota_owners: Owners stored files are charged to
+
+    Returns:
+        List of (filename, result, error) in upload order, where result is
+        the ``_process_upload`` return value or None on error
+
+    Raises:
+        UploadsBusy: If no upload slot was freed in time
+    """
+    with upload_slot():
+        if len(uploaded_files) == 1:
+            prepared = [_prepare_upload_result(uploaded_files[0], client_ip, policy)]
+        else:
+            # Run each file in a copy of the request context so its spans are
+            # reported with the request's
+            futures = [
+                _upload_executor.submit(
+                    contextvars.copy_context().run,
+                    _prepare_upload_result,
+                    uploaded_file,
+                    client_ip,
+                    policy,
+                )
+                for uploaded_file in uploaded_files
+            ]
+            prepared = [future.result() for future in futures]
+        return _complete_upload_results(
+            uploaded_files, prepared, client_ip, quota_owners
+        )
+
+
+def _build_upload_response(
+    results: list[UploadResult],
+    client_ip: str,
+    start_time: float,
+) -> JsonResponse:
+    """Build the editor JSON response from per-file upload results.
+
+    Args:
+        results: Results as returned by ``_process_uploads``
+        client_ip: Client address used for logging
+        start_time: Time the request started processing
+
+    Returns:
+        JsonResponse in the format expected by Vditor
+    """
+    succ_map = {}
+    dimensions = {}
+    err_files = []
+    errors = []
+    all_deduplicated = True
+    for filename, result, error in results:
+        if error is not None:
+            err_files.append(filename)
+            errors.append(error)
+            record_rejection(error.reason)
+            continue
+        file_url, deduplicated, image_dimensions = result
+        succ_map[filename] = file_url
+        if image_dimensions is not None:
+            width, height = image_dimensions
+            dimensions[filename] = {"width": width, "height": height}
+        all_deduplicated = all_deduplicated and deduplicated
+
+    processing_time = time.time() - start_time
+
+    if not succ_map:
+        logger.warning(
+            f"Upload failed in {processing_time:.3f}s from {client_ip}: "
+            f"{len(err_files)} file(s) rejected"
+        )
+        return JsonResponse(
+            {
+                "msg": errors[0].message,
+                "code": 1,
+                "data": {
+                    "errFiles": err_files,
+                    "succMap": {},
+                },
+            },
+            status=errors[0].status,
+        )
+
+    if errors:
+        msg = _("Some files could not be uploaded.")
+    elif all_deduplicated:
+        msg = _("File uploaded successfully (deduplicated).")
+    else:
+        msg = _("Success!")
+
+    response = JsonResponse(
+        {
+            "msg": msg,
+            "code": 0,
+            "data": {
+                "errFiles": err_files,
+                "succMap": succ_map,
+                "dimensions": dimensions,
+            },
+        }
+    )
+    # Cache successful uploads for better performance
+    response["Cache-Control"] = "public, max-age=3600"  # Cache for 1 hour
+
+    logger.info(
+        f"Upload completed in {processing_time:.3f}s from {client_ip}: "
+        f"{len(succ_map)} stored, {len(err_files)} rejected"
+    )
+    return response
+
+
+def _install_upload_handler(
+    request: HttpRequest, policy: Optional[UploadPolicy] = None
+) -> None:
+    """Validate and hash files while the request body is received.
+
+    Also replaces Django's storing handlers with ``MemoryBudgetUploadHandler``
+    when ``VDITOR_UPLOAD_MEMORY_BUDGET`` is set. Must be called before
+    ``request.FILES`` is accessed.
+    """
+    from . import uploadhandler
+
+    handlers = list(request.upload_handlers)
+    if uploadhandler.UPLOAD_MEMORY_BUDGET is not None:
+        handlers = [
+            handler
+            for handler in handlers
+            if not isinstance(
+                handler, (MemoryFileUploadHandler, TemporaryFileUploadHandler)
+            )
+        ]
+        handlers.append(uploadhandler.MemoryBudgetUploadHandler(request))
+    if STREAMING_VALIDATION:
+        handlers.insert(0, uploadhandler.VditorUploadHandler(request, policy))
+    request.upload_handlers = handlers
+
+
+def _request_upload_policy(config: str) -> Optional[UploadPolicy]:
+    """Get the upload policy bound to the route.
+
+    The policy name comes from the URL pattern's extra kwargs, never from the
+    request, so clients cannot pick a looser policy than the route allows.
+    """
+    return get_upload_policy(config)
+
+
+def _check_upload_quota(
+    request: HttpRequest, client_ip: str
+) -> tuple[list[str], Optional[JsonResponse]]:
+    """Check the quotas of the owners of a request before its body is read.
+
+    The whole ``Content-Length`` is counted, so a request is rejected if it
+    could exceed a quota.
+
+    Returns:
+        tuple: (quota_owners, error_response or None)
+    """
+    owners = get_quota_owners(request)
+    if not owners:
+        return owners, None
+    try:
+        size = max(0, int(request.META.get("CONTENT_LENGTH") or 0))
+    except ValueError:
+        size = 0
+    exceeded = check_quota(owners, size)
+    if exceeded is None:
+        return owners, None
+
+    logger.warning(f"Upload quota of {exceeded} exceeded from {client_ip}")
+    record_rejection("quota")
+    return owners, JsonResponse(
+        {
+            "msg": _("Upload quota exceeded."),
+            "code": 1,
+        },
+        status=413,
+    )
+
+
+def _unknown_policy_response(config: str, client_ip: str) -> JsonResponse:
+    logger.error(f"Upload route bound to unknown config '{config}' from {client_ip}")
+    record_rejection("config")
+    return JsonResponse(
+        {
+            "msg": _("Unknown upload configuration."),
+            "code": 1,
+        },
+        status=400,
+    )
+
+
+def _streamed_upload_results(
+    request: HttpRequest, uploaded_files: list[UploadedFile], field_name: str
+) -> list[UploadResult]:
+    """Apply the results of streaming validation to parsed files.
+
+    Attaches content hashes computed by ``VditorUploadHandler`` to the parsed
+    files and returns results for files it rejected mid-upload.
+    """
+    digests = getattr(request, "vditor_upload_digests", {})
+    for uploaded_file in uploaded_files:
+        key = (field_name, uploaded_file.name, uploaded_file.size)
+        if digests.get(key):
+            uploaded_file.content_hash = digests[key].pop(0)
+
+    errors = getattr(request, "vditor_upload_errors", {})
+    reasons = getattr(request, "vditor_upload_error_reasons", {})
+    for filename in errors:
+        update_upload_metrics(0, 0.0, success=False)
+    return [
+        (filename, None, UploadError(message, reason=reasons.get(filename, "error")))
+        for filename, message in errors.items()
+    ]
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
 @cache_control(no_cache=True, no_store=True)
 @vary_on_headers("X-Requested-With")
-def vditor_images_upload_view(request: HttpRequest) -> JsonResponse:
+@server_timing
+@idempotent_upload
+@rate_limit_uploads
+@profile_sampled("upload")
+def vditor_images_upload_view(
+    request: HttpRequest, config: str = DEFAULT_POLICY
+) -> JsonResponse:
     """Handle image uploads for Vditor editor.
 
+    Every file sent in the ``file[]`` field is processed; files that fail are
+    reported in ``errFiles`` while the others are returned in ``succMap``.
+
     Args:
-        request: HTTP request containing uploaded file
+        request: HTTP request containing uploaded files
+        config: Upload policy bound to the route by its URL pattern
 
     Returns:
         JsonResponse with upload result
     """
     start_time = time.time()
-    
-    client_ip = request.META.get('REMOTE_ADDR', 'unknown')
-    user_agent = request.META.get('HTTP_USER_AGENT', 'unknown')
-    
+
+    client_ip = get_client_address(request)
+    user_agent = request.META.get("HTTP_USER_AGENT", "unknown")
+
     logger.info(
         f"Image upload request from {client_ip} - User-Agent: {user_agent[:100]}"
     )
 
-    # Check if file was uploaded
-    image_file = request.FILES.get("file[]")
-    if not image_file:
+    policy = _request_upload_policy(config)
+    if policy is None:
+        return _unknown_policy_response(config, client_ip)
+    quota_owners, quota_error = _check_upload_quota(request, client_ip)
+    if quota_error is not None:
+        return quota_error
+
+    # Check if files were uploaded
+    _install_upload_handler(request, policy)
+    with span("parse"):
+        image_files = request.FILES.getlist("file[]")
+    rejected = _streamed_upload_results(request, image_files, "file[]")
+    if not image_files and rejected:
+        return _build_upload_response(rejected, client_ip, start_time)
+    if not image_files:
         logger.warning(f"No file uploaded from {client_ip}")
         return JsonResponse(
             {
@@ -262,200 +1350,269 @@ def vditor_images_upload_view(request: HttpRequest) -> JsonResponse:
             status=400,
         )
 
-    # Validate uploaded file
     try:
-        is_valid, error_msg = _validate_uploaded_file(image_file)
-        if not is_valid:
-            logger.warning(
-                f"Invalid file upload attempt from {client_ip}: {error_msg}. "
-                f"File: {image_file.name}, Size: {image_file.size}"
-            )
-            return JsonResponse(
-                {
-                    "msg": error_msg,
-                    "code": 1,
-                },
-                status=400,
-            )
-    except Exception as e:
-        logger.error(f"File validation error from {client_ip}: {e}")
-        return JsonResponse(
-            {
-                "msg": _("File validation failed."),
-                "code": 1,
-            },
-            status=500,
-        )
+        results = _process_uploads(image_files, client_ip, policy, quota_owners)
+    except UploadsBusy:
+        return busy_response()
+    return _build_upload_response(results + rejected, client_ip, start_time)
 
-    # Generate safe filename with hash for uniqueness
-    original_filename = image_file.name
-    try:
-        safe_filename = secure_filename(original_filename)
-        if not safe_filename:
-            safe_filename = "unnamed_file.jpg"  # Default with extension
 
-        # Create hash of file content for deduplication and security
-        file_hash = hashlib.sha256()
-        for chunk in image_file.chunks():
-            file_hash.update(chunk)
-        content_hash = file_hash.hexdigest()[:16]  # Use first 16 chars
+@csrf_exempt
+@require_http_methods(["POST"])
+@cache_control(no_cache=True, no_store=True)
+@vary_on_headers("X-Requested-With")
+@server_timing
+@idempotent_upload
+@rate_limit_uploads
+async def vditor_images_upload_async_view(
+    request: HttpRequest, config: str = DEFAULT_POLICY
+) -> JsonResponse:
+    """Handle image uploads for Vditor editor without blocking the event loop.
 
-        # Reset file pointer after hashing
-        image_file.seek(0)
+    Async counterpart of ``vditor_images_upload_view`` for ASGI deployments.
+    Multipart parsing, validation, hashing and file writes run on the upload
+    thread pool; indexing, metrics and rejection counters run through
+    ``sync_to_async``. The JSON response is identical to the sync view.
 
-        # Generate unique filename with content hash
-        file_stem = Path(safe_filename).stem[:50]  # Limit filename length
-        file_ext = Path(safe_filename).suffix
-        unique_filename = f"{content_hash}_{file_stem}{file_ext}"
+    Args:
+        request: HTTP request containing uploaded files
+        config: Upload policy bound to the route by its URL pattern
 
-        upload_path = Path(settings.MEDIA_ROOT)
-        file_path = upload_path / unique_filename
+    Returns:
+        JsonResponse with upload result
+    """
+    start_time = time.time()
+    loop = asyncio.get_running_loop()
 
-        logger.info(
-            f"Processing upload from {client_ip}: {original_filename} -> "
-            f"{unique_filename} (hash: {content_hash}, size: {image_file.size})"
-        )
+    client_ip = get_client_address(request)
+    user_agent = request.META.get("HTTP_USER_AGENT", "unknown")
 
-        # Check if file already exists (deduplication)
-        if file_path.exists():
-            logger.info(f"File already exists, using existing: {unique_filename}")
-            file_url = os.path.join(settings.MEDIA_URL, unique_filename)
-
-            # Cache the response for successful duplicates
-            response = JsonResponse(
-                {
-                    "msg": _("File uploaded successfully (deduplicated)."),
-                    "code": 0,
-                    "data": {
-                        "errFiles": [],
-                        "succMap": {
-                            original_filename: file_url,
-                        },
-                    },
-                }
-            )
-            response["Cache-Control"] = "public, max-age=3600"  # Cache for 1 hour
-            
-            processing_time = time.time() - start_time
-            update_upload_metrics(image_file.size, processing_time, success=True)
-            logger.info(
-                f"Upload completed (deduplicated) in {processing_time:.3f}s "
-                f"from {client_ip}"
-            )
-            return response
+    logger.info(
+        f"Image upload request from {client_ip} - User-Agent: {user_agent[:100]}"
+    )
 
-    except Exception as e:
-        logger.error(
-            f"Failed to process filename '{original_filename}' from {client_ip}: {e}"
+    # Metrics and rejections go through the cache, which may be a network
+    # round trip; they are recorded off the event loop like the rest
+    policy = _request_upload_policy(config)
+    if policy is None:
+        return await sync_to_async(_unknown_policy_response)(config, client_ip)
+    quota_owners, quota_error = await sync_to_async(_check_upload_quota)(
+        request, client_ip
+    )
+    if quota_error is not None:
+        return quota_error
+
+    # Check if files were uploaded; accessing FILES parses the request body
+    _install_upload_handler(request, policy)
+    with span("parse"):
+        image_files = await loop.run_in_executor(
+            _upload_executor, request.FILES.getlist, "file[]"
+        )
+    rejected = await sync_to_async(_streamed_upload_results)(
+        request, image_files, "file[]"
+    )
+    if not image_files and rejected:
+        return await sync_to_async(_build_upload_response)(
+            rejected, client_ip, start_time
         )
+    if not image_files:
+        logger.warning(f"No file uploaded from {client_ip}")
         return JsonResponse(
             {
-                "msg": _("Invalid filename."),
+                "msg": _("No file uploaded."),
                 "code": 1,
             },
             status=400,
         )
 
-    # Save file to disk
     try:
-        # Ensure upload directory has secure permissions
-        upload_path.mkdir(parents=True, exist_ok=True, mode=0o755)
+        async with async_upload_slot():
+            prepared = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        _upload_executor,
+                        contextvars.copy_context().run,
+                        _prepare_upload_result,
+                        image_file,
+                        client_ip,
+                        policy,
+                    )
+                    for image_file in image_files
+                )
+            )
+            results = await sync_to_async(_complete_upload_results)(
+                image_files, list(prepared), client_ip, quota_owners
+            )
+    except UploadsBusy:
+        return await sync_to_async(busy_response)()
+    return await sync_to_async(_build_upload_response)(
+        results + rejected, client_ip, start_time
+    )
 
-        # Write file in chunks for memory efficiency with secure permissions
-        bytes_written = 0
-        temp_path = file_path.with_suffix(file_path.suffix + ".tmp")
 
-        try:
-            with open(temp_path, "wb") as f:
-                for chunk in image_file.chunks():
-                    f.write(chunk)
-                    bytes_written += len(chunk)
+@csrf_exempt
+@require_http_methods(["PUT"])
+@cache_control(no_cache=True, no_store=True)
+@server_timing
+@idempotent_upload
+@rate_limit_uploads
+def vditor_raw_upload_view(
+    request: HttpRequest, filename: str, config: str = DEFAULT_POLICY
+) -> JsonResponse:
+    """Handle an image sent as the raw request body.
 
-            # Set secure file permissions
-            os.chmod(temp_path, 0o644)
+    Skips multipart parsing entirely: after the same validation as the editor
+    upload, the body is hashed while it is spooled to a temporary file, which
+    is then stored like a multipart upload. Intended for API clients and bulk
+    importers.
 
-            # Atomic move to final location
-            temp_path.rename(file_path)
+    Args:
+        request: HTTP PUT request whose body is the image
+        filename: Original filename of the image
+        config: Upload policy bound to the route by its URL pattern
 
-        except Exception as e:
-            # Clean up temp file on error
-            if 'temp_path' in locals():
-                temp_path.unlink(missing_ok=True)
-            logger.error(f"File save error from {client_ip}: {e}")
-            raise
+    Returns:
+        JsonResponse with upload result
+    """
+    start_time = time.time()
+    client_ip = get_client_address(request)
 
-        logger.info(
-            f"Successfully saved file {unique_filename} ({bytes_written} bytes) "
-            f"from {client_ip}"
-        )
+    policy = _request_upload_policy(config)
+    if policy is None:
+        return _unknown_policy_response(config, client_ip)
+    quota_owners, quota_error = _check_upload_quota(request, client_ip)
+    if quota_error is not None:
+        return quota_error
 
-    except OSError as e:
-        logger.error(
-            f"Failed to create upload directory '{upload_path}' from {client_ip}: {e}"
-        )
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = 0
+    if content_length <= 0:
+        logger.warning(f"Raw upload without Content-Length from {client_ip}")
         return JsonResponse(
             {
-                "msg": _("Failed to create upload directory."),
+                "msg": _("Content-Length header is required."),
                 "code": 1,
             },
-            status=500,
+            status=411,
         )
-    except IOError as e:
-        logger.error(f"Failed to write file '{file_path}' from {client_ip}: {e}")
+
+    # A generic binary type carries no information; rely on magic numbers
+    content_type = request.content_type
+    if content_type in ("", "application/octet-stream"):
+        content_type = None
+
+    logger.info(
+        f"Raw image upload request from {client_ip}: {filename} "
+        f"({content_length} bytes)"
+    )
+    upload = RequestBodyUpload(request, filename, content_type, content_length)
+    try:
+        # Received before the upload slot is taken, so slow clients cannot
+        # hold slots while sending the body
+        with span("receive", size=content_length):
+            spooled = _spool_request_body(upload, policy)
+    except UploadError as error:
+        logger.warning(f"Raw upload rejected from {client_ip}: {error.message}")
+        update_upload_metrics(content_length, time.time() - start_time, success=False)
+        return _build_upload_response([(filename, None, error)], client_ip, start_time)
+    except OSError as e:
+        logger.error(f"Failed to receive raw upload from {client_ip}: {e}")
+        update_upload_metrics(content_length, time.time() - start_time, success=False)
+        error = UploadError(_("Failed to save uploaded file."), status=500)
+        return _build_upload_response([(filename, None, error)], client_ip, start_time)
+
+    try:
+        results = _process_uploads([spooled], client_ip, policy, quota_owners)
+    except UploadsBusy:
+        return busy_response()
+    finally:
+        spooled.close()
+    return _build_upload_response(results, client_ip, start_time)
+
+
+@require_http_methods(["GET", "HEAD"])
+@cache_control(no_cache=True)
+def vditor_upload_by_hash_view(request: HttpRequest, content_hash: str) -> JsonResponse:
+    """Look up an already stored upload by its SHA-256 content hash.
+
+    Lets clients hash a file locally and skip uploading content the server
+    already has.
+
+    Args:
+        request: HTTP GET or HEAD request
+        content_hash: Hex SHA-256 digest of the file content
+
+    Returns:
+        JsonResponse with the stored file URL (and its ``srcset`` when
+        derivatives are enabled), or 404 when unknown
+    """
+    content_hash = content_hash.lower()
+    if not CONTENT_HASH_RE.fullmatch(content_hash):
         return JsonResponse(
             {
-                "msg": _("Failed to save uploaded file."),
+                "msg": _("Invalid content hash."),
                 "code": 1,
             },
-            status=500,
+            status=400,
         )
-    except Exception as e:
-        logger.error(f"Unexpected error during file save from {client_ip}: {e}")
+
+    unique_filename = content_index.lookup(content_hash)
+    if unique_filename is None:
         return JsonResponse(
             {
-                "msg": _("An unexpected error occurred."),
+                "msg": _("File not found."),
                 "code": 1,
             },
-            status=500,
+            status=404,
         )
 
-    # Generate file URL
-    try:
-        file_url = os.path.join(settings.MEDIA_URL, unique_filename)
-        logger.info(f"Upload completed successfully: {file_url}")
+    data = {"url": _stored_url(unique_filename)}
+    from . import derivatives
 
-        response = JsonResponse(
-            {
-                "msg": _("Success!"),
-                "code": 0,
-                "data": {
-                    "errFiles": [],
-                    "succMap": {
-                        original_filename: file_url,
-                    },
-                },
-            }
-        )
-        # Cache successful uploads for better performance
-        response["Cache-Control"] = "public, max-age=3600"  # Cache for 1 hour
-        
-        processing_time = time.time() - start_time
-        update_upload_metrics(image_file.size, processing_time, success=True)
-        logger.info(
-            f"Upload completed successfully in {processing_time:.3f}s from {client_ip}"
-        )
-        return response
-    except Exception as e:
-        logger.error(f"Failed to generate file URL from {client_ip}: {e}")
-        # Clean up the file if URL generation fails
-        try:
-            file_path.unlink(missing_ok=True)
-        except Exception:
-            pass
-        return JsonResponse(
-            {
-                "msg": _("Failed to process uploaded file."),
-                "code": 1,
-            },
-            status=500,
+    if derivatives.DERIVATIVE_WIDTHS:
+        data["srcset"] = derivatives.get_srcset(content_hash)
+
+    return JsonResponse(
+        {
+            "msg": _("File already uploaded."),
+            "code": 0,
+            "data": data,
+        }
+    )
+
+
+@require_http_methods(["GET"])
+@cache_control(no_cache=True, no_store=True)
+def vditor_metrics_view(request: HttpRequest) -> HttpResponse:
+    """Serve upload and cache metrics in the Prometheus text format.
+
+    Disabled unless ``VDITOR_METRICS_ENDPOINT`` is set. When
+    ``VDITOR_METRICS_TOKEN`` is set, scrapers must send it as a bearer token.
+
+    Args:
+        request: HTTP GET request
+
+    Returns:
+        HttpResponse in the Prometheus text exposition format
+    """
+    if not upload_metrics.METRICS_ENDPOINT:
+        raise Http404
+
+    token = upload_metrics.METRICS_TOKEN
+    if token is not None:
+        scheme, _sep, credentials = request.headers.get("Authorization", "").partition(
+            " "
         )
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+            credentials.strip().encode(), token.encode()
+        ):
+            response = HttpResponse("Unauthorized\n", status=401)
+            response["WWW-Authenticate"] = "Bearer"
+            return response
+
+    return HttpResponse(
+        upload_metrics.render_prometheus(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -4,13 +4,17 @@ from functools import lru_cache
 from typing import Any, Dict, Optional
 
 from django import forms
+from django.conf import settings
 from django.core.cache import cache
 from django.forms.utils import flatatt
 from django.forms.widgets import get_default_renderer
+from django.urls import reverse
 from django.utils.encoding import force_str
 from django.utils.safestring import mark_safe
 
 from .configs import VditorConfig
+from .profiling import profile_sampled
+from .tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -57,12 +61,23 @@ class VditorWidget(forms.Textarea):
 
         return config
 
+    @profile_sampled("render")
     def render(
         self,
         name: str,
         value: Any,
         attrs: Optional[Dict[str, Any]] = None,
         renderer: Any = None,
+    ) -> str:
+        with span("render", widget=name, config=self.config_name):
+            return self._render(name, value, attrs, renderer)
+
+    def _render(
+        self,
+        name: str,
+        value: Any,
+        attrs: Optional[Dict[str, Any]],
+        renderer: Any,
     ) -> str:
         if renderer is None:
             renderer = get_default_renderer()
@@ -84,6 +99,11 @@ class VditorWidget(forms.Textarea):
             "id": _id,
             "config": json.dumps(self.config),
         }
+        if getattr(settings, "VDITOR_UPLOAD_PREFLIGHT", False):
+            # Let the browser skip uploading files the server already stores
+            context["preflight_url"] = reverse(
+                "uploads_by_hash", kwargs={"content_hash": "__hash__"}
+            )
 
         try:
             rendered_html = renderer.render("widget.html", context)